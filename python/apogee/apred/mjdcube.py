@@ -2,14 +2,20 @@ import sys
 import os
 import glob
 import pdb
+import multiprocessing as mp
 import numpy as np
 from astropy.io import fits
 
-def mjdcube(mjd, darkid=None, write=False, apred='current', clobber=False) :
+def mjdcube(mjd, darkid=None, write=False, apred='current', clobber=False, threads=0) :
 
   """
   Make a cube for a given night with the CDS images of all frames
   Optionally, write out individual uncompressed data cubes
+
+  Frames are processed one at a time (or threads at a time, across chips and files, with
+  threads>0) and appended to apHist-{chip}-{mjd}.fits.partial as they are done, which is
+  renamed to the final file when the chip is complete. A partial file is resumed from the
+  last frame recorded in its .manifest file unless clobber=True.
   """
 
   print('mjd: ', mjd)
@@ -19,6 +25,9 @@ def mjdcube(mjd, darkid=None, write=False, apred='current', clobber=False) :
   datadir=os.getenv('APOGEE_DATA')
   outdir=os.getenv('APOGEE_REDUX')+'/'+apred+'/exposures/apogee-n/'+str(mjd)+'/'
 
+  # set up the list of frames to process, in output order
+  tasks=[]
+  outfiles={}
   for chip in ['a','b','c'] :
     files = sorted(glob.glob(datadir+'/'+str(mjd)+'/apR-'+chip+'-*.apz')+glob.glob(datadir+'1m/'+str(mjd)+'/apR-'+chip+'-*.apz'))
 
@@ -26,76 +35,146 @@ def mjdcube(mjd, darkid=None, write=False, apred='current', clobber=False) :
     outfile = outdir+'apHist-'+chip+'-'+str(mjd)+'.fits'
 
     # does output file already exist?
-    if not clobber and os.path.exists(outfile) : return
+    if not clobber and os.path.exists(outfile) : continue
 
-    out=fits.HDUList(fits.PrimaryHDU())
+    # resume from a partial output file, if there is one
+    done = _resume(outfile,clobber=clobber)
+    outfiles[chip] = outfile
 
     # get dark frame if requested
     if darkid is not None :
-        dark=fits.open(os.environ['APOGEE_REDUX']+'/'+apred+'/cal/darkcorr/apDark-'+chip+'-'+darkid+'.fits')[1].data
+        darkfile=os.environ['APOGEE_REDUX']+'/'+apred+'/cal/darkcorr/apDark-'+chip+'-'+darkid+'.fits'
+    else :
+        darkfile=None
 
-    # loop over all files
     for file in files :
-      print(file)
-      print('file: ',file)
-      if write :
-        # output file name for individual uncompressed images
-        outfile = os.path.basename(file.strip('apz')+'fits')
-        hdout=fits.HDUList(fits.PrimaryHDU())
-
-      # open file and confirm checksums
-      hd=fits.open(file, do_not_scale_image_data = True, uint = True, checksum = True)
-
-      # file has initial header, avg_dcounts, then nreads
-      nreads = len(hd)-2
-      try:
-          avg_dcounts=hd[1].data
+      if os.path.basename(file) in done : continue
+      # output file name for individual uncompressed images
+      if write : writefile = os.path.basename(file.strip('apz')+'fits')
+      else : writefile = None
+      tasks.append((chip,file,darkfile,writefile))
+
+  # process frames, keeping at most a few frames per process in memory, and append
+  #   the CDS frames in order
+  if threads > 0 :
+    pool = mp.Pool(threads)
+    nahead = 2*threads
+    results = [None]*len(tasks)
+    for itask in range(min(nahead,len(tasks))) : results[itask] = pool.apply_async(cdsframe,tasks[itask][1:])
+  for itask,(chip,file,darkfile,writefile) in enumerate(tasks) :
+    print('file: ',file)
+    if threads > 0 :
+      cds,header = results[itask].get()
+      results[itask] = None
+      if itask+nahead < len(tasks) : results[itask+nahead] = pool.apply_async(cdsframe,tasks[itask+nahead][1:])
+    else :
+      cds,header = cdsframe(file,darkfile,writefile)
+    _append(outfiles[chip],cds,header,os.path.basename(file))
+  if threads > 0 :
+    pool.close()
+    pool.join()
+
+  # output files are complete
+  for chip in outfiles :
+    outfile=outfiles[chip]
+    if not os.path.exists(outfile+'.partial') : _append(outfile,None,None,None)
+    os.rename(outfile+'.partial',outfile)
+    if os.path.exists(outfile+'.manifest') : os.remove(outfile+'.manifest')
+
+def cdsframe(file,darkfile=None,writefile=None) :
+  """
+  Return the CDS image (last read - second read) and last read header for an apR .apz file,
+  decompressing and accumulating one read at a time
+  Optionally subtract a dark from darkfile, and write the individual uncompressed reads to writefile
+  """
+  # open file and confirm checksums
+  hd=fits.open(file, do_not_scale_image_data = True, uint = True, checksum = True)
+
+  if writefile is not None :
+    fits.HDUList(fits.PrimaryHDU()).writeto(writefile,overwrite=True, checksum = True, output_verify='fix')
+
+  # file has initial header, avg_dcounts, then nreads
+  nreads = len(hd)-2
+  try:
+      avg_dcounts=hd[1].data
+  except:
+      # fix header if there is a problem (e.g., MJD=55728, 01660046)
+      hd[1].verify('fix')
+      avg_dcounts=hd[1].data
+
+  # first read is in extension 2
+  ext = 2
+
+  # loop over reads, processing into raw reads, and appending
+  for read in range(1,nreads+1) :
+    header = hd[ext].header
+    try:
+      raw = hd[ext].data
+    except:
+      hd[ext].verify('fix')
+      raw = hd[ext].data
+    if read == 1 :
+      data = np.copy(raw)
+    else :
+      data = np.add(data,raw,dtype=np.int16)
+      data = np.add(data,avg_dcounts,dtype=np.int16)
+      if read == 2 : first = data
+
+    if writefile is not None : fits.append(writefile,data,header,checksum=True,output_verify='fix')
+
+    # release the decompressed read
+    del raw
+    del hd[ext].data
+    ext += 1
+
+  # compute the cdsframe, subtract dark if we have one
+  cds = (data[0:2048,0:2048] - first[0:2048,0:2048] ).astype(float)
+  print(cds.shape)
+  if darkfile is not None :
+      # only the reads that are needed are read from the dark
+      dark=fits.open(darkfile,memmap=True)[1].data
+      print(dark.shape,nreads)
+      # if we don't have enough reads in the dark, do nothing
+      try :
+          cds -= (dark[nreads-1,:,:] - dark[2,:,:])
       except:
-          # fix header if there is a problem (e.g., MJD=55728, 01660046)
-          hd[1].verify('fix')
-          avg_dcounts=hd[1].data
-
-      # first read is in extension 2
-      ext = 2
-  
-      # loop over reads, processing into raw reads, and appending
-      for read in range(1,nreads+1) :
-        header = hd[ext].header
-        try:
-          raw = hd[ext].data
-        except:
-          hd[ext].verify('fix')
-          raw = hd[ext].data
-        if read == 1 :
-          data = np.copy(raw)
-        else :
-          data = np.add(data,raw,dtype=np.int16)
-          data = np.add(data,avg_dcounts,dtype=np.int16)
-          if read == 2 : first = data
-  
-        if write : hdout.append(fits.ImageHDU(data,header))
-          
-        ext += 1
- 
-      # compute and add the cdsframe, subtract dark if we have one
-      cds = (data[0:2048,0:2048] - first[0:2048,0:2048] ).astype(float)
-      print(cds.shape)
-      if darkid is not None :
-          print(dark.shape,nreads)
-          # if we don't have enough reads in the dark, do nothing
-          try :
-              cds -= (dark[nreads-1,:,:] - dark[2,:,:])
-          except:
-              print('not halting: not enough reads in dark, skipping dark subtraction for mjdcube')
-              pass
-      out.append(fits.ImageHDU(cds,header))
-      if write :
-        hdout.writeto(outfile,overwrite=True, checksum = True, output_verify='fix')
-        hd.close()
-
-    # write out the CDS frame
-    out.writeto(outfile,overwrite=True, checksum = True, output_verify='fix')
-    out.close()
+          print('not halting: not enough reads in dark, skipping dark subtraction for mjdcube')
+          pass
+      del dark
+  hd.close()
+  return cds,header
+
+def _resume(outfile,clobber=False) :
+  """
+  Return set of apR files already in a partial output file, truncating any frame that was
+  not completely written
+  """
+  done=set()
+  if clobber or not os.path.exists(outfile+'.manifest') or not os.path.exists(outfile+'.partial') :
+    for f in [outfile+'.partial',outfile+'.manifest'] :
+      if os.path.exists(f) : os.remove(f)
+    return done
+  size=None
+  for line in open(outfile+'.manifest') :
+    cols=line.split()
+    if len(cols) != 2 : continue
+    done.add(cols[0])
+    size=int(cols[1])
+  if size is not None :
+    with open(outfile+'.partial','r+b') as f : f.truncate(size)
+  print('resuming {:s} with {:d} frames'.format(outfile,len(done)))
+  return done
+
+def _append(outfile,cds,header,name) :
+  """
+  Append a CDS frame to the partial output file, starting it if needed, and record it in the manifest
+  """
+  if not os.path.exists(outfile+'.partial') :
+    fits.HDUList(fits.PrimaryHDU()).writeto(outfile+'.partial',checksum=True)
+  if cds is None : return
+  fits.append(outfile+'.partial',cds,header,checksum=True,output_verify='fix')
+  with open(outfile+'.manifest','a') as f :
+    f.write('{:s} {:d}\n'.format(name,os.path.getsize(outfile+'.partial')))
 
 if __name__ == "__main__" :
-    mjdcube(sys.argv[1],sys.argv[2:]) 
+    mjdcube(sys.argv[1],sys.argv[2:])
@@ -141,6 +141,25 @@ def comp(a,b,av=None,bv=None,domatch=True,out=None) :
 
     return a,b
 
+def visitstats(all,key='APOGEE_ID') :
+    """ Per-object visit statistics from a set of visits, computed in a single sorted pass
+
+    Returns:
+        objs : sorted unique objects
+        vhelio, vscat : mean and standard deviation of VHELIO for each object
+        verr : maximum VRELERR for each object
+        sigfiber : standard deviation of FIBERID for each object
+        vdiff : residual of each visit from its object mean VHELIO (in order of input visits)
+        n : number of visits for each object
+        inv : index into objs for each input visit
+    """
+    grp = match.group(all[key])
+    objs,inv,order,start,n = grp
+    vel = match.groupstats(None,all['VHELIO'],grp=grp)
+    err = match.groupstats(None,all['VRELERR'],grp=grp)
+    fib = match.groupstats(None,all['FIBERID'],grp=grp)
+    return objs,vel['mean'],vel['std'],err['max'],fib['std'],vel['resid'],n,inv
+
 def visitsum_tel(all) :
 
     j=np.where(all['TELESCOPE'] == 'apo25m')[0]
@@ -150,24 +169,20 @@ def visitsum_tel(all) :
     apoobjs = np.array(list(set(apo['APOGEE_ID'])))
     lcoobjs = np.array(list(set(lco['APOGEE_ID'])))
     i1,i2=match.match(apoobjs,lcoobjs)
-    vhelio = []
-    vscat = []
-    verr = []
-    sigfiber = []
-    vdiff = []
-    n = []
-    mjd = []
-    tel = []
-    for i in i1 :
-        j=np.where(all['APOGEE_ID'] == apoobjs[i])[0]
-        vhelio.append(all['VHELIO'][j].mean())
-        vscat.append(all['VHELIO'][j].std())
-        verr.append(all['VRELERR'][j].max())
-        sigfiber.append(all['FIBERID'][j].std())
-        vdiff.extend(all['VHELIO'][j]-all['VHELIO'][j].mean())
-        mjd.extend(all['MJD'][j])
-        tel.extend(all['TELESCOPE'][j])
-        n.append(len(j))
+
+    # statistics for all objects, then restrict to those observed from both telescopes
+    objs,vhelio,vscat,verr,sigfiber,vdiff,n,inv = visitstats(all)
+    both = np.isin(objs,apoobjs[i1])
+    vhelio = vhelio[both]
+    vscat = vscat[both]
+    verr = verr[both]
+    sigfiber = sigfiber[both]
+    n = n[both]
+    j = np.where(both[inv])[0]
+    j = j[np.argsort(inv[j],kind='mergesort')]
+    vdiff = vdiff[j]
+    mjd = all['MJD'][j]
+    tel = all['TELESCOPE'][j]
 
     fig,ax=plots.multi(1,2)
     mjd=np.array(mjd)
@@ -190,30 +205,9 @@ def visitsum_tel(all) :
 
 
 def visitsum(all,out=None,minvisit=1) :
-    objs = set(all['APOGEE_ID'])
     if out is None :
-        vhelio = []
-        vscat = []
-        verr = []
-        sigfiber = []
-        vdiff = []
-        n = []
+        objs,vhelio,vscat,verr,sigfiber,vdiff,n,inv = visitstats(all)
         print('n objects: ', len(objs))
-        for iobj,obj in enumerate(objs) :
-            j = np.where(all['APOGEE_ID'] == obj)[0]
-            print(iobj,len(j))
-            vhelio.append(all['VHELIO'][j].mean())
-            vscat.append(all['VHELIO'][j].std())
-            verr.append(all['VRELERR'][j].max())
-            sigfiber.append(all['FIBERID'][j].std())
-            vdiff.extend(all['VHELIO'][j]-all['VHELIO'][j].mean())
-            n.append(len(j))
-        vhelio=np.array(vhelio)
-        vscat=np.array(vscat)
-        verr=np.array(verr)
-        sigfiber=np.array(sigfiber)
-        vdiff=np.array(vdiff)
-        n=np.array(n)
     else :
         vhelio,vscat,verr,sigfiber,vdiff,n = out
 
@@ -238,45 +232,21 @@ def field(name,dr14=False,dir='./',minvisit=1) :
     elif name == 'N188' : locid=[os.environ['APOGEE_REDUX']+'/r8/fields/apo25m/4217//apVisitSum*', 
                                  os.environ['APOGEE_REDUX']+'/r8/fields/apo25m/5067//apVisitSum*']
     alldr14=struct.concat(locid)
-    objs = set(all['APOGEE_ID'])
-    vhelio = []
-    vscat = []
-    verr = []
-    sigfiber = []
-    vdiff = []
-    n = []
-    dr14vhelio = []
-    dr14vscat = []
-    dr14sigfiber = []
-    dr14n = []
-    dr14vdiff = []
-    for obj in objs :
-        j = np.where(all['APOGEE_ID'] == obj)[0]
-        vhelio.append(all['VHELIO'][j].mean())
-        vscat.append(all['VHELIO'][j].std())
-        verr.append(all['VRELERR'][j].max())
-        sigfiber.append(all['FIBERID'][j].std())
-        vdiff.extend(all['VHELIO'][j]-all['VHELIO'][j].mean())
-        n.append(len(j))
-        #print(all['MJD'][j],all['VHELIO'][j])
-        j = np.where(alldr14['APOGEE_ID'] == obj)[0]
-        dr14vhelio.append(alldr14['VHELIO'][j].mean())
-        dr14vscat.append(alldr14['VHELIO'][j].std())
-        dr14sigfiber.append(alldr14['FIBERID'][j].std())
-        dr14n.append(len(j))
-        dr14vdiff.extend(alldr14['VHELIO'][j]-alldr14['VHELIO'][j].mean())
-        #print(all['MJD'][j],all['VHELIO'][j],all['VRELERR'][j])
-        #print(alldr14['MJD'][j],alldr14['VHELIO'][j],alldr14['VRELERR'][j])
-        #pdb.set_trace()
-    vhelio=np.array(vhelio)
-    vscat=np.array(vscat)
-    verr=np.array(verr)
-    sigfiber=np.array(sigfiber)
-    n=np.array(n)
-    dr14vhelio=np.array(dr14vhelio)
-    dr14vscat=np.array(dr14vscat)
-    dr14sigfiber=np.array(dr14sigfiber)
-    dr14n=np.array(dr14n)
+    objs,vhelio,vscat,verr,sigfiber,vdiff,n,inv = visitstats(all)
+
+    # DR14 statistics for the same objects, NaN where an object has no DR14 visits
+    dr14objs,dvhelio,dvscat,dverr,dsigfiber,dvdiff,dn,dinv = visitstats(alldr14)
+    i1,i2 = match.match(objs,dr14objs)
+    dr14vhelio = np.full(len(objs),np.nan)
+    dr14vscat = np.full(len(objs),np.nan)
+    dr14sigfiber = np.full(len(objs),np.nan)
+    dr14n = np.zeros(len(objs),dtype=int)
+    dr14vhelio[i1] = dvhelio[i2]
+    dr14vscat[i1] = dvscat[i2]
+    dr14sigfiber[i1] = dsigfiber[i2]
+    dr14n[i1] = dn[i2]
+    dr14vdiff = dvdiff[np.isin(dinv,i2)]
+
     fig,ax=plots.multi(2,3)
     gd =np.where(n > minvisit)[0]
     ax[0,0].hist(vscat[gd],bins=np.arange(0.01,1,0.01),histtype='step',cumulative=True,normed=True,color='b')
@@ -14,6 +14,7 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import copy
+import multiprocessing as mp
 import numpy as np
 import matplotlib.pyplot as plt
 import os
@@ -39,7 +40,7 @@ colors=['r','g','b','c','m','y']
 xlim=[[16400,17000],[15900,16500],[15100,15800]]
 
 def wavecal(nums=[2420038],name=None,vers='current',inst='apogee-n',rows=[150],npoly=4,reject=3,
-            plot=False,hard=True,verbose=False,clobber=False,init=False,nofit=False,test=False) :
+            plot=False,hard=True,verbose=False,clobber=False,init=False,nofit=False,test=False,threads=0,nseed=10) :
     """ APOGEE wavelength calibration
 
     Solves for wavelength calibration given input frameid(s) allowing for a single polynomial
@@ -59,6 +60,9 @@ def wavecal(nums=[2420038],name=None,vers='current',inst='apogee-n',rows=[150],n
         init (bool) : if true, use simple quadratic estimate for first guess (default=False)
         nofit (bool) : only find lines, skip fit (default=False)
         test (bool) : if True, use polynomial from first set, only let centers shift for all other sets
+        threads (int) : number of parallel processes for row fits, 0 to fit rows in order with each row started
+                        from the previous solution (default=0)
+        nseed (int) : with threads>0, rows are started from the solution of the nearest of every nseed-th row (default=10)
     """
     load=apload.ApLoad(apred=vers,instrument=inst)
 
@@ -142,9 +146,9 @@ def wavecal(nums=[2420038],name=None,vers='current',inst='apogee-n',rows=[150],n
         fig,ax=plots.multi(1,3,hspace=0.001,wspace=0.001)
         fig2,ax2=plots.multi(1,3,hspace=0.001,wspace=0.001)
 
-    # loop over requested rows
-    for irow,row in enumerate(rows) :
-        # set up independent variable array with pixel, chip, groupid, and dependent variable (wavelength)
+    # set up independent variable array with pixel, chip, groupid, and dependent variable (wavelength) for each row
+    rowdata={}
+    for row in rows :
         thisrow = np.where((linestr['row'] == row) & (linestr['peak'] > 100))[0]
         x = np.zeros([3,len(thisrow)])
         x[0,:] = linestr['pixel'][thisrow]
@@ -152,101 +156,99 @@ def wavecal(nums=[2420038],name=None,vers='current',inst='apogee-n',rows=[150],n
         # we may have missing groups for this row
         groupid,groups = getgroup(linestr['frameid'][thisrow])
         x[2,:] = groupid
-        #x[2,:] = linestr['frameid'][thisrow]
-        ngroup = len(groups)
         y = linestr['wave'][thisrow]
         # if we don't have any groups, skip this row
-        if ngroup<= 0: continue
-
-        npars=npoly+3*ngroup
-        pars = np.zeros(npars)
-        # if we have more than one group, get starting polynomial guess from first group, to help
-        #   to avoid local minima
-        if ngroup > 1 :
-            if abs(nums[1]-nums[0]) > 1 : 
-                print('for multiple groups, first two frames must be from same group!')
-                pdb.set_trace()
-            print('running wavecal for: ', nums[0:2],maxgroup,ngroup,' row: ',row)
-            pars0 = wavecal(nums=nums[0:2],name=None,vers=vers,inst=inst,rows=[row],npoly=npoly,reject=reject,init=init,verbose=verbose)
-            pars[npoly-4:npoly] = pars0[0:4]
-            for igroup in range(ngroup): pars[npoly+igroup*3:npoly+(igroup+1)*3] = pars0[4:7]
-        else :
-            pars = copy.copy(initpars)
-        # initial residuals
-        res = y-func_multi_poly(x,*pars)
-        # iterate to allow outlier rejection
-        if irow == 0 : maxiter=7
-        else : maxiter=7
-        for niter in range(maxiter) :
-            # initialize bounds (to no bounds)
-            bounds = ( np.zeros(len(pars))-np.inf, np.zeros(len(pars))+np.inf)
-            # lock the middle chip position if we have one group, else the central wavelength
-            if ngroup==1 :
-                bounds[0][npoly+1] = -1.e-7
-                bounds[1][npoly+1] = 1.e-7
-            else :
-                bounds[0][npoly-1] = pars[npoly-1]-1.e-7*abs(pars[npoly-1])
-                bounds[1][npoly-1] = pars[npoly-1]+1.e-7*abs(pars[npoly-1])
-                # if we have multiple groups, only fit for chip locations during first iterations and every 3rd thereafter
-                if test or niter<3 or niter%3 == 1 : 
-                    for i in range(npoly) : 
-                        bounds[0][i] =  pars[i]-1.e-7*abs(pars[i])
-                        bounds[1][i] =  pars[i]+1.e-7*abs(pars[i])
-
-            # reject lines with bad residuals
-            gd = np.where(abs(res) < np.median(res)+reject*np.median(np.abs(res)))[0]
-
-            # calculate rms in each group and make sure we have lines in all groups
-            for igroup in range(ngroup) : 
-                j=np.where(x[2,gd] == igroup)[0]
-                if len(j) <= 0 :
-                  # if any group is missing, things will fail in func_multi_poly to determine correct npoly
-                  print('missing lines from group: ', igroup)
-                  pdb.set_trace()
-            
-            # use curve_fit to optimize parameters
-            try :
-                if verbose: 
-                    print('Niter: ', niter, 'row: ', row, 'ngroup: ', ngroup, 'nlines: ', len(thisrow), 'gd: ', len(gd))
-                    print(pars)
-                popt,pcov = curve_fit(func_multi_poly,x[:,gd],y[gd],p0=pars,bounds=bounds)
-                pars = copy.copy(popt)
-                res = y-func_multi_poly(x,*pars)
-                if verbose: 
-                    print('res: ',len(gd),np.median(res),np.median(np.abs(res)),res[gd].std())
-                    print(pars)
-            except :
-                print('Solution failed for row: ', row)
-                pdb.set_trace()
-                popt = pars*0.
-            # plot individual line residuals if requested. Get rid of maxiter-1 if you want to see plots at each iteration
-            if plot and niter == maxiter-1 :
-                for ichip in range(3) :
-                    gdplt = np.where(x[1,gd] == ichip+1)[0]
-                    if niter == maxiter-1 : 
-                        z=np.zeros(len(y))+row
-                        zr=[0,300]
-                    else : 
-                        z=x[2,:]
-                        zr=[0,ngroup]
-                    if niter < maxiter-1 : ax[ichip].cla()
-                    plots.plotc(ax[ichip],x[0,gd[gdplt]],res[gd[gdplt]],z[gd[gdplt]],zr=zr,
-                                xt='Pixel',yt='obs-fit wavelength',size=10)
-                    plt.show()
-                if not hard : pdb.set_trace()
-        
-        allrms = res[gd].std()
-        # throw out bad solutions
-        #if allrms > 0.1 : popt = pars*0.
-        if allrms < 0.1 : initpars = copy.copy(pars)
+        if len(groups) > 0 : rowdata[row] = (x,y,groups,linestr['frameid'][thisrow])
+
+    # initial guess for a single group
+    initpars1 = copy.copy(initpars[0:npoly+3])
+    if threads > 0 : pool = mp.Pool(threads)
+
+    # if we have more than one group, get starting polynomial guess from a fit to the first group, to help
+    #   to avoid local minima. These are all started from the same initial guess, so are done at once
+    multi = [row for row in rows if row in rowdata and len(rowdata[row][2]) > 1]
+    if len(multi) > 0 and abs(nums[1]-nums[0]) > 1 : 
+        print('for multiple groups, first two frames must be from same group!')
+        pdb.set_trace()
+    tasks=[]
+    for row in multi :
+        x,y,groups,frameid = rowdata[row]
+        j = np.where(frameid == 0)[0]
+        if len(j) > 0 : tasks.append((row,x[:,j]*[[1],[1],[0]],y[j],1,initpars1,npoly,reject,test,verbose))
+    if threads > 0 : firstgroup = pool.map_async(fitrow, tasks).get()
+    else : firstgroup = list(map(fitrow, tasks))
+    firstgroup = dict([(task[0],out[1]) for task,out in zip(tasks,firstgroup)])
+    multipars = {}
+    for row in multi :
+        pars0 = firstgroup[row] if row in firstgroup else initpars1
+        ngroup = len(rowdata[row][2])
+        pars = np.zeros(npoly+3*ngroup)
+        pars[npoly-4:npoly] = pars0[0:4]
+        for igroup in range(ngroup): pars[npoly+igroup*3:npoly+(igroup+1)*3] = pars0[4:7]
+        multipars[row] = pars
+
+    def _task(row,pars) :
+        x,y,groups,frameid = rowdata[row]
+        if row in multipars : pars = multipars[row]
+        return (row,x,y,len(groups),pars,npoly,reject,test,verbose)
+
+    results = {}
+    if threads > 0 :
+        # single group rows start from the solution of a seed row (every nseed-th row, themselves started
+        #   from the initial guess) rather than the previous row, so the result does not depend on the order in
+        #   which rows are run
+        fitrows = [row for row in rows if row in rowdata]
+        seeds = fitrows[nseed//2::nseed] if len(fitrows) > nseed else fitrows[len(fitrows)//2:len(fitrows)//2+1]
+        for row,out in zip(seeds,pool.map_async(fitrow,[_task(row,initpars1) for row in seeds]).get()) :
+            results[row] = out
+        tasks = []
+        for row in fitrows :
+            if row in results : continue
+            # nearest seed row with a good solution
+            pars = initpars1
+            for seed in sorted(seeds,key=lambda seed : abs(seed-row)) :
+                popt,spars,res,gd = results[seed]
+                if len(spars) == npoly+3 and res[gd].std() < 0.1 :
+                    pars = spars
+                    break
+            tasks.append(_task(row,pars))
+        for task,out in zip(tasks,pool.map_async(fitrow, tasks).get()) :
+            results[task[0]] = out
+        pool.close()
+        pool.join()
+    else :
+        # initial parameter guess for first row, subsequent rows will use guess from previous row
+        for row in rows :
+            if row not in rowdata : continue
+            results[row] = fitrow(_task(row,initpars1))
+            popt,pars,res,gd = results[row]
+            # throw out bad solutions
+            if res[gd].std() < 0.1 and len(pars) == npoly+3 : initpars1 = copy.copy(pars)
+
+    # save final fits in allpars
+    pars = initpars
+    for row in rows :
+        if row not in rowdata : continue
+        x,y,groups,frameid = rowdata[row]
+        ngroup = len(groups)
+        popt,pars,res,gd = results[row]
+        # plot individual line residuals if requested
+        if plot :
+            for ichip in range(3) :
+                gdplt = np.where(x[1,gd] == ichip+1)[0]
+                z=np.zeros(len(y))+row
+                zr=[0,300]
+                plots.plotc(ax[ichip],x[0,gd[gdplt]],res[gd[gdplt]],z[gd[gdplt]],zr=zr,
+                            xt='Pixel',yt='obs-fit wavelength',size=10)
+                plt.show()
+            if not hard : pdb.set_trace()
         if verbose : print(row,pars)
         allpars[0:npoly,row] = popt[0:npoly]
-        ref=allpars[npoly+1,row]
-        # save final fits in allpars. For chip locations, transform to chip offsets
+        # For chip locations, transform to chip offsets
         for jgroup in range(ngroup) :
             igroup=groups[jgroup]
             for ichip in range(3) : allpars[npoly+igroup*3+ichip,row] = popt[npoly+jgroup*3+ichip]
-            j=np.where(x[2,gd] == igroup)[0]
+            j=np.where(x[2,gd] == jgroup)[0]
             rms[row,igroup] = res[gd[j]].std()
             sig[row,igroup] = np.median(np.abs(res[gd[j]]))
 
@@ -463,7 +465,7 @@ def save_apWave(pars,out=None,group=0,rows=np.arange(300),npoly=4,frames=[],rms=
         allhdu.append(hdu)
     return allhdu
 
-def findlines(frame,rows,waves,lines,out=None,verbose=False,estsig=2) :
+def findlines(frame,rows,waves,lines,out=None,verbose=False,estsig=2,batch=True) :
     """ Determine positions of lines from input file in input frame for specified rows
 
     Args:
@@ -472,6 +474,8 @@ def findlines(frame,rows,waves,lines,out=None,verbose=False,estsig=2) :
         waves (list)  : list of wavelength arrays to be used to get initial pixel guess for input lines
         lines :  table with desired lines, must have at least CHIPNUM and WAVE tags
         out= (str) : optional name of output ASCII file for lines (default=None)
+        batch= (bool) : fit all lines in a row together with peakfit_batch, falling back to peakfit
+                        for lines where that fails, else fit each line with peakfit (default=True)
 
     Returns :
         structure with identified lines, with tags chip, row, wave, peak, pixrel, dpixel, frameid
@@ -488,40 +492,47 @@ def findlines(frame,rows,waves,lines,out=None,verbose=False,estsig=2) :
         # Use median offset of previous row for starting guess
         # Add a dummy first row to get starting guess offset for the first row
         dpixel_median = 0.
+        j=np.where(lines['CHIPNUM'] == ichip+1)[0]
         for irow,row in enumerate(np.append([rows[0]],rows)) :
             # subtract off median-filtered spectrum to remove background
             medspec = frame[chip][1].data[row,:]-medfilt(frame[chip][1].data[row,:],101)
-            j=np.where(lines['CHIPNUM'] == ichip+1)[0]
+            sigma=frame[chip][2].data[row,:]
             dpixel=[]
             # for dummy row, open up the search window by a factor of two
             if irow == 0 : estsig0=2*estsig
             else : estsig0=estsig
-            for iline in j :
-                wave=lines['WAVE'][iline]
-                try :
-                    pix0=wave2pix(wave,waves[chip][row,:])+dpixel_median
-                    # find peak in median-filtered subtracted spectrum
-                    pars=peakfit(medspec,pix0,estsig=estsig0,
-                                 sigma=frame[chip][2].data[row,:],mask=frame[chip][3].data[row,:])
-                    if lines['USEWAVE'][iline] == 1 : dpixel.append(pars[1]-pix0)
-                    if irow > 0 :
-                        linestr['chip'][nline] = ichip+1
-                        linestr['row'][nline] = row
-                        linestr['wave'][nline] = wave
-                        linestr['peak'][nline] = pars[0]
-                        linestr['pixel'][nline] = pars[1]
-                        linestr['dpixel'][nline] = pars[1]-pix0
-                        linestr['wave_found'][nline] = pix2wave(pars[1],waves[chip][row,:])
-                        linestr['frameid'][nline] = num
-                        nline+=1
-                    if out is not None :
-                        out.write('{:5d}{:5d}{:12.3f}{:12.3f}{:12.3f}{:12.3f}{:12d}\n'.format(
-                                  ichip+1,row,wave,pars[0],pars[1],pars[1]-pix0,num))
-                    elif verbose :
-                        print('{:5d}{:5d}{:12.3f}{:12.3f}{:12.3f}{:12.3f}{:12d}'.format(
-                              ichip+1,row,wave,pars[0],pars[1],pars[1]-pix0,num))
-                except :
-                    if verbose : print('failed: ',num,row,chip,wave)
+            # initial pixel guesses for all lines, from a single wavelength solution spline for this row
+            wave=lines['WAVE'][j]
+            pix0=wave2pix(np.array(wave),waves[chip][row,:])+dpixel_median
+            if batch : 
+                allpars=peakfit_batch(medspec,pix0,estsig=estsig0,sigma=sigma)
+            else :
+                allpars=np.full([len(j),3],np.nan)
+            for k in np.where(~np.isfinite(allpars[:,1]))[0] :
+                try : allpars[k]=peakfit(medspec,pix0[k],estsig=estsig0,sigma=sigma,mask=frame[chip][3].data[row,:])
+                except : 
+                    if verbose : print('failed: ',num,row,chip,wave[k])
+            gd=np.where(np.isfinite(allpars[:,1]))[0]
+            wave_found=pix2wave(allpars[gd,1],waves[chip][row,:])
+            for k,pars,wfound in zip(gd,allpars[gd],wave_found) :
+                iline=j[k]
+                if lines['USEWAVE'][iline] == 1 : dpixel.append(pars[1]-pix0[k])
+                if irow > 0 :
+                    linestr['chip'][nline] = ichip+1
+                    linestr['row'][nline] = row
+                    linestr['wave'][nline] = wave[k]
+                    linestr['peak'][nline] = pars[0]
+                    linestr['pixel'][nline] = pars[1]
+                    linestr['dpixel'][nline] = pars[1]-pix0[k]
+                    linestr['wave_found'][nline] = wfound
+                    linestr['frameid'][nline] = num
+                    nline+=1
+                if out is not None :
+                    out.write('{:5d}{:5d}{:12.3f}{:12.3f}{:12.3f}{:12.3f}{:12d}\n'.format(
+                              ichip+1,row,wave[k],pars[0],pars[1],pars[1]-pix0[k],num))
+                elif verbose :
+                    print('{:5d}{:5d}{:12.3f}{:12.3f}{:12.3f}{:12.3f}{:12d}'.format(
+                          ichip+1,row,wave[k],pars[0],pars[1],pars[1]-pix0[k],num))
             if len(dpixel) > 10 : dpixel_median = np.median(np.array(dpixel))
             if verbose: print('median offset: ',row,chip,dpixel_median)
 
@@ -576,6 +587,110 @@ def peakfit(spec,pix0,estsig=5,sigma=None,mask=None,plot=False,func=gaussbin) :
         pdb.set_trace()
     return(pars)
 
+def peakfit_batch(spec,pix0,estsig=5,sigma=None) :
+    """ Return integrated-Gaussian fits near a set of input pixel centers, solved together
+
+    Follows peakfit for each line: the window (width=5*sigma) is re-centered and resized from the
+    fit until it no longer changes, but the windows of all lines are extracted as a 2-D stack and
+    fit simultaneously with a vectorized Levenberg-Marquardt solver
+
+    Args:
+        spec (float) : data spectrum array
+        pix0 (float) : array of initial pixel guesses
+        estsig (float ) : initial guess for window width=5*estsig (default=5)
+        sigma (float)  : uncertainty array (default=None)
+
+    Returns:
+        array [nlines,3] of (amplitude, center, sigma), NaN for lines that could not be fit
+    """
+    npix = len(spec)
+    if sigma is None : sigma = np.ones(npix)
+    pix0 = np.atleast_1d(pix0)
+    out = np.full([len(pix0),3],np.nan)
+    active = np.where(np.isfinite(pix0))[0]
+    cen = np.zeros(len(pix0),dtype=int)
+    cen[active] = np.round(pix0[active]).astype(int)
+    sig = np.full(len(pix0),float(estsig))
+    for iter in range(11) :
+        # window width to search, lines with windows off the start of the array fail as in peakfit
+        xwid = np.maximum(np.round(5*sig[active]).astype(int),3)
+        gd = np.where((cen[active]-xwid >= 0) & (cen[active]-xwid < npix))[0]
+        active,xwid = active[gd],xwid[gd]
+        if len(active) == 0 : break
+        x = cen[active,np.newaxis]-xwid[:,np.newaxis]+np.arange(2*xwid.max()+1)
+        valid = (x <= (cen[active]+xwid)[:,np.newaxis]) & (x < npix)
+        y = np.where(valid,spec[np.clip(x,0,npix-1)],0.)
+        yerr = np.where(valid,sigma[np.clip(x,0,npix-1)],1.)
+        # initial guesses as in peakfit
+        imax = np.where(valid,y,-np.inf).argmax(axis=1)
+        x0 = x[np.arange(len(active)),imax]
+        peak = y[np.arange(len(active)),imax]
+        sig0 = np.sqrt(y.sum(axis=1)**2/peak**2/(2*np.pi))
+        p0 = np.array([peak/sig0/np.sqrt(2*np.pi),x0,sig0]).T
+        pars = _gaussbin_lm(x,y,yerr,valid,p0)
+        gd = np.where(np.isfinite(pars).all(axis=1))[0]
+        out[active] = np.nan
+        out[active[gd]] = pars[gd]
+        # iterate unless new array range is the same
+        active,xwid,pars = active[gd],xwid[gd],pars[gd]
+        done = (np.round(5*pars[:,2]).astype(int) == xwid) & (np.round(pars[:,1]).astype(int) == cen[active])
+        active,pars = active[~done],pars[~done]
+        cen[active] = np.round(pars[:,1]).astype(int)
+        sig[active] = pars[:,2]
+    return out
+
+def _gaussbin_lm(x,y,yerr,valid,p0,maxiter=50,tol=1.49012e-8) :
+    """ Weighted Levenberg-Marquardt fits of gaussbin to a stack of windows x,y,yerr [nlines,nwin],
+        with valid marking the pixels in each window, from initial guesses p0 [nlines,3]
+        Returns fitted parameters [nlines,3], NaN where the fit failed
+    """
+    def model(x,p) :
+        t1 = (x-p[:,1,np.newaxis]-0.5)/np.sqrt(2.)/p[:,2,np.newaxis]
+        t2 = (x-p[:,1,np.newaxis]+0.5)/np.sqrt(2.)/p[:,2,np.newaxis]
+        return p[:,0,np.newaxis]*(erfc(-t2)-erfc(-t1))/2.
+    def jac(x,p) :
+        u1 = (x-p[:,1,np.newaxis]-0.5)/p[:,2,np.newaxis]
+        u2 = (x-p[:,1,np.newaxis]+0.5)/p[:,2,np.newaxis]
+        g1 = np.exp(-0.5*u1**2)/np.sqrt(2*np.pi)
+        g2 = np.exp(-0.5*u2**2)/np.sqrt(2*np.pi)
+        a = p[:,0,np.newaxis]
+        return np.stack([(erfc(-u2/np.sqrt(2.))-erfc(-u1/np.sqrt(2.)))/2.,
+                         a*(g1-g2)/p[:,2,np.newaxis],
+                         a*(g1*u1-g2*u2)/p[:,2,np.newaxis]],axis=-1)
+    with np.errstate(all='ignore') :
+        w = np.where(valid,1./yerr,0.)
+        ok = np.isfinite(p0).all(axis=1) & np.isfinite(w).all(axis=1) & np.isfinite(y).all(axis=1)
+        p = np.array(p0,dtype=float)
+        p[~ok] = np.nan
+        chi2 = np.full(len(p),np.nan)
+        chi2[ok] = (((y[ok]-model(x[ok],p[ok]))*w[ok])**2).sum(axis=1)
+        lam = np.full(len(p),1.e-3)
+        # lines still being fit
+        act = np.where(ok)[0]
+        for iter in range(maxiter) :
+            if len(act) == 0 : break
+            xa,ya,wa,pa = x[act],y[act],w[act],p[act]
+            J = jac(xa,pa)*wa[:,:,np.newaxis]
+            r = (ya-model(xa,pa))*wa
+            A = np.einsum('nmi,nmj->nij',J,J)
+            g = np.einsum('nmi,nm->ni',J,r)
+            Ad = A + lam[act,np.newaxis,np.newaxis]*A*np.eye(3)
+            try : delta = np.linalg.solve(Ad,g[:,:,np.newaxis])[:,:,0]
+            except np.linalg.LinAlgError : 
+                delta = np.array([np.linalg.lstsq(a,b,rcond=None)[0] for a,b in zip(Ad,g)])
+            pn = pa+delta
+            chi2n = (((ya-model(xa,pn))*wa)**2).sum(axis=1)
+            better = (chi2n <= chi2[act]) & np.isfinite(chi2n)
+            # converged when the step no longer changes the parameters or chi2, with the curve_fit tolerances
+            conv = better & ((np.abs(delta) <= tol*np.abs(pn)).all(axis=1) | (chi2[act]-chi2n <= tol*chi2[act]))
+            p[act[better]] = pn[better]
+            chi2[act[better]] = chi2n[better]
+            lam[act] = np.where(better,lam[act]/10.,lam[act]*10.)
+            act = act[~conv & (lam[act] <= 1.e16)]
+        p[act] = np.nan
+        p[~np.isfinite(chi2)] = np.nan
+    return p
+
 def test() :
     """ test routine for peakfity
     """
@@ -590,6 +705,76 @@ def test() :
     pdb.set_trace()
     peakfit(spec,[95,99,102,107])
 
+def fitrow(input) :
+    """ Fit the wavelength solution for a single row, with iterative outlier rejection
+        Used by wavecal for multi-processor calculations
+
+    Args:
+        input (tuple) : (row, x [3,nlines] array of (pixel,chip,group), wavelengths, ngroup,
+                         initial parameters, npoly, reject, test, verbose)
+
+    When run in a multiprocessing pool, failures are printed rather than stopping in pdb
+
+    Returns:
+        popt : final parameters (zeros if the last fit failed, or if a group has no lines)
+        pars : last successful parameters
+        res : residuals of all lines
+        gd : indices of lines used in the final fit
+    """
+    row,x,y,ngroup,pars,npoly,reject,test,verbose = input
+    pars = copy.copy(pars)
+    # only drop into the debugger on failures when run serially
+    inworker = mp.current_process().name != 'MainProcess'
+    # initial residuals
+    res = y-func_multi_poly(x,*pars)
+    # iterate to allow outlier rejection
+    maxiter=7
+    for niter in range(maxiter) :
+        # initialize bounds (to no bounds)
+        bounds = ( np.zeros(len(pars))-np.inf, np.zeros(len(pars))+np.inf)
+        # lock the middle chip position if we have one group, else the central wavelength
+        if ngroup==1 :
+            bounds[0][npoly+1] = -1.e-7
+            bounds[1][npoly+1] = 1.e-7
+        else :
+            bounds[0][npoly-1] = pars[npoly-1]-1.e-7*abs(pars[npoly-1])
+            bounds[1][npoly-1] = pars[npoly-1]+1.e-7*abs(pars[npoly-1])
+            # if we have multiple groups, only fit for chip locations during first iterations and every 3rd thereafter
+            if test or niter<3 or niter%3 == 1 : 
+                for i in range(npoly) : 
+                    bounds[0][i] =  pars[i]-1.e-7*abs(pars[i])
+                    bounds[1][i] =  pars[i]+1.e-7*abs(pars[i])
+
+        # reject lines with bad residuals
+        gd = np.where(abs(res) < np.median(res)+reject*np.median(np.abs(res)))[0]
+
+        # make sure we have lines in all groups
+        for igroup in range(ngroup) : 
+            j=np.where(x[2,gd] == igroup)[0]
+            if len(j) <= 0 :
+              # if any group is missing, things will fail in func_multi_poly to determine correct npoly
+              print('missing lines from group: ', igroup, 'row: ', row)
+              # no debugger in a pool worker (no stdin): skip the row
+              if inworker : return pars*0.,pars,res,gd
+              pdb.set_trace()
+        
+        # use curve_fit to optimize parameters
+        try :
+            if verbose: 
+                print('Niter: ', niter, 'row: ', row, 'ngroup: ', ngroup, 'nlines: ', len(y), 'gd: ', len(gd))
+                print(pars)
+            popt,pcov = curve_fit(func_multi_poly,x[:,gd],y[gd],p0=pars,bounds=bounds)
+            pars = copy.copy(popt)
+            res = y-func_multi_poly(x,*pars)
+            if verbose: 
+                print('res: ',len(gd),np.median(res),np.median(np.abs(res)),res[gd].std())
+                print(pars)
+        except :
+            print('Solution failed for row: ', row)
+            if not inworker : pdb.set_trace()
+            popt = pars*0.
+    return popt,pars,res,gd
+
 def func_multi_poly(x,*pars, **kwargs) :
     """ Convert pixel to wavelength using wavecal parameters
           w = poly(x + offset(group,chip))
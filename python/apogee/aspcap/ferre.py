@@ -12,6 +12,7 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import numpy as np
+import os
 import pdb
 from tools import match
 from apogee.aspcap import aspcap
@@ -19,15 +20,17 @@ import glob
 try: import corner
 except: pass
 
-def writespec(name,data) :
+def writespec(name,data,binary=False) :
     """ Writes FERRE 'spectrum' file with input data, one line per star
+
+    Keyword args:
+        binary : if True, also write binary sidecar file name+'.npy', used by readspec() in preference
+                 to the ASCII file
     """
-    f=open(name,'w')
-    for spec in data :
-        for pix in np.arange(spec.shape[0]) :
-            f.write('{:12.6f}'.format(spec[pix]))
-        f.write('\n')
-    f.close()
+    data=np.atleast_2d(data)
+    np.savetxt(name,data,fmt='%12.6f',delimiter='')
+    # sidecar holds the values as read back from the (rounded) ASCII file, so both give identical data
+    if binary : np.save(name+'.npy',_readascii(name))
     return 
 
 
@@ -143,9 +146,12 @@ def readmcmc(name,libfile,nov=None,burn=500) :
         labels.append(libhead0['LABEL'][ipar-1])
     corner.corner(alldat[:,2:],labels=labels,show_titles=True)
 
-def read(name,libfile) :
+def read(name,libfile,cache=False) :
 
     """ Read all of the FERRE files associated with a FERRE run
+
+        Binary sidecar files of the spectrum files are used if present (see readspec());
+        with cache=True, they are written for any that are missing
     """
     # get library headers and load wavelength array
     libhead0, libhead=rdlibhead(libfile)
@@ -192,55 +198,76 @@ def read(name,libfile) :
     out=np.empty(nobj, dtype=[('obj','S24'),('spm',sform),('obs',form),('err',form),('mdl',form),('chi2',form)])
     out['obj']=ipfobj
     out['spm'][i1,:]=spm[i2,:]
-    out['obs']=readspec(name+'.frd')[i2,:]
-    out['err']=readspec(name+'.err')[i2,:]
-    out['mdl']=readspec(name+'.mdl')[i2,:]
+    out['obs']=readspec(name+'.frd',cache=cache)[i2,:]
+    out['err']=readspec(name+'.err',cache=cache)[i2,:]
+    out['mdl']=readspec(name+'.mdl',cache=cache)[i2,:]
     out['chi2']=(out['obs']-out['mdl'])**2/out['err']**2
 
     return a,out,wave
 
-def readspec(name) :
+def _sidecar(name) :
+    """ Return name of binary sidecar file for FERRE file name if it exists and is not older than name, else None
+    """
+    side=name+'.npy'
+    if not os.path.exists(side) : return None
+    if os.path.exists(name) and os.path.getmtime(side) < os.path.getmtime(name) : return None
+    return side
+
+def readspec(name,cache=False,mmap=True) :
     """ Read a single file with FERRE-format spectra, and return as 2D array [nspec,nwave]
+
+        If a binary sidecar file name+'.npy' (see writespec()) exists and is up to date, it is
+        read instead of the ASCII file
+
+    Keyword args:
+        cache : if True, write binary sidecar after reading ASCII file, for faster subsequent reads
+        mmap : if True, memory-map binary sidecar file rather than reading it
     """
-    f=open(name)
-    data=[]
-    for line in f :
-        spec=np.array(line.split())
-        spec=spec.astype(float)
-        data.append(spec)
-    return np.array(data)
+    side=_sidecar(name)
+    if side is not None :
+        return np.load(side,mmap_mode='r' if mmap else None)
+    data=_readascii(name)
+    if cache and data.dtype != object : np.save(name+'.npy',data)
+    return data
+
+def _readascii(name) :
+    """ Read ASCII FERRE-format spectra file, as 2D array [nspec,nwave] (array of rows if lines have different lengths)
+    """
+    with open(name) as f :
+        tokens=[line.split() for line in f.read().splitlines()]
+    tokens=[tok for tok in tokens if len(tok) > 0]
+    if len(tokens) == 0 : return np.array([])
+    if len(set(map(len,tokens))) == 1 :
+        return np.array(tokens,dtype=float).reshape(len(tokens),-1)
+    # ragged lines
+    return np.array([np.array(tok,dtype=float) for tok in tokens],dtype=object)
 
 def readmask(name) :
     """ Read a single FERRE mask file
     """
-    f=open(name)
-    data=[]
-    for line in f :
-        data.append(float(line))
-    return np.array(data)
+    with open(name) as f :
+        return np.array(f.read().split(),dtype=float)
 
 def writemask(name, mask) :
     '''
     Write a single FERRE ask file
     '''
-    f=open(name,'w')
-    for m in mask:
-        f.write('{:8.3f}\n'.format(m))
-    f.close()
+    np.savetxt(name,np.asarray(mask,dtype=float),fmt='%8.3f')
 
 def readferredata(name) :
     """ Read a single file with FERRE-format data, and return as 2D array [nspec,nwave]
     """
-    f=open(name)
-    alldata=[]
-    allobj=[]
-    for line in f :
-        a=line.split()
-        obj=np.array(a[0])
-        data=np.array(a[1:len(a)]).astype(float)
-        alldata.append(data)
-        allobj.append(obj)
-    return np.array(allobj),np.array(alldata)
+    with open(name) as f :
+        lines=[line.split() for line in f.read().splitlines()]
+    lines=[line for line in lines if len(line) > 0]
+    ncol=set(len(line) for line in lines)
+    if len(ncol) == 1 :
+        tokens=np.array(lines)
+        return tokens[:,0],tokens[:,1:].astype(float)
+    # ragged lines
+    allobj=np.array([line[0] for line in lines])
+    alldata=np.array([np.array(line[1:],dtype=float) for line in lines])
+    return allobj,alldata
 
 
 def rdsinglehead(f) :
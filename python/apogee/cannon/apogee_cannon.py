@@ -50,9 +50,10 @@ from sdss import yanny
 
 PICKLE_PROTOCOL = -1
 
-def norm(planfile,threads=8,inter=False,sim=False) :
+def norm(planfile,threads=8,inter=False,sim=False,pickles=False) :
     '''
-    Do Cannon normalization of files
+    Do Cannon normalization of files, written to a columnar store (see NormStore) in each field directory
+    If pickles, also write the individual star pickle files
     '''
     print('planfile: ', planfile)
     print('threads: ', threads)
@@ -116,10 +117,21 @@ def norm(planfile,threads=8,inter=False,sim=False) :
             .format(threads, N_individual_visits))
 
         pool = mp.Pool(threads)
-        normalized_result = \
-            pool.map_async(_process_normalization, aspcappaths).get()
+        if pickles :
+            aspcappaths = [path+(True,) for path in aspcappaths]
+        normalized_result = []
+        # write normalized spectra into per-field columnar store as they are returned, in order
+        outdir = os.path.dirname(paths[0][2])
+        store = None
+        for i,(result, input_path, output_path, metadata, stacked) in \
+            enumerate(pool.imap(_process_normalization, aspcappaths, chunksize=8)) :
+            normalized_result.append((result, input_path, output_path))
+            if result is True :
+                if store is None : store = NormStore(outdir,N=len(aspcappaths),P=stacked.shape[1],ids=[path[0] for path in paths])
+                store.set(i,paths[i][0],metadata,stacked)
         pool.close()
         pool.join()
+        if store is not None : store.close()
 
         # If there were input spectra that failed, then show a summary.
         _failed = []
@@ -165,18 +177,21 @@ def _process_normalization(path):
     Produce pseudo-continuum-normalized data products for APOGEE DR14 apStar
     spectra.
 
-    :param input_path:
-        The local path of an apStar spectrum.
+    :param path:
+        A tuple of (APOGEE_ID, the local path of an apStar spectrum, output
+        path), and optionally whether to write the output pickle files.
 
     :returns:
-        A three-length tuple indicating: (1) whether the normalization was
-        successful, (2) the `input_path`, and (3) the `output_path` if the
-        normalization was successful. If `None` is provided in (1), it is 
+        A five-length tuple indicating: (1) whether the normalization was
+        successful, (2) the `input_path`, (3) the `output_path` if the
+        normalization was successful, (4) the metadata, and (5) the stacked
+        [flux,ivar] spectrum. If `None` is provided in (1), it is 
         because the output file already exists and we were not instructed 
         to clobber it.
     """
 
-    apogee_id, input_path,output_path = path
+    apogee_id, input_path,output_path = path[0:3]
+    pickles = path[3] if len(path) > 3 else False
 
     print(input_path, output_path)
     #normalization set up
@@ -197,26 +212,27 @@ def _process_normalization(path):
     except:
         #logger.exception("Normalization failed on {}".format(input_path))
         print("Normalization failed on {}".format(input_path))
-        return (False, input_path, None)
+        return (False, input_path, None, None, None)
 
     metadata.update(APOGEE_ID=apogee_id)
 
     stacked = np.vstack(stacked)
     visits = np.vstack(visits)
      
-    with open(output_path, "wb") as fp:
-        pickle.dump((metadata,stacked), fp, PICKLE_PROTOCOL)
+    if pickles :
+        with open(output_path, "wb") as fp:
+            pickle.dump((metadata,stacked), fp, PICKLE_PROTOCOL)
 
-    with open("{}.visits".format(output_path), "wb") as fp:
-        pickle.dump(visits, fp, PICKLE_PROTOCOL)
+        with open("{}.visits".format(output_path), "wb") as fp:
+            pickle.dump(visits, fp, PICKLE_PROTOCOL)
 
-    with open("{}.meta".format(output_path), "wb") as fp:
-        pickle.dump(metadata, fp, PICKLE_PROTOCOL)
+        with open("{}.meta".format(output_path), "wb") as fp:
+            pickle.dump(metadata, fp, PICKLE_PROTOCOL)
 
     #logger.info("Normalized spectra in {} successfully".format(input_path))
     print("Normalized spectra in {} successfully".format(input_path))
 
-    return (True, input_path, output_path)
+    return (True, input_path, output_path, metadata, stacked)
 
 def getrange(val):
     '''
@@ -342,36 +358,32 @@ def train(planfile,skip=1,threads=8,xh=None,model_name=None,censor=None,sim=Fals
     logger.addHandler(handler)
 
     sdss_path=path.Path()
-    ngd = 0
+    filenames = []
+    ids = []
     for i, row in enumerate(labelled_set):
-
-        logger.info(
-            "Reading labelled set spectra ({}/{})".format(i + 1, N_labelled))
         if row['TELESCOPE'] == 'apo1m' :
             filename = sdss_path.full('cannonStar-1m',apred=apred,apstar=apstar,aspcap=aspcap_vers,results=results,cannon=cannon,
                    field=row['FIELD'],reduction=row['REDUCTION_ID'],telescope=row['TELESCOPE'])
+            ids.append(row['REDUCTION_ID'])
         else :
             filename = sdss_path.full('cannonStar',apred=apred,apstar=apstar,aspcap=aspcap_vers,results=results,cannon=cannon,
                    field=row['FIELD'],obj=row['APOGEE_ID'],telescope=row['TELESCOPE'])
-
-        if not os.path.exists(filename):
-            logger.warn("Could not find filename for labelled set star {}: {}"\
-                .format(row["APOGEE_ID"], filename))
-            continue
-
-        with open(filename, "rb") as fp:
-            #flux, ivar = pickle.load(fp)
-            metadata, data = pickle.load(fp)
-            flux,ivar = data
-
-        if (np.isfinite(flux).all()) & (np.isfinite(ivar).all()) :
-            normalized_flux[i, :] = flux
-            normalized_ivar[i, :] = ivar
+            ids.append(row['APOGEE_ID'])
+        filenames.append(filename)
+
+    logger.info("Reading labelled set spectra ({})".format(N_labelled))
+    metadatas, flux, ivar, ok = loadnorm(filenames,ids=ids,P=P)
+    for i in np.where(~ok)[0] :
+        logger.warn("Could not find spectrum for labelled set star {}: {}"\
+            .format(labelled_set[i]["APOGEE_ID"], filenames[i]))
+    for i in np.where(ok)[0] :
+        if (np.isfinite(flux[i]).all()) & (np.isfinite(ivar[i]).all()) :
+            normalized_flux[i, :] = flux[i]
+            normalized_ivar[i, :] = ivar[i]
         else :
-            print('non-finite values in',row['APOGEE_ID'])
+            print('non-finite values in',labelled_set[i]['APOGEE_ID'])
             normalized_flux[i, :] = 0.
             normalized_ivar[i, :] = 0.
-            #pdb.set_trace()
 
     # TODO: Cache the normalized_flux and normalized_ivar into a single file so that
     #       it is faster to read in next time?
@@ -534,18 +546,13 @@ def fit(planfile, model_name=None, spectrum_filenames=None, threads=8, clobber=T
 
     logger = logging.getLogger("AnniesLasso")
 
-    # get allStar file for initial labels
+    # get allStar file for initial labels, and index for lookup by ID
     apl=apload.ApLoad(apred=apred,apstar=apstar,aspcap=aspcap,results=results)
     allstar=apl.allStar()[1].data
+    index=allstarindex(allstar)
 
     # loop over fields in planfile
     for field in p['ASPCAP']['field'] :
-        metadatas = []
-        fluxes = []
-        ivars = []
-        output_filenames = []
-        apogee_names = []
-        failures = 0
 
         # get file names to fit 
         try:
@@ -553,120 +560,80 @@ def fit(planfile, model_name=None, spectrum_filenames=None, threads=8, clobber=T
         except:
             return
         
-        spectrum_filenames = []
-        initial_labels = []
-        apogee_ids = []
-        for apogee_id,inpath,outpath in paths :
-            # only take stars within certain parameter ranges
-            print(apogee_id)
-            #j=apselect.select(allstar,redid=apogee_id)[0]
-            j=np.where(((allstar['REDUCTION_ID'] == apogee_id) | (allstar['APOGEE_ID'] == apogee_id) ) & (allstar['COMMISS'] == 0) )[0]
-            if (len(j) == 0) : 
-                print('missing target',apogee_id)
-            else:
-                if len(j)>1 : j=j[0]
-                if ((allstar['FPARAM'][j,1] >= logg[0]) & (allstar['FPARAM'][j,1] <= logg[1]) &
-                    (allstar['FPARAM'][j,0] >= teff[0]) & (allstar['FPARAM'][j,0] <= teff[1]) &
-                    (allstar['FPARAM'][j,3] >= mh[0]) & (allstar['FPARAM'][j,3] <= mh[1]) &
-                    (allstar['FPARAM'][j,6] >= alpha[0]) & (allstar['FPARAM'][j,6] <= alpha[1]) ) :
-                    spectrum_filenames.append(outpath)
-                    apogee_names.append(apogee_id)
-                    #labels=[]
-                    #for i,label in enumerate(label_names) :
-                    #    if allstar[label][j][0] > -9 :
-                    #        labels.append(allstar[label][j][0])
-                    #    else :
-                    #        labels.append(mean_labels[i])
-                    #initial_labels.append(labels)
+        # match all stars to allStar at once, and only take stars within certain parameter ranges
+        j=allstarlookup(index,[path[0] for path in paths])
+        for i in np.where(j < 0)[0] : print('missing target',paths[i][0])
+        fparam=allstar['FPARAM'][np.maximum(j,0)]
+        gd=np.where((j >= 0) & 
+                    (fparam[:,1] >= logg[0]) & (fparam[:,1] <= logg[1]) &
+                    (fparam[:,0] >= teff[0]) & (fparam[:,0] <= teff[1]) &
+                    (fparam[:,3] >= mh[0]) & (fparam[:,3] <= mh[1]) &
+                    (fparam[:,6] >= alpha[0]) & (fparam[:,6] <= alpha[1]) )[0]
+        apogee_names = [paths[i][0] for i in gd]
+        spectrum_filenames = [paths[i][2] for i in gd]
 
         if len(apogee_names) == 0 : return
 
-        #initial_labels=np.array(initial_labels)
         initial_labels = mean_labels
         # MAGIC HACK
         delete_meta_keys = ("fjac", ) # To save space...
 
-        #output_suffix = kwargs.get("output_suffix", None)
-        #output_suffix = "result" if output_suffix is None else str(output_suffix)
         summary_file =  root+field+'/cannonField-'+os.path.basename(field)+'-'+output_suffix+'.fits'
         N = len(spectrum_filenames)
-        for i, names in enumerate(zip(apogee_names,spectrum_filenames)):
-            apogee_id = names[0]
-            filename = names[1]
-            logger.info("At spectrum {0}/{1}: {2}".format(i + 1, N, filename))
-
+        input_filenames = []
+        output_filenames = []
+        apogee_ids = []
+        for apogee_id,filename in zip(apogee_names,spectrum_filenames) :
             basename, _ = os.path.splitext(filename)
             output_filename = "-".join([basename, output_suffix]) + ".pkl"
-        
             if os.path.exists(output_filename) and not clobber:
                 logger.info("Output filename {} already exists and not clobbering."\
                     .format(output_filename))
                 continue
-
-            try:
-                with open(filename, "rb") as fp:
-                    metadata, data = pickle.load(fp)
-                    metadatas.append(metadata)
-                    flux,ivar = data
-                    fluxes.append(flux)
-                    ivars.append(ivar)
-
-                output_filenames.append(output_filename)
-                apogee_ids.append(apogee_id)
-
-            except:
-                logger.exception("Error occurred loading {}".format(filename))
-                failures += 1
-
-            else:
-                if len(output_filenames) >= chunk_size:
-                
-                    results, covs, metas = model.fit(fluxes, ivars,
-                        initial_labels=initial_labels, model_redshift=fit_velocity,
-                        full_output=True)
-
-                    for result, cov, meta, output_filename \
-                    in zip(results, covs, metas, output_filenames):
-
-                        for key in delete_meta_keys:
-                            if key in meta:
-                                del meta[key]
-
-                        with open(output_filename, "wb") as fp:
-                            pickle.dump((result, cov, meta), fp, 2) # For legacy.
-                        logger.info("Saved output to {}".format(output_filename))
-                
-                    del output_filenames[0:], fluxes[0:], ivars[0:]
-
-
-        if len(output_filenames) > 0:
-
-            results, covs, metas = model.fit(fluxes, ivars, 
+            input_filenames.append(filename)
+            output_filenames.append(output_filename)
+            apogee_ids.append(apogee_id)
+
+        # read all of the normalized spectra into preallocated arrays
+        metadatas, fluxes, ivars, ok = loadnorm(input_filenames,ids=apogee_ids,logger=logger)
+        failures = len(ok)-ok.sum()
+        ok = np.where(ok)[0]
+        metadatas = [metadatas[i] for i in ok]
+        fluxes = fluxes[ok]
+        ivars = ivars[ok]
+        output_filenames = [output_filenames[i] for i in ok]
+        apogee_ids = [apogee_ids[i] for i in ok]
+
+        # Create an ordered dictionary of lists for all the data.
+        data_dict = OrderedDict([("FILENAME", [])])
+        data_dict['APOGEE_ID'] = []
+        data_dict['LOCATION_ID'] = []
+        data_dict['FIELD'] = []
+        for label_name in label_names:
+            data_dict[label_name] = []
+        for label_name in label_names:
+            data_dict["{}_RAWERR".format(label_name)] = []
+        for label_name in label_names:
+            data_dict["{}_ERR".format(label_name)] = []
+        #data_dict["COV"] = []
+        #meta_keys=metas[0].keys()
+        meta_keys=['chi_sq','r_chi_sq','model_flux']
+        for key in meta_keys:
+            data_dict[key] = []
+        data_dict['flux'] = []
+        data_dict['ivar'] = []
+
+        # fit in chunks of chunk_size spectra
+        for i1 in range(0,len(output_filenames),chunk_size) :
+            i2 = min(i1+chunk_size,len(output_filenames))
+
+            results, covs, metas = model.fit(fluxes[i1:i2], ivars[i1:i2], 
                 initial_labels=initial_labels, model_redshift=fit_velocity,
                 full_output=True)
 
-            # Create an ordered dictionary of lists for all the data.
-            data_dict = OrderedDict([("FILENAME", [])])
-            data_dict['APOGEE_ID'] = []
-            data_dict['LOCATION_ID'] = []
-            data_dict['FIELD'] = []
-            for label_name in label_names:
-                data_dict[label_name] = []
-            for label_name in label_names:
-                data_dict["{}_RAWERR".format(label_name)] = []
-            for label_name in label_names:
-                data_dict["{}_ERR".format(label_name)] = []
-            #data_dict["COV"] = []
-            #meta_keys=metas[0].keys()
-            meta_keys=['chi_sq','r_chi_sq','model_flux']
-            for key in meta_keys:
-                data_dict[key] = []
-            data_dict['flux'] = []
-            data_dict['ivar'] = []
-
             # loop over spectra, output individual files, and accumulate for summary file
             for result, cov, meta, output_filename,apogee_id,metadata,flux,ivar \
-            in zip(results, covs, metas, output_filenames, apogee_ids,metadatas,fluxes,ivars):
+            in zip(results, covs, metas, output_filenames[i1:i2], apogee_ids[i1:i2],metadatas[i1:i2],fluxes[i1:i2],ivars[i1:i2]):
 
               if np.isfinite(result).all() :
                 outlist=[os.path.basename(output_filename),apogee_id,metadata['LOCATION_ID'],metadata['FIELD']]+result.tolist()
@@ -713,8 +680,6 @@ def fit(planfile, model_name=None, spectrum_filenames=None, threads=8, clobber=T
                 hdulist.append(fits.ImageHDU(1./np.sqrt(ivar),header=hdr))
                 hdulist.append(fits.ImageHDU(meta.get('model_flux'),header=hdr))
                 hdulist.writeto(output_filename.replace('-result','').replace('.pkl','.fits'),overwrite=True)
-        
-            del output_filenames[0:], fluxes[0:], ivars[0:]
 
 
         logger.info("Number of failures: {}".format(failures))
@@ -726,6 +691,147 @@ def fit(planfile, model_name=None, spectrum_filenames=None, threads=8, clobber=T
 
     return None
 
+def allstarindex(allstar) :
+    '''
+    Return sorted IDs and corresponding allStar rows, for lookup by REDUCTION_ID or APOGEE_ID
+    (first non-commissioning row that matches either)
+    '''
+    ok=np.where(allstar['COMMISS'] == 0)[0]
+    keys=np.char.strip(np.append(np.array(allstar['REDUCTION_ID'][ok]),np.array(allstar['APOGEE_ID'][ok])).astype(str))
+    rows=np.append(ok,ok)
+    # sort by ID, then row, and keep the first row for each ID
+    order=np.lexsort((rows,keys))
+    keys=keys[order]
+    rows=rows[order]
+    first=np.append(True,keys[1:] != keys[:-1])
+    return keys[first],rows[first]
+
+def allstarlookup(index,ids) :
+    '''
+    Return allStar row for each input ID, given index from allstarindex, -1 if not found
+    '''
+    keys,rows=index
+    ids=np.char.strip(np.array(ids).astype(str))
+    if len(keys) == 0 : return np.zeros(len(ids),dtype=int)-1
+    i=np.clip(np.searchsorted(keys,ids),0,len(keys)-1)
+    return np.where(keys[i] == ids,rows[i],-1)
+
+class NormStore(object) :
+    '''
+    Columnar store of normalized spectra for a field, in the field directory:
+        cannonNorm-flux.npy, cannonNorm-ivar.npy : memory-mapped [N,P] arrays
+        cannonNorm.fits : table of APOGEE_ID, LOCATION_ID, FIELD, NVISIT, SNR, OK for each row
+    Written with NormStore(outdir,N,P,ids=), set(), close(); read with NormStore(outdir)
+    String columns are sized from ids, and widened by set() if a longer value is given
+    '''
+    def __init__(self,outdir,N=None,P=None,ids=None) :
+        self.root = os.path.join(outdir,'cannonNorm')
+        if N is None :
+            self.meta = Table.read(self.root+'.fits')
+            self.flux = np.load(self.root+'-flux.npy',mmap_mode='r')
+            self.ivar = np.load(self.root+'-ivar.npy',mmap_mode='r')
+            self.index = dict([(str(name).strip(),i) for i,name in enumerate(self.meta['APOGEE_ID'])])
+        else :
+            # failed rows have flux=1, ivar=0, OK=False
+            self.flux = np.lib.format.open_memmap(self.root+'-flux.npy.tmp',mode='w+',dtype=np.float64,shape=(N,P))
+            self.ivar = np.lib.format.open_memmap(self.root+'-ivar.npy.tmp',mode='w+',dtype=np.float64,shape=(N,P))
+            self.flux[:] = 1.
+            self.meta = Table()
+            width = 18 if ids is None or len(ids) == 0 else max([18]+[len(apogee_id) for apogee_id in ids])
+            self.meta['APOGEE_ID'] = np.zeros(N,dtype='S{:d}'.format(width))
+            self.meta['LOCATION_ID'] = np.zeros(N,dtype=int)
+            self.meta['FIELD'] = np.zeros(N,dtype='S32')
+            self.meta['NVISIT'] = np.zeros(N,dtype=int)
+            self.meta['SNR'] = np.zeros(N)
+            self.meta['OK'] = np.zeros(N,dtype=bool)
+
+    @staticmethod
+    def exists(outdir) :
+        return os.path.exists(os.path.join(outdir,'cannonNorm.fits'))
+
+    def set(self,i,apogee_id,metadata,stacked) :
+        ''' set row i from metadata and stacked [flux,ivar] '''
+        self.flux[i] = stacked[0]
+        self.ivar[i] = stacked[1]
+        self._setstr('APOGEE_ID',i,apogee_id)
+        self.meta['LOCATION_ID'][i] = metadata['LOCATION_ID']
+        self._setstr('FIELD',i,metadata['FIELD'])
+        self.meta['NVISIT'][i] = len(metadata['SNR'])
+        self.meta['SNR'][i] = metadata['SNR'][0] if len(metadata['SNR']) > 0 else 0.
+        self.meta['OK'][i] = True
+
+    def _setstr(self,name,i,value) :
+        ''' set string column name in row i, widening the column first if value does not fit '''
+        if len(value) > self.meta[name].dtype.itemsize :
+            self.meta.replace_column(name,self.meta[name].astype('S{:d}'.format(len(value))))
+        self.meta[name][i] = value
+
+    def close(self) :
+        ''' flush arrays and write metadata table, replacing any existing store '''
+        self.flux.flush()
+        self.ivar.flush()
+        del self.flux, self.ivar
+        os.rename(self.root+'-flux.npy.tmp',self.root+'-flux.npy')
+        os.rename(self.root+'-ivar.npy.tmp',self.root+'-ivar.npy')
+        self.meta.write(self.root+'.fits',overwrite=True)
+
+    def rows(self,ids) :
+        ''' return row for each APOGEE_ID, -1 if not present or normalization failed '''
+        rows = np.array([self.index.get(str(apogee_id).strip(),-1) for apogee_id in ids],dtype=int)
+        rows[rows >= 0] = np.where(self.meta['OK'][rows[rows >= 0]],rows[rows >= 0],-1)
+        return rows
+
+    def metadata(self,i) :
+        ''' metadata dictionary for row i '''
+        return {'APOGEE_ID' : self.meta['APOGEE_ID'][i], 'LOCATION_ID' : self.meta['LOCATION_ID'][i],
+                'FIELD' : self.meta['FIELD'][i], 'SNR' : [self.meta['SNR'][i]]}
+
+def loadnorm(filenames,ids=None,logger=None,P=8575) :
+    '''
+    Read normalized spectra into preallocated arrays, from the field NormStore if there is one
+    (and ids are given), otherwise from the individual cannonStar pickle files
+
+    Returns:
+        metadatas (list), flux [N,P] (1 if missing), ivar [N,P] (0 if missing), ok (boolean [N], spectrum read successfully)
+    '''
+    metadatas=[None]*len(filenames)
+    fluxes=np.ones((len(filenames),P))
+    ivars=np.zeros((len(filenames),P))
+    ok=np.zeros(len(filenames),dtype=bool)
+    dirs=np.array([os.path.dirname(filename) for filename in filenames])
+    for outdir in np.unique(dirs) :
+        j=np.where(dirs == outdir)[0]
+        if ids is not None and NormStore.exists(outdir) :
+            # slice from the store, contiguous if all stars in field are requested
+            store=NormStore(outdir)
+            rows=store.rows([ids[i] for i in j])
+            gd=np.where(rows >= 0)[0]
+            if len(gd) == len(store.meta) and (rows[gd] == np.arange(len(gd))).all() :
+                fluxes[j[gd]]=store.flux[:]
+                ivars[j[gd]]=store.ivar[:]
+            elif len(gd) > 0 :
+                fluxes[j[gd]]=store.flux[rows[gd]]
+                ivars[j[gd]]=store.ivar[rows[gd]]
+            for i,row in zip(j[gd],rows[gd]) : metadatas[i]=store.metadata(row)
+            ok[j[gd]]=True
+            if logger is not None : logger.info("Read {0}/{1} spectra from {2}".format(len(gd),len(j),store.root))
+            del store
+            continue
+        for i in j :
+            filename=filenames[i]
+            if logger is not None : logger.info("At spectrum {0}/{1}: {2}".format(i + 1, len(filenames), filename))
+            try:
+                with open(filename, "rb") as fp:
+                    metadata, data = pickle.load(fp)
+                flux,ivar = data
+                fluxes[i] = flux
+                ivars[i] = ivar
+                metadatas[i] = metadata
+                ok[i] = True
+            except:
+                if logger is not None : logger.exception("Error occurred loading {}".format(filename))
+    return metadatas,fluxes,ivars,ok
+
 def getfiles(apred,apstar,aspcap,results,cannon,field,aspcapStar=False) :
 
     # construct list of apStar files to normalize and corresponding output files
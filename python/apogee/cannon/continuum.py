@@ -53,7 +53,8 @@ def fit_sines_and_cosines(dispersion, flux, ivar, continuum_pixels,
 
     :param flux:
         The flux values for all pixels, as they correspond to the `dispersion`
-        array.
+        array. This can be a 2-D array of many spectra, which are all fit at
+        once.
 
     :param ivar:
         The inverse variances for all pixels, as they correspond to the
@@ -117,43 +118,42 @@ def fit_sines_and_cosines(dispersion, flux, ivar, continuum_pixels,
 
         # TODO: ISSUE: Check for overlapping regions and raise an warning.
 
-    metadata = []
+    # Solve the normal equations for all objects at once in each region.
+    N = flux.shape[0]
     continuum = np.ones_like(flux) * fill_value
-    for i in range(flux.shape[0]):
-
-        # Get the flux and inverse variance for this object.
-        object_metadata = []
-        object_flux, object_ivar = (flux[i], ivar[i])
-
-        # Normalize each region.
-        for region_mask, region_matrix, continuum_mask, continuum_matrix in \
-        zip(region_masks, region_matrices, continuum_masks, continuum_matrices):
-            if continuum_mask.size == 0:
-                # Skipping..
-                object_metadata.append([order, L, fill_value, scalar, [], None])
-                continue
-
-            # We will fit to continuum pixels only.   
-            continuum_disp = dispersion[continuum_mask] 
-            continuum_flux, continuum_ivar \
-                = (object_flux[continuum_mask], object_ivar[continuum_mask])
-
-            # Solve for the amplitudes.
-            M = continuum_matrix
-            MTM = np.dot(M, continuum_ivar[:, None] * M.T)
-            MTy = np.dot(M, (continuum_ivar * continuum_flux).T)
-
-            eigenvalues = np.linalg.eigvalsh(MTM)
-            MTM[np.diag_indices(len(MTM))] += scalar * np.max(eigenvalues)
-            eigenvalues = np.linalg.eigvalsh(MTM)
-            condition_number = max(eigenvalues)/min(eigenvalues)
-
-            amplitudes = np.linalg.solve(MTM, MTy)
-            continuum[i, region_mask] = np.dot(region_matrix.T, amplitudes)
-            object_metadata.append(
-                (order, L, fill_value, scalar, amplitudes, condition_number))
-
-        metadata.append(object_metadata)
+    region_metadata = []
+    for region_mask, region_matrix, continuum_mask, continuum_matrix in \
+    zip(region_masks, region_matrices, continuum_masks, continuum_matrices):
+        if continuum_mask.size == 0:
+            # Skipping..
+            region_metadata.append([[order, L, fill_value, scalar, [], None]] * N)
+            continue
+
+        # We will fit to continuum pixels only.   
+        continuum_flux, continuum_ivar \
+            = (flux[:, continuum_mask], ivar[:, continuum_mask])
+
+        # Solve for the amplitudes.
+        M = continuum_matrix
+        MTM = np.einsum("ip,np,jp->nij", M, continuum_ivar, M)
+        MTy = np.einsum("ip,np->ni", M, continuum_ivar * continuum_flux)
+
+        # Regularize; the eigenvalues of the regularized matrices are just 
+        # shifted, so we only need to calculate them once.
+        eigenvalues = np.linalg.eigvalsh(MTM)
+        regularization = scalar * np.max(eigenvalues, axis=1)
+        MTM[:, np.arange(M.shape[0]), np.arange(M.shape[0])] += regularization[:, None]
+        eigenvalues = eigenvalues + regularization[:, None]
+        condition_numbers = np.max(eigenvalues, axis=1)/np.min(eigenvalues, axis=1)
+
+        amplitudes = np.linalg.solve(MTM, MTy[:, :, None])[:, :, 0]
+        continuum[:, region_mask] = np.dot(amplitudes, region_matrix)
+        region_metadata.append([
+            (order, L, fill_value, scalar, amplitudes[i], condition_numbers[i]) \
+            for i in range(N)])
+
+    # Per-object metadata for each region.
+    metadata = [[region[i] for region in region_metadata] for i in range(N)]
 
     return (continuum, metadata) if full_output else continuum
 
@@ -163,25 +163,27 @@ def normalize_individual_visit(dispersion, apStar_flux, apStar_ivar,
     normalized_ivar_floor=IVAR_FLOOR, **kwargs): # MAGIC
     """
     Stack an invividual visit from an apStar file, while properly accounting for
-    the inverse variances.
+    the inverse variances. Many visits can be normalized at once by giving
+    2-D flux, ivar, and bitmask arrays.
 
     RTFD.
 
     Note: Revise ivar floor in 2027.
     """
 
-    assert dispersion.size == apStar_flux.size
-    assert apStar_flux.ndim == 1
+    assert dispersion.size == apStar_flux.shape[-1]
+    assert apStar_flux.ndim in (1, 2)
     assert apStar_flux.shape == apStar_ivar.shape
 
 
     # Re-weight bad pixels based on their distance to the median.
     bad = apStar_bitmask > 0
-    median_flux = np.median(apStar_flux)
+    median_flux = np.median(apStar_flux, axis=-1)[..., None] \
+        * np.ones_like(apStar_flux)
 
     deltas = np.max(np.array([
-            conservatism[0] * np.abs(apStar_flux[bad] - median_flux),
-            conservatism[1] * median_flux * np.ones(bad.sum())
+            conservatism[0] * np.abs(apStar_flux[bad] - median_flux[bad]),
+            conservatism[1] * median_flux[bad]
         ]), axis=0)
     adjusted_ivar = apStar_ivar
     adjusted_ivar[bad] = apStar_ivar[bad] / (1. + deltas**2 * apStar_ivar[bad])
@@ -195,8 +197,8 @@ def normalize_individual_visit(dispersion, apStar_flux, apStar_ivar,
     continuum = fit_sines_and_cosines(dispersion, apStar_flux, adjusted_ivar,
         continuum_pixels, **kwds)
 
-    # Flatten the continuum since continuum.fit can take many spectra at once.
-    continuum = continuum.flatten()
+    # Reshape the continuum since continuum.fit always returns 2-D output.
+    continuum = continuum.reshape(apStar_flux.shape)
     normalized_flux = apStar_flux / continuum
     # We do continuum * adj_ivar * continuum instead of continuum**2 to account
     # for the super high S/N spectra, where continuum**2 --> inf.
@@ -245,23 +247,17 @@ def normalize_individual_visits(filename, continuum_pixels,
     dispersion = 10**(image[1].header["CRVAL1"] + \
         np.arange(flux_array.shape[1]) * image[1].header["CDELT1"])
 
-    # Normalize the individual visit spectra.
-    normalized_visit_flux = np.zeros((N_visits, dispersion.size))
-    normalized_visit_ivar = np.zeros((N_visits, dispersion.size))
+    # Normalize the individual visit spectra, all at once.
+    # The first two indices contain stacked spectra with incorrect weights.
+    flux = flux_array[offset:offset + N_visits]
+    ivar = 1.0/(error_array[offset:offset + N_visits])**2
+    bitmask = bitmask_array[offset:offset + N_visits]
+
+    normalized_visit_flux, normalized_visit_ivar = normalize_individual_visit(
+        dispersion, flux, ivar, bitmask, continuum_pixels, **kwargs)
 
     metadata = {"SNR": [], "LOCATION_ID": image[0].header['LOCID'], "FIELD": image[0].header['FIELD']}
     for i in range(N_visits):
-
-        # The first two indices contain stacked spectra with incorrect weights.
-        flux = flux_array[offset + i]
-        ivar = 1.0/(error_array[offset + i])**2
-        bitmask = bitmask_array[offset + i]
-
-        normed_flux, normed_ivar = normalize_individual_visit(dispersion,
-            flux, ivar, bitmask, continuum_pixels, **kwargs)
-
-        normalized_visit_flux[i, :] = normed_flux
-        normalized_visit_ivar[i, :] = normed_ivar
         if aspcapStar: 
             metadata["SNR"].append(image[0].header["SNR"])
         else :
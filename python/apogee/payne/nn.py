@@ -8,10 +8,13 @@ from keras import models
 from keras import layers
 from keras import optimizers
 from keras import regularizers
+from keras import callbacks
 from astropy.io import fits
 from astropy.table import Table, TableColumns, Column
 import pickle
 import copy
+import functools
+import os
 import sys
 import pdb
 import time
@@ -32,8 +35,15 @@ nodes=20
 nepochs=50000
 
 def train(file,plot=False,pixels=[1000,9000,1000],suffix='',fitfrac=1.0, order=0, threads=32,payne=False,
-          teff=[0,10000],logg=[-1,6],mh=[-3,1],am=[-1,1],cm=[-2,2],nm=[-2,2],raw=False,rot=False,nolog=True,elem=False) :
+          teff=[0,10000],logg=[-1,6],mh=[-3,1],am=[-1,1],cm=[-2,2],nm=[-2,2],raw=False,rot=False,nolog=True,elem=False,
+          block=None,hidden=300,patience=1000) :
     """ Train a neural net model on an input training set
+
+        By default, a separate network is trained for each pixel, in parallel, and the model saved
+        to a pickle file. With block=, pixels are instead trained jointly, in blocks of block pixels
+        (block=0 for a single network for all pixels) that share a hidden layer of hidden nodes, with
+        early stopping (patience epochs) and checkpointing of each block so that an interrupted run
+        resumes where it left off; the model is saved to a compact NPZ file readable by get()
     """
     global nfit, verbose, nepochs
 
@@ -149,6 +159,36 @@ def train(file,plot=False,pixels=[1000,9000,1000],suffix='',fitfrac=1.0, order=0
         means.append(mn)
         stds.append(std)
 
+    if block is not None :
+        # joint training of blocks of pixels, each as a single multi-output network
+        fitpix = np.array([ipix for i,ipix in enumerate(pixels) if np.isfinite(means[i])])
+        if block <= 0 : block = len(fitpix)
+        w0,b0,w1,b1,grp = [],[],[],[],[]
+        for iblock,i0 in enumerate(range(0,len(fitpix),block)) :
+            showtime('fitting block {:d}, pixels {:d}-{:d}'.format(iblock,fitpix[i0],fitpix[min(i0+block,len(fitpix))-1]))
+            w,b=fitjoint((normpars,spec[:,fitpix[i0:i0+block]],file+suffix+'_block{:03d}'.format(iblock),fitpix[i0:i0+block]),
+                         hidden=hidden,patience=patience)
+            w0.append(w[0])
+            b0.append(b[0])
+            w1.extend(w[1].T)
+            b1.extend(b[1])
+            grp.extend([iblock]*w[1].shape[1])
+        head['nodes'] = hidden
+        head['reg'] = reg
+        head['batch_size'] = batch_size
+        head['nepochs'] = nepochs
+        head['pmeans'] = pmeans
+        head['pstds'] = pstds
+        head['means'] = means
+        head['stds'] = stds
+        head['w0'] = np.array(w0)
+        head['b0'] = np.array(b0)
+        head['w1'] = np.array(w1)
+        head['b1'] = np.array(b1)
+        head['grp'] = np.array(grp)
+        Model(head).write(file+suffix)
+        return head
+
     # get the model in parallel for different pixels
     print('fitting: ',len(data))
     pool = mp.Pool(threads)
@@ -253,6 +293,73 @@ def fit(data) :
     except :
         return w,b,mod,history.history['loss'],0.
 
+def _ckmatch(file,key) :
+    """ Return True if checkpoint file exists and was written for the same key (dict of arrays/values)
+    """
+    if not os.path.exists(file) : return False
+    try : out=np.load(file)
+    except : return False
+    for name,val in key.items() :
+        if name not in out.files or not np.array_equal(out[name],val) : return False
+    return True
+
+def fitjoint(data,hidden=300,patience=1000) :
+    """ Routine to do a multi-output NN model fit for a block of pixels given input data=(pars,pixels,checkpoint,pixind),
+        where pixels is (nspec,npix), and pixind the indices of those pixels. A completed block is saved to checkpoint.npz,
+        and reused if present; network weights are saved to checkpoint.weights.h5 during the fit, and used to resume an
+        interrupted fit. Checkpoints are only used if they were written for the same pixels, hidden layer size, and
+        training set size, otherwise the block is refit
+
+    Returns:
+        w,b : (first layer, output layer) weights and biases
+    """
+    pars=data[0]
+    pix=data[1]
+    ckfile=data[2]
+    pixind=data[3] if len(data) > 3 else np.arange(pix.shape[1])
+    key={'pixind':pixind,'hidden':hidden,'shape':np.array(pars.shape),'nfit':nfit}
+
+    if _ckmatch(ckfile+'.npz',key) :
+        print('using completed block: ', ckfile)
+        out=np.load(ckfile+'.npz')
+        return (out['w0'],out['w1']),(out['b0'],out['b1'])
+    elif os.path.exists(ckfile+'.npz') :
+        print('completed block does not match current pixels/hidden/training set, refitting: ', ckfile)
+
+    net=models.Sequential()
+    net.add(layers.Dense(hidden, activation='sigmoid', input_shape=(pars.shape[1],),
+            kernel_regularizer=regularizers.l2(reg)))
+    net.add(layers.Dense(pix.shape[1], activation='linear'))
+    opt=optimizers.Adam(lr=0.001)
+    net.compile(optimizer=opt,loss='mse')
+    if verbose > 0 : net.summary()
+    # weights in progress are only valid for the block they were written for, recorded in checkpoint.key.npz
+    if os.path.exists(ckfile+'.weights.h5') :
+        if _ckmatch(ckfile+'.key.npz',key) :
+            print('resuming from: ', ckfile+'.weights.h5')
+            net.load_weights(ckfile+'.weights.h5')
+        else :
+            print('weights do not match current pixels/hidden/training set, not resuming: ', ckfile+'.weights.h5')
+            os.remove(ckfile+'.weights.h5')
+    np.savez(ckfile+'.key.npz',**key)
+
+    if nfit < pix.shape[0] :
+        validation_data=(pars[nfit:],pix[nfit:])
+        monitor='val_loss'
+    else :
+        validation_data=None
+        monitor='loss'
+    stop=callbacks.EarlyStopping(monitor=monitor,patience=patience,restore_best_weights=True)
+    check=callbacks.ModelCheckpoint(ckfile+'.weights.h5',monitor=monitor,save_best_only=True,save_weights_only=True)
+    net.fit(pars[0:nfit],pix[0:nfit],epochs=nepochs,batch_size=batch_size,verbose=verbose,
+            validation_data=validation_data,callbacks=[stop,check])
+
+    w0,b0,w1,b1=net.get_weights()
+    np.savez(ckfile+'.npz',w0=w0,b0=b0,w1=w1,b1=b1,**key)
+    if os.path.exists(ckfile+'.weights.h5') : os.remove(ckfile+'.weights.h5')
+    os.remove(ckfile+'.key.npz')
+    return (w0,w1),(b0,b1)
+
 def merge(file,n=8) :
     """ Merge pieces of a model (e.g., run on different nodes for pixel subsets) into a single model
     """
@@ -285,41 +392,174 @@ def model(pars, mn, std, weights, biases) :
     return mn + std * (np.dot( sigmoid((np.dot(weights[0].T,pars)+biases[0])).T, weights[1] ) +biases[1])
 
 def spectrum(x,*pars) :
-    """ Return full spectrum given input list of pixels, parameters
+    """ Return full spectrum given input list of pixels, parameters, using model loaded by get()
     """
-    spec=np.full_like(x.astype(float),np.nan)
-    pnorm= (pars-pmeans)/pstds
-    for j,i in enumerate(x) :
-        if  np.isfinite(means[i]) :
-            spec[j]= model(pnorm, means[i], stds[i], weights[ifit[i]], biases[ifit[i]]) 
+    return nnmodel.spectrum(np.array(pars))[x]
+
+class Model(object) :
+    """ Neural network spectral model with the networks for all pixels stacked into dense arrays,
+        so that a full spectrum (or a batch of spectra) is evaluated with a few matrix products
 
-    return spec
+        Each network has a single sigmoid hidden layer, which may be shared by a block of pixels
+        (joint training) or belong to a single pixel (per-pixel training)
 
-def get(file) :
-    """ Load a model pickle file into global variables
+    Args:
+        head (dict) : model dictionary, as saved by train() in a pickle file (per-pixel weights
+                      and biases) or NPZ file (stacked arrays w0, b0, w1, b1, grp)
+    """
+    def __init__(self,head) :
+        self.head = head
+        self.pmeans = np.array(head['pmeans'],dtype=float)
+        self.pstds = np.array(head['pstds'],dtype=float)
+        # parameters with no dispersion were not scaled in training
+        self.pstds[self.pstds <= 0.] = 1.
+        means = np.array(head['means'],dtype=float)
+        stds = np.array(head['stds'],dtype=float)
+        self.npix = len(means)
+        # pixels with finite normalization have a network, in order
+        self.pix = np.where(np.isfinite(means))[0]
+        self.means = means[self.pix]
+        self.stds = stds[self.pix]
+        self.npar = len(self.pmeans)
+        if 'w0' in head :
+            # stacked arrays: w0 (ngroup,npar,nodes), b0 (ngroup,nodes), w1 (nfit,nodes), b1 (nfit),
+            #   and grp (nfit), the hidden layer used by each fit pixel
+            w0 = np.array(head['w0'],dtype=float).transpose(1,0,2)
+            self.b0 = np.array(head['b0'],dtype=float)
+            self.w1 = np.array(head['w1'],dtype=float)
+            self.b1 = np.array(head['b1'],dtype=float)
+            self.grp = np.array(head['grp'],dtype=int)
+            self.nodes = w0.shape[2]
+        else :
+            # list of per-pixel (w0,w1),(b0,b1) tuples
+            w = head['weights']
+            b = head['biases']
+            nfit = len(w)
+            self.nodes = np.asarray(w[0][0]).shape[1]
+            w0 = np.empty((self.npar,nfit,self.nodes))
+            self.b0 = np.empty((nfit,self.nodes))
+            self.w1 = np.empty((nfit,self.nodes))
+            self.b1 = np.empty(nfit)
+            for k in range(nfit) :
+                w0[:,k,:] = w[k][0]
+                self.b0[k,:] = b[k][0]
+                self.w1[k,:] = np.asarray(w[k][1]).reshape(self.nodes)
+                self.b1[k] = np.asarray(b[k][1]).reshape(-1)[0]
+            self.grp = np.arange(nfit)
+        self.ngroup = w0.shape[1]
+        # first layer stored as a single (npar, ngroup*nodes) matrix
+        self.w0 = w0.reshape(self.npar,self.ngroup*self.nodes)
+
+    def _hidden(self,pars) :
+        """ Hidden layer activations for (N,npar) input parameters, returns (N,ngroup,nodes)
+        """
+        pnorm = (pars-self.pmeans)/self.pstds
+        return sigmoid(np.dot(pnorm,self.w0).reshape(len(pars),self.ngroup,self.nodes)+self.b0)
+
+    def spectrum(self,pars,chunk=256) :
+        """ Model spectrum for input parameters
+
+        Args:
+            pars : parameter vector (npar), or array of parameter vectors (N,npar)
+
+        Keyword args:
+            chunk (int) : number of parameter vectors to evaluate at once, to bound memory (default=256)
+
+        Returns:
+            spectrum (npix), or spectra (N,npix), with NaN at pixels that have no model
+        """
+        batch = np.ndim(pars) > 1
+        pars = np.atleast_2d(np.asarray(pars,dtype=float))
+        out = np.full((len(pars),self.npix),np.nan)
+        for i in range(0,len(pars),chunk) :
+            h = self._hidden(pars[i:i+chunk])
+            if self.ngroup < len(self.pix) :
+                # shared hidden layers: output layer of each group is a matrix product
+                net = np.empty((len(h),len(self.pix)))
+                for g in range(self.ngroup) :
+                    j = np.where(self.grp == g)[0]
+                    net[:,j] = np.dot(h[:,g,:],self.w1[j].T)
+            else :
+                net = np.einsum('nkj,kj->nk',h[:,self.grp,:],self.w1)
+            out[i:i+chunk,self.pix] = self.means + self.stds * (net+self.b1)
+        return out if batch else out[0]
+
+    def jacobian(self,pars,chunk=16) :
+        """ Analytic derivatives of model spectrum with respect to (unnormalized) parameters
+
+        Args:
+            pars : parameter vector (npar), or array of parameter vectors (N,npar)
+
+        Keyword args:
+            chunk (int) : number of parameter vectors to evaluate at once, to bound memory (default=16)
+
+        Returns:
+            jacobian (npix,npar), or (N,npix,npar), with NaN at pixels that have no model
+        """
+        batch = np.ndim(pars) > 1
+        pars = np.atleast_2d(np.asarray(pars,dtype=float))
+        w0 = self.w0.reshape(self.npar,self.ngroup,self.nodes)
+        out = np.full((len(pars),self.npix,self.npar),np.nan)
+        for i in range(0,len(pars),chunk) :
+            h = self._hidden(pars[i:i+chunk])
+            if self.ngroup < len(self.pix) :
+                # shared hidden layers: derivatives of hidden nodes, then output layer, per group
+                net = np.empty((len(h),len(self.pix),self.npar))
+                for g in range(self.ngroup) :
+                    j = np.where(self.grp == g)[0]
+                    dh = (h[:,g,:]*(1.-h[:,g,:]))[:,:,np.newaxis] * w0[:,g,:].T
+                    net[:,j,:] = np.einsum('nmi,km->nki',dh,self.w1[j])
+            else :
+                g = (h*(1.-h))[:,self.grp,:]*self.w1
+                net = np.einsum('nkj,ikj->nki',g,w0[:,self.grp,:])
+            out[i:i+chunk,self.pix,:] = net * self.stds[:,np.newaxis] / self.pstds
+        return out if batch else out[0]
+
+    def fitfunc(self,pixels) :
+        """ Return (function, jacobian) pair for curve_fit of the spectrum at the given pixels
+        """
+        def func(x,*pars) :
+            return self.spectrum(np.array(pars))[pixels]
+        def jac(x,*pars) :
+            return self.jacobian(np.array(pars))[pixels,:]
+        return func, jac
+
+    def write(self,file) :
+        """ Save model in compact NPZ format (stacked arrays), readable by get()
+        """
+        means = np.full(self.npix,np.nan)
+        stds = np.full(self.npix,np.nan)
+        means[self.pix] = self.means
+        stds[self.pix] = self.stds
+        w0 = self.w0.reshape(self.npar,self.ngroup,self.nodes).transpose(1,0,2)
+        np.savez(file+'.npz',pmeans=self.head['pmeans'],pstds=self.head['pstds'],means=means,stds=stds,
+                 w0=w0,b0=self.b0,w1=self.w1,b1=self.b1,grp=self.grp)
+
+def get(file,format=None) :
+    """ Load a model from NPZ or pickle file, return it as a Model (also used by spectrum())
+
+    Args:
+        file (str) : model file name, without .npz/.pkl suffix
+        format (str) : 'npz' or 'pkl' to load that file; default loads whichever of the two exists, the newer one if both do
     """
-    global head, pmeans, pstds, means, stds, weights, biases, ifit
+    global head, nnmodel
+
+    if format is None :
+        formats=[f for f in ['npz','pkl'] if os.path.exists(file+'.'+f)]
+        if len(formats) == 0 : raise IOError('no model file found: '+file+'.npz or .pkl')
+        format=max(formats,key=lambda f : os.path.getmtime(file+'.'+f))
+    print('loading model: ',file+'.'+format)
 
     # Getting back the objects:
-    with open(file+'.pkl') as f: 
-        head = pickle.load(f)
-        #pmeans, pstds, means, stds, weights, biases = pickle.load(f)
-    pmeans = np.array(head['pmeans'])
-    pstds = np.array(head['pstds'])
-    means = head['means']
-    stds = head['stds']
-    weights = head['weights']
-    biases = head['biases']
-    #pmeans = np.array(pmeans)
-    #pstds = np.array(pstds)
-
-    # get correspondence of pixel number with weight/bias index (since NaNs are not fit)
-    ifit = np.zeros(len(means)).astype(int)
-    j=0
-    for i in range(len(means)) :
-        if np.isfinite(means[i]) : 
-            ifit[i] = j
-            j += 1
+    if format == 'npz' :
+        head = dict(np.load(file+'.npz'))
+    elif format == 'pkl' :
+        with open(file+'.pkl','rb') as f:
+            head = pickle.load(f)
+    else :
+        raise ValueError('unknown model format: '+format)
+    nnmodel = Model(head)
+    return nnmodel
 
 def test(pmn, pstd, mn, std, weights, biases,n=100, t0=[3750.,4500.], g0=2., mh0=0.) :
     """ Plots cross-sections of model for fit pixels
@@ -353,7 +593,7 @@ def fitinput(file,threads=8,nfit=8,dofit=True,order=4) :
     s=fits.open(file+'.fits')[2].data
     p=p[:,0:8]
     if nfit == 0 : nfit = p.shape[0]
-    get(file)
+    mod=get(file)
 
     specerr=np.full_like(s[0,:],0.005)
     if dofit :
@@ -363,7 +603,7 @@ def fitinput(file,threads=8,nfit=8,dofit=True,order=4) :
             specs.append((s[i,:]/cont, specerr))
 
         pool = mp.Pool(threads)
-        output = pool.map_async(solve, specs).get()
+        output = pool.map_async(functools.partial(solve,model=mod), specs).get()
         pool.close()
         pool.join()
 
@@ -385,15 +625,10 @@ def fitinput(file,threads=8,nfit=8,dofit=True,order=4) :
         hdu.close()
 
     # save model and fit spectra
-    pix = np.arange(0,8575,1)
-    model=[]
-    for i in range(nfit) :
-        snorm = s[i,:] / np.nanmean(s[i,:])
-        spec=spectrum(pix, *p[i,:])    
-        model.append(spec)
+    model=mod.spectrum(p[0:nfit,0:mod.npar])
 
     hdu=fits.HDUList()
-    hdu.append(fits.ImageHDU(np.array(model)))
+    hdu.append(fits.ImageHDU(model))
     hdu.writeto(file+'_model.fits',overwrite=True)   
     hdu.close()
 
@@ -450,17 +685,21 @@ def comp(file,order=4,z=2)  :
         plt.draw()
         pdb.set_trace()
 
-def solve(spec) :
-    """ Solve for parameters for a single input spectrum
+def solve(spec,model=None) :
+    """ Solve for parameters for a single input spectrum, given (spectrum, uncertainty) and Model
+        (default: model loaded by get()), using analytic derivatives
     """
+    if model is None : model=nnmodel
     s=spec[0]
     serr=spec[1]
     pix = np.arange(0,len(s),1)
-    init = np.array([4000.,2.5,0.,0.,0.,0.,1.5,0.])
-    bounds = (np.array([3000.,-0.5,-3.,-1.,-1.,-1.,0.5,0.]),
-              np.array([8000., 5.5, 1., 1., 1., 1.,4.5,100.]))
-    gd = np.where(np.isfinite(s))[0]
-    fpars,fcov = curve_fit(spectrum,pix[gd],s[gd],sigma=serr[gd],p0=init,bounds=bounds)
+    npar = model.npar
+    init = np.array([4000.,2.5,0.,0.,0.,0.,1.5,0.])[0:npar]
+    bounds = (np.array([3000.,-0.5,-3.,-1.,-1.,-1.,0.5,0.])[0:npar],
+              np.array([8000., 5.5, 1., 1., 1., 1.,4.5,100.])[0:npar])
+    gd = np.intersect1d(np.where(np.isfinite(s) & np.isfinite(serr))[0],model.pix)
+    func,jac = model.fitfunc(gd)
+    fpars,fcov = curve_fit(func,pix[gd],s[gd],sigma=serr[gd],p0=init,bounds=bounds,jac=jac)
     return fpars
 
 def fitfield(model,field,stars=None,nfit=0,order=4,threads=8,plot=False,write=True) :
@@ -468,7 +707,7 @@ def fitfield(model,field,stars=None,nfit=0,order=4,threads=8,plot=False,write=Tr
     """
 
     # get model and list of stars
-    get(model)
+    mod=get(model)
     load=apload.ApLoad(dr='dr14')
     apfield=load.apField(field)[1].data
     aspcap_param=load.aspcapField(field)[1].data
@@ -502,7 +741,7 @@ def fitfield(model,field,stars=None,nfit=0,order=4,threads=8,plot=False,write=Tr
 
     # do the fits in parallel
     pool = mp.Pool(threads)
-    output = pool.map_async(solve, specs).get()
+    output = pool.map_async(functools.partial(solve,model=mod), specs).get()
     pool.close()
     pool.join()
     print('done pool')
@@ -513,20 +752,14 @@ def fitfield(model,field,stars=None,nfit=0,order=4,threads=8,plot=False,write=Tr
     out['APOGEE_ID']=stars
     length=len(out)
     out.add_column(Column(name='FPARAM',data=output))
-    spec=[]
-    err=[]
-    bestfit=[]
-    chi2=[]
-    for i,star in enumerate(stars) :
-        spec.append(specs[i][0])
-        err.append(specs[i][1])
-        fit=spectrum(pix, *output[i])
-        bestfit.append(fit)
-        chi2.append(np.nansum((specs[i][0]-fit)**2/specs[i][1]**2))
-    out.add_column(Column(name='SPEC',data=np.array(spec)))
-    out.add_column(Column(name='ERR',data=np.array(err)))
-    out.add_column(Column(name='SPEC_BESTFIT',data=np.array(bestfit)))
-    out.add_column(Column(name='CHI2',data=np.array(chi2)))
+    spec=np.array([s[0] for s in specs])
+    err=np.array([s[1] for s in specs])
+    bestfit=mod.spectrum(output)
+    chi2=np.nansum((spec-bestfit)**2/err**2,axis=1)
+    out.add_column(Column(name='SPEC',data=spec))
+    out.add_column(Column(name='ERR',data=err))
+    out.add_column(Column(name='SPEC_BESTFIT',data=bestfit))
+    out.add_column(Column(name='CHI2',data=chi2))
     if write : out.write('nn-'+field+'.fits',format='fits',overwrite=True)
     return out
 
@@ -31,6 +31,12 @@ import shutil
 import argparse
 import pdb
 from astropy.io import fits
+from scipy.spatial import cKDTree
+
+# weights of [M/H], [alpha/M], [C/M], Teff, logg in the find_filler "distance", and
+#   the weights for models where [c/m]-[alpha/m] have the opposite sign as the hole
+_DISTWEIGHT = np.array([0.7, 0.4, 0.17, 0.62/100., 1.5])
+_DISTWEIGHT_OPP = np.array([0.7, 5*0.4, 5*0.17, 0.62/100., 1.5])
 
 def cval(x) :
     """ routine to convert value to "Kurucz-style" string, i.e. mXX or pXX
@@ -76,26 +82,33 @@ def filename(teff,logg,z,c,a,model='Unknown',vers='x3') :
 
     return file
 
-def find_filler(all,i,model='Unknown') :
+def find_filler(all,i,model='Unknown',index=None) :
     """ Find "closest" existing model for an atmosphere hole using "distance" scheme suggested largely by Matt Shetrone 
 
     Args :
         all (recarray) : input list of atmospheres
         i (int) : index of hole
         model (str) : type of atmopshere (default='Unknown' --> kurucz)
+        index (dict) : spatial index of computed models from filler_index(), to only compute
+                       distances to the nearest models (default=None --> compute distance to all models)
     Returns :
         fill : index of "closest" atmosphere
         dist : "distance" to closest atmosphere
     """
 
-    # calculate distance of all models from the hole
-    dist = 0.7*abs(all['z'][i]-all['z'])/1.00 + 0.4*abs(all['a'][i]-all['a'])/1.00 + 0.17*abs(all['c'][i]-all['c'])/1.00 + 0.62*abs(all['teff'][i]-all['teff'])/100. + 1.5*abs(all['logg'][i]-all['logg'])
-    # penalize models where [c/m]-[alpha/m] have opposite sign
-    if all['c'][i] - all['a'][i] <= 0. :
-        bd = np.where((all['metric'] == 0.) & ((all['c']-all['a']) > 0.))
-    else :
-        bd = np.where((all['metric'] == 0.) & ((all['c']-all['a']) <= 0.))
-    dist[bd] +=  4*0.4*abs(all['a'][i]-all['a'][bd])/1.00 + 4*0.17*abs(all['c'][i]-all['c'][bd])/1.00
+    if index is not None :
+        # closest distance from the nearest computed model with each sign of [c/m]-[alpha/m]
+        x = np.array([all['z'][i],all['a'][i],all['c'][i],all['teff'][i],all['logg'][i]],dtype=float)
+        trees = index[bool(all['c'][i] - all['a'][i] <= 0.)]
+        dmin = np.min([tree.query(x*weight,p=1)[0] for tree,gd,weight in trees])
+        # all models within (rounding of) that distance, in input order so ties go to the first as below
+        gd = np.sort(np.concatenate([gd[tree.query_ball_point(x*weight,dmin*(1+1.e-5)+1.e-5,p=1)]
+                                     for tree,gd,weight in trees]).astype(int))
+        dist = distance(all,i,gd)
+        fill = gd[np.argmin(dist)]
+        return fill, dist.min()
+
+    dist = distance(all,i)
 
     # search only through computed models and only where alpha and m go in opposite directions
     #gd = np.where((all['metric'] == 0.) & ((all['z'][i]-all['z'])*(all['a'][i]-all['a']) <= 0.))
@@ -104,6 +117,48 @@ def find_filler(all,i,model='Unknown') :
     fill = gd[0][np.argmin(dist[gd])]
     return fill, dist[fill]
 
+def distance(all,i,j=None) :
+    """ Return "distance" of models from a hole, as used by find_filler
+
+    Args :
+        all (recarray) : input list of atmospheres
+        i (int) : index of hole
+        j (array) : indices of models to return distance for (default=None --> all models)
+    Returns :
+        dist : "distance" of the models
+    """
+    mod = all if j is None else all[j]
+
+    # calculate distance of all models from the hole
+    dist = 0.7*abs(all['z'][i]-mod['z'])/1.00 + 0.4*abs(all['a'][i]-mod['a'])/1.00 + 0.17*abs(all['c'][i]-mod['c'])/1.00 + 0.62*abs(all['teff'][i]-mod['teff'])/100. + 1.5*abs(all['logg'][i]-mod['logg'])
+    # penalize models where [c/m]-[alpha/m] have opposite sign
+    if all['c'][i] - all['a'][i] <= 0. :
+        bd = np.where((mod['metric'] == 0.) & ((mod['c']-mod['a']) > 0.))
+    else :
+        bd = np.where((mod['metric'] == 0.) & ((mod['c']-mod['a']) <= 0.))
+    dist[bd] +=  4*0.4*abs(all['a'][i]-mod['a'][bd])/1.00 + 4*0.17*abs(all['c'][i]-mod['c'][bd])/1.00
+    return dist
+
+def filler_index(all) :
+    """ Build a spatial index of the computed models (metric=0) for find_filler: a KD-tree in the
+        (weighted, L1) "distance" for the models with each sign of [c/m]-[alpha/m]
+
+    Args :
+        all (recarray) : input list of atmospheres
+    Returns :
+        index : dict, for each sign of [c/m]-[alpha/m] of a hole ([c/m]-[alpha/m] <= 0 : True/False),
+                with a list of (tree, model indices, weights) to search
+    """
+    x = np.array([all['z'],all['a'],all['c'],all['teff'],all['logg']],dtype=float).T
+    neg = (all['c']-all['a']) <= 0.
+    index = {}
+    for sign in [True,False] :
+        index[sign] = []
+        for same,weight in zip([True,False],[_DISTWEIGHT,_DISTWEIGHT_OPP]) :
+            gd = np.where((all['metric'] == 0.) & (neg == (sign if same else not sign)))[0]
+            if len(gd) > 0 : index[sign].append((cKDTree(x[gd]*weight),gd,weight))
+    return index
+
 def writetmp(tmp,file) :
     """ Auxiliary routine to open file, write string, and close file
 
@@ -227,33 +282,32 @@ def fill_holes(argv) :
 
     print('# [M/H] [C/M] [A/M] Teff logg metric Delta(M) Delta(C) Delta(A) Delta(Teff) Delta(logg) (SPECLIB_VERS: '+os.environ['APOGEE_VER']+')')
 
-    # loop over grid finding computed models and filling up array of all models
-    nmissing = 0
-    i=0
-    for teff in all_teff :
-       for z in all_z :
-          for c in all_c :
-             for a in all_a :
-                for logg in all_logg :
-
-                    file = filename(teff,logg,z,c,a,model=model)
-                    all['teff'][i] = teff
-                    all['logg'][i] = logg
-                    all['z'][i] = z
-                    all['c'][i] = c
-                    all['a'][i] = a
-                    all['metric'][i] = -1.
-                    # see if model exists 
-                    if os.path.exists(dir+file) :
-                      # set "metric" to zero
-                      all['metric'][i] = 0.
-                    i += 1
+    # fill up array of all models
+    teff,z,c,a,logg = [x.flatten() for x in np.meshgrid(all_teff,all_z,all_c,all_a,all_logg,indexing='ij')]
+    all['teff'] = teff
+    all['logg'] = logg
+    all['z'] = z
+    all['c'] = c
+    all['a'] = a
+    files = [filename(teff[i],logg[i],z[i],c[i],a[i],model=model) for i in range(ntot)]
+
+    # list each atmosphere directory once to find the computed models, and set "metric" to zero for them
+    exists = set()
+    for subdir in set([os.path.dirname(file) for file in files]) :
+        try :
+            exists.update([subdir+'/'+f for f in os.listdir(dir+subdir)])
+        except OSError :
+            pass
+    all['metric'] = [0. if file in exists else -1. for file in files]
+
+    # spatial index of computed models to find fillers
+    index = filler_index(all)
 
     # now loop through and try to fill the missing models
     for i in range(ntot) :
         file =filename(all['teff'][i],all['logg'][i],all['z'][i],all['c'][i],all['a'][i],model=model)
         if all['metric'][i] < 0 :
-            fill, dist = find_filler(all,i,model=model) 
+            fill, dist = find_filler(all,i,model=model,index=index)
             all['metric'][i] = dist
             file =file+'.filled'
             fillfile = filename(all['teff'][fill],all['logg'][fill],all['z'][fill],all['c'][fill],all['a'][fill],model=model)
@@ -289,17 +343,9 @@ def fill_holes(argv) :
                '  {:+.2f} {:+.2f} {:+.2f} {:4d} {:+.1f}'.format(all['z'][i]-all['z'][fill],all['c'][i]-all['c'][fill],all['a'][i]-all['a'][fill],all['teff'][i]-all['teff'][fill],all['logg'][i]-all['logg'][fill]) )
 
     # FITS file output
-    out=np.zeros([len(all_c),len(all_a),len(all_z),len(all_logg),len(all_teff)],dtype=np.float32)
-    i=0
-    for teff in range(len(all_teff)) :
-       for z in range(len(all_z)) :
-          for c in range(len(all_c)) :
-             for a in range(len(all_a)) :
-                 for logg in range(len(all_logg)) :
-                     out[c,a,z,logg,teff] = all['metric'][i]
-                     i+=1
+    out=all['metric'].reshape(len(all_teff),len(all_z),len(all_c),len(all_a),len(all_logg)).transpose(2,3,1,4,0)
     if args.fits is not None :
-        hd=fits.PrimaryHDU(out)
+        hd=fits.PrimaryHDU(np.ascontiguousarray(out))
         hd.header['CTYPE1']='TEFF'
         hd.header['CRVAL1']=float(args.teff[1])
         hd.header['CDELT1']=float(args.teff[2])
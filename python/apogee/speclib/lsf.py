@@ -3,11 +3,12 @@
 # routines from github jobovy, modified by holtz to work in apogee product context
 ###############################################################################
 import os, os.path
+import collections
 from functools import wraps
 import warnings
 import math
 import numpy
-from scipy import special, interpolate, sparse, ndimage
+from scipy import special, interpolate, sparse, ndimage, signal
 import scipy.sparse.linalg
 import time
 import sys
@@ -55,7 +56,7 @@ def get(lsfid,waveid,fiber,highres=9,apred=None,telescope=None) :
 
 def convolve(wav,spec,
              lsf=None,xlsf=None,dxlsf=None,fiber='combo',
-             vmacro=6.,vrot=None, highout=False):
+             vmacro=6.,vrot=None, highout=False, chunk=256):
     """ convolve an input spectrum with APOGEE LSF and resample to APOGEE's apStar wavelength grid
     Args:
        wav - wavelength array (linear in wavelength in \AA)
@@ -65,7 +66,10 @@ def convolve(wav,spec,
           xlsf= (None) 1/integer equally-spaced pixel offsets at which the lsf=lsf input is calculated
           dxlsf= (None) spacing of pixel offsets
        fiber= if lsf is None, the LSF is calculated for this fiber
-       vmacro= (6.) Gaussian macroturbulence smoothing to apply as well (FWHM or a [sparse] matrix like lsf on the same x grid; can be computed with apogee.modelspec.vmacro)
+       vmacro= (6.) Gaussian macroturbulence smoothing to apply as well (FWHM), scalar or one per spectrum (0 for none)
+       vrot= (None) rotational broadening (vsini), scalar or one per spectrum (0 for none)
+       highout= (False) if True, return the spectra on the high-resolution grid
+       chunk= (256) number of spectra to process at once, to bound memory
     Returns :
        spectrum on apStar wavelength grid
     HISTORY:
@@ -89,7 +93,6 @@ def convolve(wav,spec,
     l10wav= numpy.log10(waveout[gd])
     dowav= l10wav[1]-l10wav[0]
     tmpwav= 10.**numpy.arange(l10wav[0],l10wav[-1]+dowav/hires,dowav/hires)
-    tmp= numpy.empty(len(l10wav)*hires)   
     # for minigrid, extract same length for LSF
     if wav[0]-waveout[0] > 10 :
         lsf = lsf[gd[0]*hires:gd[0]*hires+len(tmpwav),:]
@@ -97,39 +100,86 @@ def convolve(wav,spec,
     # sparsify, need to do after trimming lsf for minigrid
     if not isinstance(lsf,sparse.dia_matrix):
         lsf= sparsify(lsf)
+    # only the rows at the output pixels are needed
+    if highout : lsf= lsf.tocsr()
+    else : lsf= lsf.tocsr()[::hires]
 
-    # Interpolate the input spectrum, starting from a polynomial baseline
     if len(spec.shape) == 1: spec= numpy.reshape(spec,(1,len(spec)))
     nspec= spec.shape[0]
-    tmp= numpy.empty((nspec,len(tmpwav)))
-    for ii in range(nspec):
-        baseline= numpy.polynomial.Polynomial.fit(wav,spec[ii],4)
-        ip= interpolate.InterpolatedUnivariateSpline(wav,
-                                                     spec[ii]/baseline(wav),
-                                                     k=3)
-        tmp[ii]= baseline(tmpwav)*ip(tmpwav)
-    # Add macroturbulence, allowing for different kernel for each spectrum
-    if not vmacro is None :
-        sigvm= vmacro/3./10.**5./numpy.log(10.)*hires/dowav/2./numpy.sqrt(2.*numpy.log(2.))
-        if isinstance(vmacro,float): sigvm=numpy.tile(sigvm,(nspec,1))
-        for ii in range(nspec) :
-            tmp[ii,:]= ndimage.gaussian_filter1d(tmp[ii,:],sigvm[ii],mode='constant')
-    # Add rotation
-    if vrot is not None :
-        deltav=dowav/hires*3.e5*numpy.log(10)
-        print('rot: ',deltav,vrot)
-        kernel=rotate(deltav,vrot,epsilon=0.25)
-        kernel=sparsify(numpy.tile(kernel,(len(tmpwav),1)))
-        print(kernel.shape)
-        tmp=kernel.dot(tmp.T).T
-    if not isinstance(tmp,sparse.csr_matrix):
-        # Use sparse representations to quickly calculate the convolution
-        tmp= sparse.csr_matrix(tmp)
-
-    if highout :
-        return lsf.dot(tmp.T).T.toarray(),waveout[gd]
-    else :
-        return lsf.dot(tmp.T).T.toarray()[:,::hires],waveout[gd]
+    # macroturbulence and rotation, allowing for different kernel for each spectrum
+    if vmacro is None : vmacro= 0.
+    vmacro= numpy.broadcast_to(numpy.asarray(vmacro,dtype=float),(nspec,))
+    sigvm= vmacro/3./10.**5./numpy.log(10.)*hires/dowav/2./numpy.sqrt(2.*numpy.log(2.))
+    if vrot is None : vrot= 0.
+    vrot= numpy.broadcast_to(numpy.asarray(vrot,dtype=float),(nspec,))
+    deltav=dowav/hires*3.e5*numpy.log(10)
+
+    out= numpy.empty((nspec,lsf.shape[0]))
+    for i0 in range(0,nspec,chunk) :
+        i1= min(i0+chunk,nspec)
+        # Interpolate the input spectra, starting from a polynomial baseline
+        tmp= resample(wav,spec[i0:i1],tmpwav)
+        # Add macroturbulence
+        tmp= _kernelconvolve(tmp,sigvm[i0:i1],_gausskernel)
+        # Add rotation
+        tmp= _kernelconvolve(tmp,vrot[i0:i1],lambda v : _rotkernel(deltav,v,epsilon=0.25))
+        # LSF convolution as a sparse product
+        out[i0:i1]= lsf.dot(tmp.T).T
+
+    return out,waveout[gd]
+
+def resample(wav,spec,outwav) :
+    """ Interpolate spectra onto a new wavelength grid with a cubic spline, relative to a 4th order polynomial baseline
+
+    Args:
+        wav (np.array) : input wavelength array
+        spec (np.array) : spectra on wav wavelength grid [nspec,nwave]
+        outwav (np.array) : output wavelength array
+    Returns :
+        spectra on outwav wavelength grid [nspec,nout]
+    """
+    # baselines for all spectra at once, with the domain mapping of numpy.polynomial.Polynomial.fit
+    off,scl= numpy.polynomial.polyutils.mapparms([wav.min(),wav.max()],[-1.,1.])
+    coef= numpy.polynomial.polynomial.polyfit(off+scl*wav,spec.T,4)
+    baseline= numpy.polynomial.polynomial.polyval(off+scl*wav,coef)
+    ip= interpolate.make_interp_spline(wav,(spec/baseline).T,k=3)
+    return numpy.polynomial.polynomial.polyval(off+scl*outwav,coef)*ip(outwav).T
+
+# LRU cache of smoothing kernels, keyed by kernel type and width
+_KERNELCACHE= collections.OrderedDict()
+_KERNELCACHESIZE= 4096
+# kernels longer than this are applied with FFTs
+_FFTKERNEL= 64
+
+def _gausskernel(sigma) :
+    """ Cached, normalized Gaussian kernel, as used by ndimage.gaussian_filter1d
+    """
+    def _kernel() :
+        x= numpy.arange(-int(4.*sigma+0.5),int(4.*sigma+0.5)+1)
+        phi= numpy.exp(-0.5/(sigma*sigma)*x**2)
+        return phi/phi.sum()
+    return _lru(_KERNELCACHE,_KERNELCACHESIZE,('gauss',sigma),_kernel)
+
+def _rotkernel(deltav,vsini,epsilon=0.6) :
+    """ Cached rotation kernel
+    """
+    return _lru(_KERNELCACHE,_KERNELCACHESIZE,('rot',deltav,vsini,epsilon),
+                lambda : rotate(deltav,vsini,epsilon=epsilon))
+
+def _kernelconvolve(spec,width,kernel) :
+    """ Convolve each spectrum [nspec,nwave] with kernel(width[i]), grouping spectra with the same width;
+        spectra with width <= 0 are unchanged
+    """
+    uwidth,inv= numpy.unique(width,return_inverse=True)
+    for iw,w in enumerate(uwidth) :
+        if not w > 0. : continue
+        j= numpy.where(inv == iw)[0]
+        k= kernel(w)
+        if len(k) > _FFTKERNEL :
+            spec[j]= signal.fftconvolve(spec[j],k[numpy.newaxis,:],mode='same',axes=-1)
+        else :
+            spec[j]= ndimage.convolve1d(spec[j],k,axis=-1,mode='constant')
+    return spec
 
 def sparsify(lsf):
     """convert an LSF matrix calculated with eval [ncen,npixoff] to a sparse [ncen,ncen] matrix with the LSF on the diagonals (for quick convolution with the LSF)
@@ -211,8 +261,7 @@ def eval(x,fiber='combo',lsfid=5440020,waveid=2420038,sparse=False):
         dx[-1]= dx[-1-hires]
         dx[-2]= dx[-2-hires]
         dx[-3]= dx[-3-hires]
-        xs= numpy.tile(x,(len(hireswav),1))\
-            *numpy.tile(dx,(len(x),1)).T # nwav,nx       
+        xs= numpy.outer(dx,x) # nwav,nx
         gd= True^numpy.isnan(pix)
         # Read LSF file for this chip
         #lsfpars= apread.apLSF(chip,ext=0)
@@ -266,44 +315,59 @@ def raw(x,xcenter,params,nowings=False):
     if not nowings: out+= _wingsbin(x,wingparams,params['binsize'],params['Wproftype'])
     return out
 
-def _gausshermitebin(x,params,binsize):
-    """ Evaluate the integrated Gauss-Hermite function
+def _gausshermitebin(x,params,binsize,chunk=4096):
+    """ Evaluate the integrated Gauss-Hermite function for all centers at once
+
+    Args :
+       x - pixel offsets [ncenter,nx]
+       params - sigma and Hermite coefficients at each center [nterm+1,ncenter]
+       binsize - width of a pixel in X-units
+       chunk= (4096) number of centers to evaluate at once, to bound memory
+    Returns :
+       integrated Gauss-Hermite function [ncenter,nx]
     """
     ncenter= params.shape[1]
+    nterm= params.shape[0]-1
+    # HermiteE -> power series conversion is linear in the coefficients
+    conv= numpy.zeros((nterm,nterm))
+    for jj in range(nterm):
+        c= numpy.polynomial.hermite_e.herme2poly(numpy.eye(nterm)[jj])
+        conv[:len(c),jj]= c
+    coefs= numpy.dot(conv,params[1:])
     out= numpy.empty((ncenter,x.shape[1]))
-    integ= numpy.empty((params.shape[0]-1,x.shape[1]))
-    for ii in range(ncenter):
-        poly= numpy.polynomial.HermiteE(params[1:,ii])
-        # Convert to regular polynomial basis for easy integration
-        poly= poly.convert(kind=numpy.polynomial.Polynomial)
-        # Integrate and add up
-        w1= (x[ii]-0.5*binsize)/params[0,ii]
-        w2= (x[ii]+0.5*binsize)/params[0,ii]
+    for i0 in range(0,ncenter,chunk):
+        i1= min(i0+chunk,ncenter)
+        sig= params[0,i0:i1,numpy.newaxis]
+        w1= (x[i0:i1]-0.5*binsize)/sig
+        w2= (x[i0:i1]+0.5*binsize)/sig
         eexp1= numpy.exp(-0.5*w1**2.)
         eexp2= numpy.exp(-0.5*w2**2.)
-        integ[0]= numpy.sqrt(numpy.pi/2.)\
-            *(special.erf(w2/_SQRTTWO)-special.erf(w1/_SQRTTWO))
-        out[ii]= poly.coef[0]*integ[0]
-        if params.shape[0] > 1:
-            integ[1]= -eexp2+eexp1
-            out[ii]+= poly.coef[1]*integ[1]
-        for jj in range(2,params.shape[0]-1):
-            integ[jj]= (-w2**(jj-1)*eexp2+w1**(jj-1)*eexp1)\
-                +(jj-1)*integ[jj-2]
-            out[ii]+= poly.coef[jj]*integ[jj]
+        # integrals of w^jj exp(-w^2/2), through the recurrence in jj
+        integ= [numpy.sqrt(numpy.pi/2.)\
+                    *(special.erf(w2/_SQRTTWO)-special.erf(w1/_SQRTTWO))]
+        res= coefs[0,i0:i1,numpy.newaxis]*integ[0]
+        if nterm > 1:
+            integ.append(-eexp2+eexp1)
+            res+= coefs[1,i0:i1,numpy.newaxis]*integ[1]
+        pw1= numpy.ones_like(w1)
+        pw2= numpy.ones_like(w2)
+        for jj in range(2,nterm):
+            pw1*= w1
+            pw2*= w2
+            integ.append((-pw2*eexp2+pw1*eexp1)+(jj-1)*integ[jj-2])
+            res+= coefs[jj,i0:i1,numpy.newaxis]*integ[jj]
+        out[i0:i1]= res
     return out
 
 def _wingsbin(x,params,binsize,Wproftype):
-    """Evaluate the wings of the LSF
+    """Evaluate the wings of the LSF for all centers at once
     """
-    ncenter= params.shape[1]
-    out= numpy.empty((ncenter,x.shape[1]))
-    for ii in range(ncenter):
-        if Wproftype == 1: # Gaussian
-            w1=(x[ii]-0.5*binsize)/params[1,ii]
-            w2=(x[ii]+0.5*binsize)/params[1,ii]
-            out[ii]= params[0,ii]/2.*(special.erf(w2/_SQRTTWO)\
-                                          -special.erf(w1/_SQRTTWO))
+    out= numpy.zeros((params.shape[1],x.shape[1]))
+    if Wproftype == 1: # Gaussian
+        w1=(x-0.5*binsize)/params[1,:,numpy.newaxis]
+        w2=(x+0.5*binsize)/params[1,:,numpy.newaxis]
+        out[:]= params[0,:,numpy.newaxis]/2.*(special.erf(w2/_SQRTTWO)\
+                                                  -special.erf(w1/_SQRTTWO))
     return out
 
 def unpack_lsf_params(lsfarr):
@@ -376,34 +440,74 @@ def scalarDecorator(func):
             scalarOut= False
         result= func(*args,**kwargs)
         if scalarOut:
-            return result[0]
+            return result[...,0]
         else:
             return result
     return scalar_wrapper
 
+# LRU caches of apWave wavelength arrays, keyed by (waveid,telescope,apred), and of the
+#   wavelength-solution splines, keyed by (waveid,telescope,apred,chip,fiber)
+_WAVECACHE= collections.OrderedDict()
+_WAVECACHESIZE= 4
+_SPLINECACHE= collections.OrderedDict()
+_SPLINECACHESIZE= 1024
+
+def _lru(cache,size,key,func) :
+    """ Return cache[key], computing it with func() if not present, with LRU eviction
+    """
+    try :
+        cache.move_to_end(key)
+        return cache[key]
+    except KeyError :
+        val= func()
+        cache[key]= val
+        while len(cache) > size : cache.popitem(last=False)
+        return val
+
+def clearcache() :
+    """ Clear the cached wavelength solutions used by wave2pix and pix2wave
+    """
+    _WAVECACHE.clear()
+    _SPLINECACHE.clear()
+
+def _wavesol(waveid,chip,fiber) :
+    """ Return cached (wave0,baseline,spline) for wave2pix and (baseline,spline) for pix2wave
+        for the wavelength solution of a chip and fiber
+    """
+    def _read() :
+        waves= load.apWave(waveid,hdu=2)[0]
+        return dict([(ch,numpy.array(waves[ch])) for ch in ['a','b','c']])
+    def _fit() :
+        wave0= _lru(_WAVECACHE,_WAVECACHESIZE,(waveid,load.telescope,load.apred),_read)[chip][300-fiber]
+        pix0= numpy.arange(len(wave0))
+        # Need to sort into ascending order
+        sindx= numpy.argsort(wave0)
+        swave0= wave0[sindx]
+        spix0= pix0[sindx]
+        # Start from a linear baseline
+        baseline= numpy.polynomial.Polynomial.fit(swave0,spix0,1)
+        ip= interpolate.InterpolatedUnivariateSpline(swave0,spix0/baseline(swave0),k=3)
+        pbaseline= numpy.polynomial.Polynomial.fit(pix0,wave0,1)
+        pip= interpolate.InterpolatedUnivariateSpline(pix0,wave0/pbaseline(pix0),k=3)
+        return (swave0,baseline,ip),(pbaseline,pip)
+    return _lru(_SPLINECACHE,_SPLINECACHESIZE,(waveid,load.telescope,load.apred,chip,fiber),_fit)
+
 @scalarDecorator
 def wave2pix(wave,chip,fiber=300,waveid=2420038):
     """ convert wavelength to pixel
     Args :
        wavelength - wavelength (\AA)
        chip - chip to use ('a', 'b', or 'c')
-       fiber= (300) fiber to use the wavelength solution of
+       fiber= (300) fiber to use the wavelength solution of, or list of fibers
     Returns :
-       pixel in the chip
+       pixel in the chip, [nfiber,nwave] if a list of fibers is given
     HISTORY:
         2015-02-27 - Written - Bovy (IAS)
     """
-# Load wavelength solutions
-    wave0 =load.apWave(waveid,hdu=2)[0][chip][300-fiber]
-    pix0= numpy.arange(len(wave0))
-    # Need to sort into ascending order
-    sindx= numpy.argsort(wave0)
-    wave0= wave0[sindx]
-    pix0= pix0[sindx]
-    # Start from a linear baseline
-    baseline= numpy.polynomial.Polynomial.fit(wave0,pix0,1)
-    ip= interpolate.InterpolatedUnivariateSpline(wave0,pix0/baseline(wave0),
-                                                 k=3)
+    if numpy.ndim(fiber) > 0 :
+        return numpy.array([wave2pix(wave,chip,fiber=fib,waveid=waveid) for fib in fiber])
+    # Cached wavelength solution
+    (wave0,baseline,ip),p2w= _wavesol(waveid,chip,fiber)
     out= baseline(wave)*ip(wave)
     # NaN for out of bounds
     out[wave > wave0[-1]]= numpy.nan
@@ -416,21 +520,16 @@ def pix2wave(pix,chip,fiber=300,waveid=2420038):
     Args :
        pix - pixel
        chip - chip to use ('a', 'b', or 'c')
-       fiber= (300) fiber to use the wavelength solution of
+       fiber= (300) fiber to use the wavelength solution of, or list of fibers
     Returns :
-       wavelength in \AA
+       wavelength in \AA, [nfiber,npix] if a list of fibers is given
     HISTORY:
         2015-02-27 - Written - Bovy (IAS)
     """
-    wave0 =load.apWave(waveid,hdu=2)[0][chip][300-fiber]
-    pix0= numpy.arange(len(wave0))
-    # Need to sort into ascending order
-    sindx= numpy.argsort(pix0)
-    wave0= wave0[sindx]
-    pix0= pix0[sindx]
-    # Start from a linear baseline
-    baseline= numpy.polynomial.Polynomial.fit(pix0,wave0,1)
-    ip= interpolate.InterpolatedUnivariateSpline(pix0,wave0/baseline(pix0), k=3)
+    if numpy.ndim(fiber) > 0 :
+        return numpy.array([pix2wave(pix,chip,fiber=fib,waveid=waveid) for fib in fiber])
+    # Cached wavelength solution
+    w2p,(baseline,ip)= _wavesol(waveid,chip,fiber)
     out= baseline(pix)*ip(pix)
     # NaN for out of bounds
     out[pix < 0]= numpy.nan
@@ -557,6 +656,75 @@ def test(highres=9.,plot=False):
               plt.draw()
               pdb.set_trace()
 
+def benchmark(ncenter=8575*9,highres=9,horder=4,seed=1) :
+    """ Check that the vectorized _gausshermitebin and _wingsbin reproduce the per-center
+        loop implementation, and time both, for a chip's worth of LSF centers
+
+    Args:
+        ncenter (int) : number of LSF centers (default=8575*9, apStar grid with highres=9)
+        highres (int) : number of subpixels for the pixel offsets (default=9)
+        horder (int) : highest Hermite order (default=4)
+        seed (int) : random seed for the LSF parameters (default=1)
+    Returns :
+        maximum absolute difference between the two implementations
+    """
+    rng= numpy.random.RandomState(seed)
+    x= numpy.tile(numpy.arange(-7.,7.01,1./highres),(ncenter,1))
+    x*= rng.uniform(0.9,1.1,ncenter)[:,numpy.newaxis]
+    ghparams= numpy.empty((horder+2,ncenter))
+    ghparams[0]= rng.uniform(0.8,1.5,ncenter)
+    ghparams[1]= 1./numpy.sqrt(2.*numpy.pi)
+    ghparams[2:]= rng.normal(0.,0.02,(horder,ncenter))
+    wingparams= numpy.array([rng.uniform(0.,0.1,ncenter),rng.uniform(2.,4.,ncenter)])
+    t0= time.time()
+    ref= _gausshermitebin_loop(x,ghparams,1.)+_wingsbin_loop(x,wingparams,1.,1)
+    t1= time.time()
+    out= _gausshermitebin(x,ghparams,1.)+_wingsbin(x,wingparams,1.,1)
+    t2= time.time()
+    diff= numpy.max(numpy.abs(out-ref))
+    print('loop: {:8.2f} s  vectorized: {:8.2f} s  max diff: {:g}'.format(t1-t0,t2-t1,diff))
+    return diff
+
+def _gausshermitebin_loop(x,params,binsize):
+    """ Reference per-center implementation of _gausshermitebin, used by benchmark()
+    """
+    ncenter= params.shape[1]
+    out= numpy.empty((ncenter,x.shape[1]))
+    integ= numpy.empty((params.shape[0]-1,x.shape[1]))
+    for ii in range(ncenter):
+        poly= numpy.polynomial.HermiteE(params[1:,ii])
+        # Convert to regular polynomial basis for easy integration
+        poly= poly.convert(kind=numpy.polynomial.Polynomial)
+        # Integrate and add up
+        w1= (x[ii]-0.5*binsize)/params[0,ii]
+        w2= (x[ii]+0.5*binsize)/params[0,ii]
+        eexp1= numpy.exp(-0.5*w1**2.)
+        eexp2= numpy.exp(-0.5*w2**2.)
+        integ[0]= numpy.sqrt(numpy.pi/2.)\
+            *(special.erf(w2/_SQRTTWO)-special.erf(w1/_SQRTTWO))
+        out[ii]= poly.coef[0]*integ[0]
+        if params.shape[0] > 1:
+            integ[1]= -eexp2+eexp1
+            out[ii]+= poly.coef[1]*integ[1]
+        for jj in range(2,params.shape[0]-1):
+            integ[jj]= (-w2**(jj-1)*eexp2+w1**(jj-1)*eexp1)\
+                +(jj-1)*integ[jj-2]
+            out[ii]+= poly.coef[jj]*integ[jj]
+    return out
+
+def _wingsbin_loop(x,params,binsize,Wproftype):
+    """ Reference per-center implementation of _wingsbin, used by benchmark()
+    """
+    ncenter= params.shape[1]
+    out= numpy.zeros((ncenter,x.shape[1]))
+    for ii in range(ncenter):
+        if Wproftype == 1: # Gaussian
+            w1=(x[ii]-0.5*binsize)/params[1,ii]
+            w2=(x[ii]+0.5*binsize)/params[1,ii]
+            out[ii]= params[0,ii]/2.*(special.erf(w2/_SQRTTWO)\
+                                          -special.erf(w1/_SQRTTWO))
+    return out
+
 def rotate(deltav,vsini,epsilon=0.6) :
     """ rotation kernel from IDL Users library routine
     
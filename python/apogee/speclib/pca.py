@@ -26,7 +26,6 @@ import tempfile
 import multiprocessing as mp
 import numpy as np
 import time
-import struct
 from apogee.aspcap import aspcap
 from apogee.aspcap import ferre
 from apogee.speclib import atmos
@@ -49,7 +48,7 @@ from tools import html
 colors=['r','g','b','c','m','y']
 
 def pca(planfile,dir='kurucz/giantisotopes/tgGK_150714_lsfcombo5',pcas=None,whiten=False,writeraw=False,test=False, 
-        incremental=False, threads=4, rawsynth=False, prefix='',piece=None) :
+        incremental=False, threads=4, rawsynth=False, prefix='',piece=None, maxmem=None) :
     """ Read in grid of spectra and do PCA compression
 
     Args :
@@ -61,8 +60,10 @@ def pca(planfile,dir='kurucz/giantisotopes/tgGK_150714_lsfcombo5',pcas=None,whit
         writeraw (bool ) : output uncompressed grid in FERRE format ? (default=False)
         test (bool) : used abreviated grid for testing (speed) (default=False)
         incremental (bool) : use incremental PCA routline (default=False) (WARNING: if not incremental, default PCA is not perfectly repeatable!)
-        threads (int) : number of threads to use for parallel calculation (default=4), large grids may require threads=0
+        threads (int) : number of threads to use for parallel calculation (default=4), large grids may require threads=0 or maxmem
         rawsynth (bool) : work on raw highres synthesis output (default=False), UNTESTED??
+        maxmem (float) : if given, approximate memory budget (GB) per piece for out-of-core incremental PCA, which streams 
+                         batches of models from the grid rather than loading the whole piece (default=None)
 
     Output: compressed grid in FERRE format
     """
@@ -110,6 +111,7 @@ def pca(planfile,dir='kurucz/giantisotopes/tgGK_150714_lsfcombo5',pcas=None,whit
     indata['rawsynth'] = rawsynth
     indata['prefix'] = prefix
     indata['incremental'] = incremental
+    indata['maxmem'] = maxmem
     for key in ['oa0','doa','noa','am0','dam','nam','cm0','dcm','ncm','nm0','dnm','nnm','vt0','dvt','nvt','mh0','dmh','nmh','logg0','dlogg','nlogg','teff0','dteff','nteff','rot0','drot','nrot'] :
         indata[key] = p[key]
 
@@ -137,6 +139,12 @@ def pca(planfile,dir='kurucz/giantisotopes/tgGK_150714_lsfcombo5',pcas=None,whit
         print(ipiece,w1,w2)
         pars.append((ipiece,indata,[w1,w2]))
 
+    # read the grid once into a memory-mapped file, from which each piece takes its pixels
+    if len(pars) > 0 :
+        showtime('start read:')
+        indata['gridfile'] = outdir+'/'+outfile+'_{:03d}_{:03d}_grid.npy'.format(npiece,npca)
+        loadgrid(indata,gridfile=indata['gridfile'])
+
     if threads == 0 :
         outputs=[]
         for par in pars :
@@ -148,6 +156,9 @@ def pca(planfile,dir='kurucz/giantisotopes/tgGK_150714_lsfcombo5',pcas=None,whit
         outputs = pool.map_async(dopca, pars).get()
         pool.close()
         pool.join()
+    if len(pars) > 0 :
+        os.remove(indata['gridfile'])
+        os.remove(indata['gridfile'].replace('_grid.npy','_gridmean.npy'))
 
     # header file informationfor output files
     wchip=[ [aspcap.nw_chip[0],aspcap.logw0_chip[0],aspcap.dlogw], 
@@ -169,10 +180,10 @@ def pca(planfile,dir='kurucz/giantisotopes/tgGK_150714_lsfcombo5',pcas=None,whit
             npix=w2-w1
             npixels.append(npix)
             if npca > 0 : 
-                feigen=open(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.eigen'.format(npiece,npca,ipiece),'rb')
-                for i in range(npca) : eigen[i,w1:w2] = struct.unpack('f'*npix,feigen.read(npix*4))
-                mean[w1:w2] = struct.unpack('f'*npix,feigen.read(npix*4))
-                feigen.close()
+                feigen=np.fromfile(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.eigen'.format(npiece,npca,ipiece),
+                                   dtype=np.float32).reshape(npca+1,npix)
+                eigen[:,w1:w2] = feigen[0:npca]
+                mean[w1:w2] = feigen[npca]
         #for ipiece,output in enumerate(outputs) :
         #    wrange=pars[ipiece][2]
         #    eigen[:,wrange[0]:wrange[1]] = output[0]
@@ -189,34 +200,100 @@ def pca(planfile,dir='kurucz/giantisotopes/tgGK_150714_lsfcombo5',pcas=None,whit
         # bundle the component files into a single file
         allpca=open('p_aps'+outfile+'_{:03d}_{:03d}.unf'.format(npiece,npca),'wb')
 
-    if npca > 0 : fpca=[]
     if writeraw: 
         ferre.wrhead(p,'f_aps'+outfile+'.hdr',npix=nwave,wchip=wchip,cont=cont)
         allraw=open('f_aps'+outfile+'.unf','wb')
-        fraw=[]
+
+    # interleave the pieces for each model, a block of models at a time
+    fpca=[]
+    fraw=[]
     for ipiece in range(npiece) :
-        if writeraw: fraw.append(open(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.raw'.format(npiece,npca,ipiece),'rb'))
-        if npca > 0 : fpca.append(open(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.pca'.format(npiece,npca,ipiece),'rb'))
-    for i in range(nmod) :
-        for ipiece in range(npiece) :
-            w1=ipiece*nspec
-            w2=(ipiece+1)*nspec if ipiece < npiece -1 else nwave
-            npix=w2-w1
-            if npca > 0 : pca=fpca[ipiece].read(npca*4)
-            if npca > 0 : allpca.write(pca)
-            if writeraw: 
-                raw=fraw[ipiece].read(npix*4)
-                allraw.write(raw)
+        w1=ipiece*nspec
+        w2=(ipiece+1)*nspec if ipiece < npiece -1 else nwave
+        npix=w2-w1
+        if writeraw: fraw.append(np.memmap(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.raw'.format(npiece,npca,ipiece),
+                                           dtype=np.float32,mode='r',shape=(nmod,npix)))
+        if npca > 0 : fpca.append(np.memmap(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.pca'.format(npiece,npca,ipiece),
+                                            dtype=np.float32,mode='r',shape=(nmod,npca)))
+    nblock=max(1,int(2**26/(nwave*4)))
+    for i1 in range(0,nmod,nblock) :
+        i2=min(i1+nblock,nmod)
+        if npca > 0 : np.concatenate([f[i1:i2] for f in fpca],axis=1).tofile(allpca)
+        if writeraw: np.concatenate([f[i1:i2] for f in fraw],axis=1).tofile(allraw)
     if npca > 0 : allpca.close()
     if writeraw: allraw.close()
+    del fpca, fraw
     for ipiece in range(npiece) :
         if npca > 0 : 
-            fpca[ipiece].close()
             os.remove(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.pca'.format(npiece,npca,ipiece))
         if writeraw: 
-            fraw[ipiece].close()
             os.remove(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.raw'.format(npiece,npca,ipiece))
 
+def gridfiles(p) :
+    """ Return list of grid files, in model order, with their (am,cm,nm,vm/oa) labels
+
+    Args:
+        p : dictionary with grid parameters
+    """
+    files=[]
+    for ioa,oa in enumerate(spectra.vector(p['oa0'],p['doa'],p['noa'])) :
+     for ivm,vm in enumerate(spectra.vector(p['vt0'],p['dvt'],p['nvt'])) :
+      for icm,cm in enumerate(spectra.vector(p['cm0'],p['dcm'],p['ncm'])) :
+        for inm,nm in enumerate(spectra.vector(p['nm0'],p['dnm'],p['nnm'])) :
+          for iam,am in enumerate(spectra.vector(p['am0'],p['dam'],p['nam'])) :
+            if int(p['noa']) == 1 and int(p['nvt']) >= 1 :
+              file=('a{:s}c{:s}n{:s}v{:s}.fits').format(
+                     atmos.cval(am),atmos.cval(cm),atmos.cval(nm),atmos.cval(10**vm))
+            elif int(p['noa']) > 1 and int(p['nvt']) == 1 :
+              file=('a{:s}c{:s}n{:s}o{:s}.fits').format(
+                     atmos.cval(am),atmos.cval(cm),atmos.cval(nm),atmos.cval(oa))
+            else :
+              file=('a{:s}c{:s}n{:s}.fits').format(
+                     atmos.cval(am),atmos.cval(cm),atmos.cval(nm))
+            files.append((file,(am,cm,nm,vm)))
+    return files
+
+def loadgrid(p,gridfile=None) :
+    """ Read all of the grid files once, packed into ASPCAP pixels, as [nmod,nwave] float32 array
+        and the mean of each model spectrum
+
+    Args:
+        p : dictionary with grid parameters and indir, prefix, rawsynth
+        gridfile (str) : if given, write grid to this .npy file (and means to _gridmean.npy), for memory-mapped use
+
+    Returns:
+        grid, mean : [nmod,nwave] array (memmap if gridfile given), [nmod] array
+    """
+    pix_apstar=aspcap.gridPix()
+    pix_aspcap=aspcap.gridPix(apStar=False)
+    if p['rawsynth']:
+        wave=np.arange(15100.,17000.01,0.05)
+        nwave=len(wave)
+    else :
+        nwave=aspcap.nw_chip.sum()
+
+    files=gridfiles(p)
+    nsub=int(p['nrot'])*int(p['nmh'])*int(p['nlogg'])*int(p['nteff'])
+    if gridfile is None : 
+        grid=np.zeros([len(files)*nsub,nwave],dtype=np.float32)
+    else :
+        grid=np.lib.format.open_memmap(gridfile,mode='w+',dtype=np.float32,shape=(len(files)*nsub,int(nwave)))
+    mean=np.zeros(len(files)*nsub)
+    nmod=0
+    for file,label in files :
+        # read file and pack into ASPCAP grid size
+        sap=fits.open(p['indir']+p['prefix']+file)[0].data
+        sap=sap.reshape((nsub,sap.shape[-1]))
+        for pasp,pap in zip(pix_aspcap,pix_apstar) :
+            grid[nmod:nmod+nsub,pasp[0]:pasp[1]]=sap[:,pap[0]:pap[1]]
+        mean[nmod:nmod+nsub]=np.nanmean(grid[nmod:nmod+nsub].astype(np.float64),axis=1)
+        nmod+=nsub
+        del sap
+    if gridfile is not None :
+        grid.flush()
+        np.save(gridfile.replace('_grid.npy','_gridmean.npy'),mean)
+    return grid,mean
+
 def dopca(pars) :
     """ do a single PCA decomposition for a limited number of pixels
 
@@ -241,69 +318,61 @@ def dopca(pars) :
     rawsynth=p['rawsynth']
     prefix=p['prefix']
 
-    if p['incremental'] :
+    if p.get('maxmem') is not None :
+        print('using out-of-core incremental PCA')
+        pca = IncrementalPCA(n_components=npca,whiten=whiten)
+    elif p['incremental'] :
         print('using incremental PCA')
         pca = IncrementalPCA(n_components=npca,whiten=whiten,batch_size=1000)
     else :
         pca = PCA(n_components=npca,whiten=whiten)
 
-    # load data for this piece
-    pcadata=np.zeros([int(p['noa'])*int(p['nam'])*int(p['ncm'])*int(p['nnm'])*int(p['nvt'])*
-                      int(p['nrot'])*int(p['nmh'])*int(p['nlogg'])*int(p['nteff']),npix],dtype=np.float32)
-    nmod=0
-    pix_apstar=aspcap.gridPix()
-    pix_aspcap=aspcap.gridPix(apStar=False)
-    if rawsynth:
-        wave=np.arange(15100.,17000.01,0.05)
-        nwave=len(wave)
+    # get grid, memory-mapped if it has already been read, otherwise read it into a
+    #   temporary memory-mapped file for this piece, so the full grid is never held in memory
+    gridfile=p.get('gridfile')
+    if gridfile is None :
+        gridfile=outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}_grid.npy'.format(npiece,npca,ipiece)
+        loadgrid(p,gridfile=gridfile)
+    grid=np.load(gridfile,mmap_mode='r')
+    gmean=np.load(gridfile.replace('_grid.npy','_gridmean.npy'))
+    nmod=grid.shape[0]
+
+    # replace zero or NaN models in this piece with 1
+    raw=grid[:,w1:w2]
+    fix=np.where((raw.sum(axis=1,dtype=np.float64) == 0.) | ~np.isfinite(gmean))[0]
+    if len(fix) > 0 :
+        files=gridfiles(p)
+        gmean=gmean.copy()
+        sub=spectra.vector(p['rot0'],p['drot'],p['nrot']),spectra.vector(p['mh0'],p['dmh'],p['nmh']), \
+            spectra.vector(p['logg0'],p['dlogg'],p['nlogg']),spectra.vector(p['teff0'],p['dteff'],p['nteff'])
+        for i in fix :
+            ifile,irot,imh,ilogg,iteff=np.unravel_index(i,(len(files),len(sub[0]),len(sub[1]),len(sub[2]),len(sub[3])))
+            am,cm,nm,vm=files[ifile][1]
+            print('!!ZERO or NaN MODEL',am,cm,nm,vm,sub[0][irot],sub[1][imh],sub[2][ilogg],sub[3][iteff],w1,w2)
+            s=grid[i].astype(np.float64)
+            s[w1:w2]=1.
+            gmean[i]=np.nanmean(s)
+
+    # normalized data for this piece, either all at once, or in batches of models within memory budget
+    #   (each batch takes ~3 copies, input and sklearn internal)
+    if p.get('maxmem') is None :
+        batches=[np.arange(nmod)]
+        pcadata=normdata(raw,gmean,fix,0,nmod)
     else :
-        nwave=aspcap.nw_chip.sum()
-
-    for ioa,oa in enumerate(spectra.vector(p['oa0'],p['doa'],p['noa'])) :
-     for ivm,vm in enumerate(spectra.vector(p['vt0'],p['dvt'],p['nvt'])) :
-      for icm,cm in enumerate(spectra.vector(p['cm0'],p['dcm'],p['ncm'])) :
-        for inm,nm in enumerate(spectra.vector(p['nm0'],p['dnm'],p['nnm'])) :
-          for iam,am in enumerate(spectra.vector(p['am0'],p['dam'],p['nam'])) :
-            if int(p['noa']) == 1 and int(p['nvt']) >= 1 :
-              file=('a{:s}c{:s}n{:s}v{:s}.fits').format(
-                     atmos.cval(am),atmos.cval(cm),atmos.cval(nm),atmos.cval(10**vm))
-            elif int(p['noa']) > 1 and int(p['nvt']) == 1 :
-              file=('a{:s}c{:s}n{:s}o{:s}.fits').format(
-                     atmos.cval(am),atmos.cval(cm),atmos.cval(nm),atmos.cval(oa))
-            else :
-              file=('a{:s}c{:s}n{:s}.fits').format(
-                     atmos.cval(am),atmos.cval(cm),atmos.cval(nm))
-            # read file and pack into ASPCAP grid size
-            sap=fits.open(indir+prefix+file)[0].data
-            sap=sap.reshape((int(p['nrot']),int(p['nmh']),int(p['nlogg']),int(p['nteff']),sap.shape[-1]))
-            s=np.zeros([int(p['nrot']),int(p['nmh']),int(p['nlogg']),int(p['nteff']),nwave])
-            for pasp,pap in zip(pix_aspcap,pix_apstar) :
-                s[:,:,:,:,pasp[0]:pasp[1]]=sap[:,:,:,:,pap[0]:pap[1]]
-            #s1=fits.open(indir+file)[1].data
-            #s2=fits.open(indir+file)[2].data
-            #s3=fits.open(indir+file)[3].data
-            for irot,rot in enumerate(spectra.vector(p['rot0'],p['drot'],p['nrot'])) :
-             for imh,mh in enumerate(spectra.vector(p['mh0'],p['dmh'],p['nmh'])) :
-              for ilogg,logg in enumerate(spectra.vector(p['logg0'],p['dlogg'],p['nlogg'])) :
-                for iteff,teff in enumerate(spectra.vector(p['teff0'],p['dteff'],p['nteff'])) :
-                  #s=np.append(s1[imh,ilogg,iteff,:],s2[imh,ilogg,iteff,:])
-                  #s=np.append(s,s3[imh,ilogg,iteff,:])
-                  #s=sall[imh,ilogg,iteff,:]
-                  if s[irot,imh,ilogg,iteff,w1:w2].sum() == 0. or not np.isfinite(np.nanmean(s[irot,imh,ilogg,iteff,:]))  : 
-                     print('!!ZERO or NaN MODEL',am,cm,nm,vm,rot,mh,logg,teff,w1,w2)
-                     s[irot,imh,ilogg,iteff,w1:w2] = 1.
-            #      s/=np.nanmean(s)
-            #      if len(np.where(np.isfinite(s) is False)[0]) > 0 : print(imh,ilogg,iteff,np.where(np.isfinite(s) is False) )
-                  pcadata[nmod,:] = s[irot,imh,ilogg,iteff,w1:w2]/np.nanmean(s[irot,imh,ilogg,iteff,:])
-                  nmod+=1
-      #del s1, s2, s3, s
-    del s
+        nbatch=max(npca,int(p['maxmem']*1.e9/(npix*4*3)))
+        # every batch needs at least nbatch >= npca models for partial_fit
+        batches=np.array_split(np.arange(nmod),max(1,nmod//nbatch))
+        print('{:d} batches of {:d} models'.format(len(batches),len(batches[0])))
+        pcadata=None
 
     # do the PCA decomposition 
     if npca > 0 :
-        print(pcadata.shape)
         showtime('start pca: '+str(ipiece))
-        model=pca.fit_transform(pcadata)
+        if pcadata is not None :
+            print(pcadata.shape)
+            model=pca.fit_transform(pcadata)
+        else :
+            for batch in batches : pca.partial_fit(normdata(raw,gmean,fix,batch[0],batch[-1]+1))
         print(pca.explained_variance_ratio_)
         eigen = pca.components_
         mean = pca.mean_
@@ -317,19 +386,44 @@ def dopca(pars) :
     if npca > 0 : 
         fpca=open(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.pca'.format(npiece,npca,ipiece),'wb')
         feigen=open(outdir+'/'+outfile+'_{:03d}_{:03d}_{:03d}.eigen'.format(npiece,npca,ipiece),'wb')
-        for i in range(npca) : feigen.write(struct.pack('f'*npix,*eigen[i,:]))
-        feigen.write(struct.pack('f'*npix,*mean))
+        np.append(eigen,mean.reshape((1,npix)),axis=0).astype(np.float32).tofile(feigen)
         feigen.close()
-    for i in range(nmod) :
-        if writeraw: fraw.write(struct.pack('f'*npix,*pcadata[i,:]))
-        if npca > 0 : fpca.write(struct.pack('f'*npca,*model[i,:]))
+    if pcadata is not None :
+        if npca > 0 : model.astype(np.float32).tofile(fpca)
+        if writeraw: pcadata.tofile(fraw)
+    else :
+        for batch in batches :
+            data=normdata(raw,gmean,fix,batch[0],batch[-1]+1)
+            if npca > 0 : pca.transform(data).astype(np.float32).tofile(fpca)
+            if writeraw: data.tofile(fraw)
     if writeraw: fraw.close()
     if npca > 0 : fpca.close()
     showtime('done piece: '+str(ipiece))
     del pca 
-    del pcadata
+    del pcadata, raw, grid
+    if p.get('gridfile') is None :
+        os.remove(gridfile)
+        os.remove(gridfile.replace('_grid.npy','_gridmean.npy'))
     return eigen,mean
 
+def normdata(raw,gmean,fix,i1,i2) :
+    """ Return normalized spectra of models i1:i2 for a piece, with zero or NaN models set to 1
+
+    Args:
+        raw : [nmod,npix] (memory-mapped) pixels of the piece
+        gmean : [nmod] normalization of each model
+        fix : indices of zero or NaN models
+        i1, i2 : range of models to return
+    """
+    out=np.zeros([i2-i1,raw.shape[1]],dtype=np.float32)
+    nblock=max(1,int(2**26/(raw.shape[1]*8)))
+    for j1 in range(i1,i2,nblock) :
+        j2=min(j1+nblock,i2)
+        out[j1-i1:j2-i1]=raw[j1:j2]/gmean[j1:j2,np.newaxis]
+    j=fix[(fix >= i1) & (fix < i2)]
+    out[j-i1]=1./gmean[j,np.newaxis]
+    return out
+
 def showtime(string) :
     """ Utiltiy routine to print a string and clock time
     """
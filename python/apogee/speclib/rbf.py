@@ -2,9 +2,12 @@ from __future__ import print_function
 
 import os
 import pdb
+import collections
 import numpy as np
 import multiprocessing as mp
 import subprocess
+from scipy import linalg
+from scipy.spatial import distance
 from astropy.io import fits
 from sdss import yanny
 from apogee.speclib import atmos
@@ -16,8 +19,9 @@ import matplotlib.pyplot as plt
 
 def fill(planfile='tgGK_180625.par',dir='marcs/giantisotopes/tgGK_180625',
          cmrange=None, nmrange=None, vtrange=None,grid='GK',
-         apstar=False,threads=30,fakehole=False,out='rbf_',r0=1.0) :
-    """ routine to fill grid holes using RBF interpolation routine from Szabolcs
+         apstar=False,threads=30,fakehole=False,out='rbf_',r0=1.0,external=False) :
+    """ routine to fill grid holes using RBF interpolation, either in-process (default) or
+        with the external rbf routine from Szabolcs (external=True)
     """
 
     # Read planfile and set output file name
@@ -131,7 +135,7 @@ def fill(planfile='tgGK_180625.par',dir='marcs/giantisotopes/tgGK_180625',
                  name = out+'c{:s}n{:s}v{:s}_{:02d}'.format(atmos.cval(cm),atmos.cval(nm),atmos.cval(vt),npars)
                  print(name,am1,am2,mh1,mh2,logg1,logg2,teff2,teff2,hcm,ham1,ham2,hmh1,hmh2,hlogg1,hlogg2,hteff1,hteff2)
                  pars.append((name,r0,data[am1:am2,mh1:mh2,logg1:logg2,teff1:teff2,:],
-                              np.squeeze(holes.data[hcm,ham1:ham2,hmh1:hmh2,hlogg1:hlogg2,hteff1:hteff2])))
+                              np.squeeze(holes.data[hcm,ham1:ham2,hmh1:hmh2,hlogg1:hlogg2,hteff1:hteff2]),external))
                  npars+=1
                  steff+=nteff
                slogg+=nlogg
@@ -232,7 +236,8 @@ def subgrid(n) :
         pdb.set_trace()
 
 def dorbf(pars) :
-    """ Routine that actually does one RBF interpolation
+    """ Routine that actually does one RBF interpolation, with input (name,r0,data,holes[,external])
+        If external, use the external rbf routine, otherwise interpolate in-process with rbfinterp
     """
 
     # input
@@ -240,8 +245,11 @@ def dorbf(pars) :
     r0=pars[1]
     data=pars[2]
     holes=pars[3]
+    external=pars[4] if len(pars) > 4 else True
     ndim=data.shape
 
+    if not external : return rbfinterp(name,r0,data,holes)
+
     # do the rbf for this subgrid 
     print('doing rbf',name,ndim,holes.shape)
 
@@ -320,6 +328,77 @@ def dorbf(pars) :
     os.remove(name+'_hole.dat.filled')
     return data, holes
 
+# cache of RBF factorizations, keyed by subgrid geometry (good/hole points) and r0
+_RBFCACHE=collections.OrderedDict()
+_RBFCACHESIZE=16
+
+def rbfinterp(name,r0,data,holes) :
+    """ In-process version of dorbf: fill holes in a subgrid using multiquadric RBF interpolation
+        in the normalized [0,1] grid coordinates, using all good spectra as nodes and all
+        wavelengths as multiple right hand sides of a single (cached) factorization
+
+    Args:
+        name : name of subgrid, for messages
+        r0 : multiquadric scale, phi(r) = sqrt(r**2+r0**2)
+        data : [nam,nmh,nlogg,nteff,nfreq] subgrid of spectra, modified in place (good spectra normalized, holes filled)
+        holes : [nam,nmh,nlogg,nteff] hole distances (>0 for holes), modified in place
+
+    Returns:
+        data, holes
+    """
+    ndim=data.shape
+    nd=len(ndim)-1
+    print('doing rbf',name,ndim,holes.shape)
+
+    # coordinates and spectra of all points in subgrid
+    idx=tuple(np.indices(ndim[:-1]).reshape(nd,-1))
+    x=np.array(idx,dtype=float).T/np.maximum(np.array(ndim[:-1])-1.,1.)
+    spec=data[idx]
+    dist=holes[idx]
+    synhole=spec.sum(axis=1) == 0
+    hole=(dist > 0) & ~synhole
+    good=np.where(~(synhole|hole))[0]
+    bad=np.where(synhole|hole)[0]
+    print('ngood, nsynhole, nhole: ', len(good),synhole.sum(),hole.sum())
+
+    # normalize good spectra
+    spec[good]/=np.nanmean(spec[good],axis=1)[:,None]
+    data[idx]=spec
+
+    # if no holes, return original data
+    if len(bad) == 0 : return data, holes
+    if len(good) == 0 :
+        print("failed to fill holes")
+        data[tuple(i[bad] for i in idx)]=0.
+        return data, holes
+
+    # factorization of RBF system for these nodes, augmented with a constant term
+    key=(x[good].tobytes(),float(r0))
+    try :
+        _RBFCACHE.move_to_end(key)
+        lu=_RBFCACHE[key]
+    except KeyError :
+        ngood=len(good)
+        a=np.ones([ngood+1,ngood+1])
+        a[:ngood,:ngood]=np.sqrt(distance.cdist(x[good],x[good],'sqeuclidean')+r0**2)
+        a[ngood,ngood]=0.
+        lu=linalg.lu_factor(a)
+        _RBFCACHE[key]=lu
+        while len(_RBFCACHE) > _RBFCACHESIZE : _RBFCACHE.popitem(last=False)
+
+    # solve for weights for all wavelengths at once, and evaluate at holes
+    rhs=np.zeros([len(good)+1,ndim[-1]])
+    rhs[:-1]=spec[good]
+    w=linalg.lu_solve(lu,rhs)
+    k=np.sqrt(distance.cdist(x[bad],x[good],'sqeuclidean')+r0**2)
+    filled=k.dot(w[:-1])+w[-1]
+
+    # replace holes, and flag them
+    ibad=tuple(i[bad] for i in idx)
+    data[ibad]=filled
+    holes[ibad]=np.where(dist[bad] > 0,-1.*dist[bad],-100.)
+    return data, holes
+
 def comp(planfile='tgGK_180625.par',dir='marcs/giantisotopes/tgGK_180625',grid='GK',fakehole=False,
          cmrange=None, nmrange=None, vtrange=None, apstar=False, hard=None,out='rbf_') :
 
@@ -463,15 +463,20 @@ def get_vmicro(vmicrofit,vmicro,teff=None,logg=None,mh=None) :
         pdb.set_trace()
     return vm
 
-def mkgrid(planfile,clobber=False,save=False,run=True) :
+def mkgrid(planfile,clobber=False,save=False,run=True,threads=1) :
     """ Create a grid of synthetic spectra using Turbospectrum given specifications in  input parameter file
         Outputs results in FITS file
 
+        Successfully completed grid points are recorded in a {name}.manifest file, with their spectra in {name}_points/,
+        so an interrupted run resumes from the last completed grid point (failed points are rerun); these are removed
+        when the grid is done
+
     Args :
         planfile (str) : name of input Yanny planfile with grid specifications
-        clobber ( bool ) : skip trying to use previously saved syntheses (by [M/H]) (default = False)
+        clobber ( bool ) : skip trying to use previously saved syntheses (default = False)
         save (bool) :  save all temporary files for syntheses (default = False)
         run (bool)  : actually run syntheses (default = True)
+        threads (int) : number of parallel processes for grid points (default = 1)
     """
 
     # Read planfile
@@ -530,6 +535,10 @@ def mkgrid(planfile,clobber=False,save=False,run=True) :
         #pixels=[[0,nspec]]
 
     # make the grid(s)
+    dskip = 1 if kurucz else 2
+    kwargs={'wrange':wrange,'dw':dw,'atmosdir':marcsdir,'elemgrid':elem,'linelistdir':linelistdir+'/'+elem+'/',
+            'linelist':linelist,'solarisotopes':solarisotopes,'kurucz':kurucz,'run':run,'save':save}
+    outfile=specdir+'/'+p['name']+elem+'.fits'
     for oa in prange(oa0,doa,noa) :
      for am in prange(p['am0'],p['dam'],p['nam']) :
       if enhanced_o : oa = [('O',2*am)]
@@ -538,13 +547,18 @@ def mkgrid(planfile,clobber=False,save=False,run=True) :
         for nm in prange(p['nm0'],p['dnm'],p['nnm']) :
           specdata=np.zeros([nelem,int(p['nmh']),int(p['nlogg']),int(p['nteff']),nspec],dtype=np.float32)
           specnormdata=np.zeros([nelem,int(p['nmh']),int(p['nlogg']),int(p['nteff']),nspec],dtype=np.int16)
-          # allow for restart after certain number of [M/H] have been completed
+          # grid points completed by a previous run are recorded in a manifest, with the
+          # spectra for each point saved in a separate file
+          manifest=specdir+'/'+p['name']+elem+'.manifest'
+          pointdir=specdir+'/'+p['name']+elem+'_points'
           if clobber :
               nmh = 0
+              if os.path.exists(manifest) : os.remove(manifest)
+              if os.path.exists(pointdir) : shutil.rmtree(pointdir)
           else :
               try :
                   # does output file exist?
-                  old=fits.open(specdir+'/'+p['name']+elem+'.fits')[0]
+                  old=fits.open(outfile)[0]
                   specdata=old.data
                   if len(old.shape) < 5 : specdata=np.expand_dims(specdata,axis=0)
                   # is it a partially completed file with nmh card, or a completed file?
@@ -557,96 +571,156 @@ def mkgrid(planfile,clobber=False,save=False,run=True) :
                       return
               except :
                   nmh = 0
+          try: os.makedirs(pointdir)
+          except: pass
+          done = mkgrid_manifest(manifest)
+          tasks=[]
           for imh,mh in enumerate(prange(p['mh0'],p['dmh'],p['nmh'])) :
-           if imh >= nmh :
             for ilogg,logg in enumerate(prange(p['logg0'],p['dlogg'],p['nlogg'])) :
               for iteff,teff in enumerate(prange(p['teff0'],p['dteff'],p['nteff'])) :
-
-                print(teff, logg, mh)
-                sys.stdout.flush()
-                nskip=0 
-                dskip = 1 if kurucz else 2
+                if imh < nmh : continue
+                if (imh,ilogg,iteff) in done :
+                    point=np.load(pointdir+'/{:d}_{:d}_{:d}.npz'.format(imh,ilogg,iteff))
+                    specdata[:,imh,ilogg,iteff,:]=point['spec']
+                    specnormdata[:,imh,ilogg,iteff,:]=point['specnorm']
+                    continue
                 vout = get_vmicro(vmicrofit,vmicro,teff=teff,logg=logg,mh=mh)
-                print(teff,logg,mh,am,cm,nm,oa,vout)
-                while nskip >= 0 and nskip < 10 :
-                  spec,specnorm=mkturbospec(int(teff),logg,mh,am,cm,nm,els=oa,
-                    wrange=wrange,dw=dw,atmosdir=marcsdir,
-                    elemgrid=elem,linelistdir=linelistdir+'/'+elem+'/',linelist=linelist,vmicro=vout,
-                    solarisotopes=solarisotopes,
-                    nskip=nskip,kurucz=kurucz,run=run,save=save) 
-                  nskip = nskip+dskip if isinstance(spec,float) else -1
-                if nskip > 0 : 
-                    print('FAILED Turbospec',nskip)
-                    fail('failed Turbospec convergence: {:8d} {:8.2f} {:8.2f} {:8.2f}  {:8.2f} {:8.2f} {:8.2f} {:d}'.format(
-                               int(teff),logg,mh,am,cm,nm,vout,nskip))
-                try:
-                    if elem == '' :
-                        specdata[0,imh,ilogg,iteff,:]=spec
-                        specnormdata[0,imh,ilogg,iteff,:]=np.round((specnorm-0.5)*65534.).astype(int)
-                    else :
-                        specdata[:,imh,ilogg,iteff,:]=spec[:,gdspec]
-                        specnormdata[:,imh,ilogg,iteff,:]=np.round((specnorm[:,gdspec]-0.5)*65534).astype(int)
-                except :
-                    print(specdata.shape)
-                    specdata[:,imh,ilogg,iteff,:]=0.
-                    specnormdata[:,imh,ilogg,iteff,:]=-32767
-                    try: lspec=len(spec)
-                    except: lspec=1
-                    fail('error loading specdata: {:8d} {:8.2f} {:8.2f} {:8.2f}  {:8.2f} {:8.2f} {:8.2f} {:d}'.format(
-                               int(teff),logg,mh,am,cm,nm,vout,lspec))
-
-            # FITS header and output after each metallicity subgrid
-            # for minigrids, each section is output in a separate HDU
-            p1=0
-            hdulist=fits.HDUList()
-            for iwind in range(nwind) :
-                p2 = p1 + pixels[iwind][1]-pixels[iwind][0]
-                print(iwind,p1,p2)
-                if iwind == 0 :
-                    hdu=fits.PrimaryHDU(np.squeeze(specdata[:,:,:,:,p1:p2]))
-                else :
-                    hdu=fits.ImageHDU(np.squeeze(specdata[:,:,:,:,p1:p2]))
-                p1 += pixels[iwind][1]-pixels[iwind][0]
-                idim=1
-                # for elem with all waves, use next line and comment out following 7
-                #spectra.add_dim(hdu.header,rawwave[0],rawwave[1]-rawwave[0],1,'WAVELENGTH',idim)
+                tasks.append(((imh,ilogg,iteff),(int(teff),logg,mh,am,cm,nm),oa,vout,dskip,kwargs))
+          print('grid points to run: {:d}, already done: {:d}'.format(len(tasks),len(done)))
+
+          if threads > 1 :
+              pool = mp.Pool(threads)
+              results = pool.imap_unordered(mkgridpoint, tasks)
+          else :
+              results = map(mkgridpoint, tasks)
+          for (imh,ilogg,iteff),pars,vout,spec,specnorm,nskip in results :
+            teff,logg,mh,am,cm,nm = pars
+            # only successful points are recorded as done, so failures are retried on restart
+            ok = nskip <= 0
+            if nskip > 0 : 
+                print('FAILED Turbospec',nskip)
+                fail('failed Turbospec convergence: {:8d} {:8.2f} {:8.2f} {:8.2f}  {:8.2f} {:8.2f} {:8.2f} {:d}'.format(
+                           int(teff),logg,mh,am,cm,nm,vout,nskip))
+            try:
                 if elem == '' :
-                    spectra.add_dim(hdu.header,rawwave[0],rawwave[1]-rawwave[0],1,'WAVELENGTH',idim)
+                    specdata[0,imh,ilogg,iteff,:]=spec
+                    specnormdata[0,imh,ilogg,iteff,:]=np.round((specnorm-0.5)*65534.).astype(int)
                 else :
-                    hdu.header.append(('ELEM',elem))
-                    gd = np.where( (rawwave >= wair[iwind,0]) & (rawwave <= wair[iwind,1]) )[0]
-                    spectra.add_dim(hdu.header,rawwave[gd[0]],rawwave[1]-rawwave[0],1,'WAVELENGTH',idim)
-                    hdu.header.append(('CDELT1',rawwave[1]-rawwave[0]))
-                if int(p['nteff']) > 1 :
-                    idim+=1
-                    spectra.add_dim(hdu.header,float(p['teff0']),float(p['dteff']),1,'TEFF',idim)
-                if int(p['nlogg']) > 1 :
-                    idim+=1
-                    spectra.add_dim(hdu.header,float(p['logg0']),float(p['dlogg']),1,'LOGG',idim)
-                if int(p['nmh']) > 1 :
-                    idim+=1
-                    spectra.add_dim(hdu.header,float(p['mh0']),float(p['dmh']),1,'M_H',idim)
-                if elem != '' :
-                    idim+=1
-                    spectra.add_dim(hdu.header,-0.75,0.25,1,elem,idim)
-                hdu.header['LOGW'] = 0
-                if p.get('width') : hdu.header['width'] = p['width']
-                if p.get('linelist') : hdu.header['linelist'] = p['linelist']
-                if p['synthcode'] == 'asset'  : hdu.header.add_comment('ASSET generated synthetic spectra')
-                if p['synthcode'] == 'turbospec' : hdu.header.add_comment('Turbospec generated synthetic spectra')
-                if p['synthcode'] == 'moog ' : hdu.header.add_comment('MOOG generated synthetic spectra')
-                hdu.header.add_comment('APOGEE_VER:'+os.environ['APOGEE_VER'])
-                # following card for partial completion output
-                if imh+1 < int(p['nmh']) : hdu.header['nmh'] = imh+1
-                try : os.mkdir(specdir)
-                except: pass
-                hdulist.append(hdu)
-            hdunorm=fits.ImageHDU(np.squeeze(specnormdata))
-            hdunorm.header.extend(hdu.header.copy(strip=True))
-            hdunorm.header['BZERO'] = 0.5
-            hdunorm.header['BSCALE'] = 1./65534.
-            hdulist.append(hdunorm)
-            hdulist.writeto(specdir+'/'+p['name']+elem+'.fits',overwrite=True)
+                    specdata[:,imh,ilogg,iteff,:]=spec[:,gdspec]
+                    specnormdata[:,imh,ilogg,iteff,:]=np.round((specnorm[:,gdspec]-0.5)*65534).astype(int)
+            except :
+                print(specdata.shape)
+                specdata[:,imh,ilogg,iteff,:]=0.
+                specnormdata[:,imh,ilogg,iteff,:]=-32767
+                ok = False
+                try: lspec=len(spec)
+                except: lspec=1
+                fail('error loading specdata: {:8d} {:8.2f} {:8.2f} {:8.2f}  {:8.2f} {:8.2f} {:8.2f} {:d}'.format(
+                           int(teff),logg,mh,am,cm,nm,vout,lspec))
+            if not ok : continue
+            # save the point, then record it as done
+            pointfile=pointdir+'/{:d}_{:d}_{:d}.npz'.format(imh,ilogg,iteff)
+            np.savez(pointfile+'.tmp.npz',spec=specdata[:,imh,ilogg,iteff,:],specnorm=specnormdata[:,imh,ilogg,iteff,:])
+            os.rename(pointfile+'.tmp.npz',pointfile)
+            with open(manifest,'a') as fman :
+                fman.write('{:d} {:d} {:d} {:d}\n'.format(imh,ilogg,iteff,nskip))
+          if threads > 1 :
+              pool.close()
+              pool.join()
+
+          # FITS header and output of the completed subgrid
+          # for minigrids, each section is output in a separate HDU
+          p1=0
+          hdulist=fits.HDUList()
+          for iwind in range(nwind) :
+              p2 = p1 + pixels[iwind][1]-pixels[iwind][0]
+              print(iwind,p1,p2)
+              if iwind == 0 :
+                  hdu=fits.PrimaryHDU(np.squeeze(specdata[:,:,:,:,p1:p2]))
+              else :
+                  hdu=fits.ImageHDU(np.squeeze(specdata[:,:,:,:,p1:p2]))
+              p1 += pixels[iwind][1]-pixels[iwind][0]
+              idim=1
+              # for elem with all waves, use next line and comment out following 7
+              #spectra.add_dim(hdu.header,rawwave[0],rawwave[1]-rawwave[0],1,'WAVELENGTH',idim)
+              if elem == '' :
+                  spectra.add_dim(hdu.header,rawwave[0],rawwave[1]-rawwave[0],1,'WAVELENGTH',idim)
+              else :
+                  hdu.header.append(('ELEM',elem))
+                  gd = np.where( (rawwave >= wair[iwind,0]) & (rawwave <= wair[iwind,1]) )[0]
+                  spectra.add_dim(hdu.header,rawwave[gd[0]],rawwave[1]-rawwave[0],1,'WAVELENGTH',idim)
+                  hdu.header.append(('CDELT1',rawwave[1]-rawwave[0]))
+              if int(p['nteff']) > 1 :
+                  idim+=1
+                  spectra.add_dim(hdu.header,float(p['teff0']),float(p['dteff']),1,'TEFF',idim)
+              if int(p['nlogg']) > 1 :
+                  idim+=1
+                  spectra.add_dim(hdu.header,float(p['logg0']),float(p['dlogg']),1,'LOGG',idim)
+              if int(p['nmh']) > 1 :
+                  idim+=1
+                  spectra.add_dim(hdu.header,float(p['mh0']),float(p['dmh']),1,'M_H',idim)
+              if elem != '' :
+                  idim+=1
+                  spectra.add_dim(hdu.header,-0.75,0.25,1,elem,idim)
+              hdu.header['LOGW'] = 0
+              if p.get('width') : hdu.header['width'] = p['width']
+              if p.get('linelist') : hdu.header['linelist'] = p['linelist']
+              if p['synthcode'] == 'asset'  : hdu.header.add_comment('ASSET generated synthetic spectra')
+              if p['synthcode'] == 'turbospec' : hdu.header.add_comment('Turbospec generated synthetic spectra')
+              if p['synthcode'] == 'moog ' : hdu.header.add_comment('MOOG generated synthetic spectra')
+              hdu.header.add_comment('APOGEE_VER:'+os.environ['APOGEE_VER'])
+              try : os.mkdir(specdir)
+              except: pass
+              hdulist.append(hdu)
+          hdunorm=fits.ImageHDU(np.squeeze(specnormdata))
+          hdunorm.header.extend(hdu.header.copy(strip=True))
+          hdunorm.header['BZERO'] = 0.5
+          hdunorm.header['BSCALE'] = 1./65534.
+          hdulist.append(hdunorm)
+          hdulist.writeto(outfile,overwrite=True)
+          # grid is complete, remove the per-point files
+          os.remove(manifest)
+          shutil.rmtree(pointdir)
+
+def mkgridpoint(task) :
+    """ Runs Turbospectrum for a single grid point, stripping atmosphere layers (nskip) until it converges
+        Used by mkgrid for multi-processor calculations
+
+    Args :
+        task (tuple ) : (grid index, (teff,logg,mh,am,cm,nm), els, vmicro, nskip step, mkturbospec keywords)
+
+    Returns :
+        grid index, parameters, vmicro, spec, specnorm, nskip (-1 if converged)
+    """
+    key,pars,els,vout,dskip,kwargs = task
+    teff,logg,mh,am,cm,nm = pars
+    print(teff,logg,mh,am,cm,nm,els,vout)
+    sys.stdout.flush()
+    nskip=0 
+    while nskip >= 0 and nskip < 10 :
+        spec,specnorm=mkturbospec(int(teff),logg,mh,am,cm,nm,els=els,vmicro=vout,nskip=nskip,**kwargs)
+        nskip = nskip+dskip if isinstance(spec,float) else -1
+    return key,pars,vout,spec,specnorm,nskip
+
+def mkgrid_manifest(manifest) :
+    """ Read the grid points completed by mkgrid from its manifest file
+
+    Args :
+        manifest (str) : name of manifest file
+
+    Returns :
+        set of successfully completed (imh,ilogg,iteff) grid indices
+    """
+    done=set()
+    if not os.path.exists(manifest) : return done
+    for line in open(manifest) :
+        cols=line.split()
+        # skip a partially written last line from an interrupted run
+        if len(cols) != 4 : continue
+        # points that failed to converge (nskip > 0) are not done
+        if int(cols[3]) > 0 : continue
+        done.add((int(cols[0]),int(cols[1]),int(cols[2])))
+    return done
 
 def mkgridlink(planfile,suffix=None) :
     """  DEVELOPMENT : create coarse grid by merging syntheses from multiple grids
@@ -836,7 +910,7 @@ def mkgridlsf(planfile,highres=9,fiber=None,ls=None,apred=None,prefix=None,teles
             nout=smoothdata.shape[-1]
             smoothdata=np.reshape(smoothdata,(nelem,nmh,nlogg,nteff,nout)).astype(np.float32)
         else :
-            smoothdata=np.zeros([nrot,nelem,nmh,nlogg,nteff,nout],dtype=np.float32)
+            smoothdata=None
             for irot,vrot in enumerate(prange(p['rot0'],p['drot'],p['nrot'])) :
                 if kernel == 'rot' :
                     smooth,waveout=lsf.convolve(ws,specdata.data,lsf=ls,xlsf=x,vrot=10.**vrot,vmacro=vmacro)
@@ -845,6 +919,9 @@ def mkgridlsf(planfile,highres=9,fiber=None,ls=None,apred=None,prefix=None,teles
                 else :
                     print('Unknown kernel!')
                     pdb.set_trace()
+                if smoothdata is None :
+                    nout=smooth.shape[-1]
+                    smoothdata=np.zeros([nrot,nelem,nmh,nlogg,nteff,nout],dtype=np.float32)
                 smoothdata[irot,:,:,:,:,:]=np.reshape(smooth,(nelem,nmh,nlogg,nteff,nout)).astype(np.float32)
 
         specdata.data=np.reshape(specdata.data,(nelem,nmh,nlogg,nteff,npix))
@@ -989,17 +1066,18 @@ def mksynth(file,threads=8,highres=9,waveid=2420038,lsfid=5440020,apred='r10',te
     for spec in specs :
         if isinstance(spec[1],np.ndarray) :
           if spec[1].sum() > 0.001 :
-            mh=spec[0][2]
-            vmacro = 10.**(0.470794-0.254*mh)
-            vmacro = vmacro if vmacro<15 else 15.
-            vrot=spec[0][7]
-            if vrot < 0.5 : vrot=None
-            # convolve one at a time because we have different vrot for each
-            z,waveout=lsf.convolve(ws,spec[1],lsf=ls,xlsf=x,vmacro=vmacro,vrot=vrot)
             out.append(spec[1])
-            conv.append(np.squeeze(z))
             outpar.append(spec[0])
-            if plot : plt.plot(wa,np.squeeze(z))
+    if len(out) > 0 :
+        # convolve all at once, the kernels are grouped by vmacro and vrot
+        mh=np.array([par[2] for par in outpar])
+        vmacro = 10.**(0.470794-0.254*mh)
+        vmacro[vmacro>15] = 15.
+        vrot=np.array([par[7] for par in outpar])
+        vrot[vrot<0.5] = 0.
+        conv,waveout=lsf.convolve(ws,np.array(out),lsf=ls,xlsf=x,vmacro=vmacro,vrot=vrot)
+        if plot :
+            for z in conv : plt.plot(wa,z)
 
     # write the spectra out
     hdu=fits.HDUList()
@@ -0,0 +1,32 @@
+# encoding: utf-8
+#
+# test_struct.py
+
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import numpy as np
+from astropy.io import fits
+
+from tools import struct
+
+
+class TestConcat(object):
+    """Tests for the ``concat`` function in tools/struct.py."""
+
+    def test_concat_unsigned(self, tmpdir):
+
+        files = []
+        for i, vals in enumerate([[40000, 5], [65535, 0, 32768]]):
+            cols = [fits.Column(name='U', format='I', bzero=32768, array=np.array(vals, dtype=np.uint16)),
+                    fits.Column(name='ID', format='{:d}A'.format(2+3*i), array=np.array(['x'*(2+3*i)]*len(vals)))]
+            files.append(str(tmpdir.join('tab{:d}.fits'.format(i))))
+            fits.BinTableHDU.from_columns(cols).writeto(files[-1])
+
+        out = struct.concat(files)
+        assert out['U'].dtype == np.uint16
+        assert list(out['U']) == [40000, 5, 65535, 0, 32768]
+        assert list(out['ID']) == [b'xx', b'xx', b'xxxxx', b'xxxxx', b'xxxxx']
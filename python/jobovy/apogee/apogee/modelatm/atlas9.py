@@ -3,13 +3,17 @@
 ###############################################################################
 import os, os.path
 import copy
+import itertools
+import pickle
 import numpy
-from scipy import interpolate, ndimage
-from galpy.util import bovy_plot
+from scipy import interpolate, sparse
+from galpy.util import bovy_plot, save_pickles
 import apogee.tools.path as appath
 import apogee.tools.download as apdownload
 from apogee.util import int_newton_cotes
 _OPSCALE= 'ROSSTAU' # could be 'ROSSTAU' for Rossland optical depth or 'RHOX'
+# Process-wide cache of parsed grid atmospheres, keyed by grid point and dr
+_ATLAS9CACHE= {}
 class Atlas9Atmosphere(object):
     """Atlas9Atmosphere: tools for dealing with ATLAS9 model atmospheres"""
     def __init__(self,teff=4500.,logg=2.5,metals=0.,am=0.,cm=0.,
@@ -238,23 +242,13 @@ class Atlas9Atmosphere(object):
     
     def _loadGridPoint(self):
         """Load the model corresponding to this grid point"""
-        filePath= appath.modelAtmospherePath(lib='kurucz_filled',
-                                             teff=self._teff,logg=self._logg,
-                                             metals=self._metals,
-                                             cfe=self._cm,afe=self._am,
-                                             dr=self._dr)
-        # Download if necessary
-        if not os.path.exists(filePath):
-            apdownload.modelAtmosphere(lib='kurucz_filled',
-                                       teff=self._teff,logg=self._logg,
-                                       metals=self._metals,
-                                       cfe=self._cm,afe=self._am,dr=self._dr)
-        atContent= readAtlas9(filePath)
-        # Unpack
-        self._first4lines= atContent[0]
+        atContent= _loadAtlas9(self._teff,self._logg,self._metals,
+                               self._am,self._cm,dr=self._dr)
+        # Unpack, copying what might be changed by this instance
+        self._first4lines= copy.copy(atContent[0])
         self._abscale= atContent[1]
-        self._abchanges= atContent[2]
-        self._deck= atContent[3]
+        self._abchanges= copy.copy(atContent[2])
+        self._deck= numpy.copy(atContent[3])
         self._pradk= atContent[4]
         self._nlayers= self._deck.shape[0]
         return None
@@ -383,14 +377,98 @@ def interpolateAtlas9(teff,logg,metals,am,cm,dr=None,interp_x=_OPSCALE):
        metals - overall metallicity scale
        am - overall alpha enhancement
        cm - carbon enhancement
+       (teff, logg, metals, am, and cm can be arrays, to interpolate many atmospheres at once)
        dr= (None) load model atmospheres from this data release
        interp_x= (might be changed) quantity to use for putting models onto a common opacity scale when interpolating ('ROSSTAU' or 'RHOX')
     OUTPUT:
-       stuff
+       stuff (for array input: list of stuff for each point)
     HISTORY:
        2015-03-20 - Written - Bovy (IAS)
     """
-    # Using simple linear interpolation between the nearest grid points for now
+    scalarOut= numpy.ndim(teff) == 0
+    teff, logg, metals, am, cm= numpy.broadcast_arrays(\
+        numpy.atleast_1d(teff),numpy.atleast_1d(logg),
+        numpy.atleast_1d(metals),numpy.atleast_1d(am),numpy.atleast_1d(cm))
+    # Using simple linear interpolation between the nearest grid points for
+    # now: determine the surrounding models and their weights for each point
+    # and accumulate them into a (npoint,nmodel) weight matrix
+    corners= []
+    first= []
+    decks= []
+    pradks= []
+    modelIndx= {}
+    rows, cols, weights= [], [], []
+    for ii in range(len(teff)):
+        tcorners= _atlas9Corners(teff[ii],logg[ii],metals[ii],am[ii],cm[ii])
+        corners.append(tcorners)
+        first.append(len(cols))
+        if interp_x.lower() == 'rosstau':
+            # All models have the same rossland tau scale, so models can be
+            # shared between points
+            for params, w in tcorners:
+                if not params in modelIndx:
+                    modelIndx[params]= len(decks)
+                    atContent= _loadAtlas9(*params,dr=dr)
+                    decks.append(atContent[3])
+                    pradks.append(atContent[4])
+                rows.append(ii)
+                cols.append(modelIndx[params])
+                weights.append(w)
+        else:
+            # Interpolate each model atmosphere onto a common opacity scale
+            models= [Atlas9Atmosphere(*params,dr=dr) for params, w in tcorners]
+            opmin= numpy.amax([numpy.amin(tatm._deck[:,0]) for tatm in models])
+            opmax= numpy.amin([numpy.amax(tatm._deck[:,0]) for tatm in models])
+            for tatm, (params, w) in zip(models,tcorners):
+                tatm.interpOpacityScale(opmin,opmax)
+                rows.append(ii)
+                cols.append(len(decks))
+                weights.append(w)
+                decks.append(tatm._deck)
+                pradks.append(tatm._pradk)
+    # Now interpolate all layers and columns of all points at once (all models
+    # have the same number of layers)
+    decks= numpy.array(decks)
+    weights= sparse.csr_matrix((weights,(rows,cols)),
+                               shape=(len(teff),len(decks)))
+    newdecks= weights.dot(decks[:,:,:7].reshape((len(decks),-1)))\
+        .reshape((len(teff),decks.shape[1],7))
+    newpradks= weights.dot(numpy.array(pradks))
+    out= []
+    for ii in range(len(teff)):
+        params0= corners[ii][0][0]
+        atContent0= _loadAtlas9(*params0,dr=dr)
+        newdeck= numpy.empty_like(atContent0[3])
+        newdeck[:,:7]= newdecks[ii]
+        # we don't interpolate FLXCNV,VCONV,VELSND
+        newdeck[:,7:]= decks[cols[first[ii]],:,7:]
+        # Fix the abundances; overall scale of metallicity
+        abscale= 10.**metals[ii]
+        # Changes due to [C/M] and [a/M]
+        abchanges= copy.deepcopy(atContent0[2])
+        abchanges[6]+= cm[ii]-params0[4]
+        abchanges[8]+= am[ii]-params0[3]
+        abchanges[12]+= am[ii]-params0[3]
+        abchanges[14]+= am[ii]-params0[3]
+        abchanges[16]+= am[ii]-params0[3]
+        abchanges[20]+= am[ii]-params0[3]
+        abchanges[22]+= am[ii]-params0[3]
+        # Need to change 1 and 2 as well
+        totz= 0.
+        for key in abchanges:
+            if key > 2: totz+= 10.**abchanges[key]
+        totz*= abscale
+        abchanges[1]= atContent0[2][1]\
+            /(atContent0[2][1]+atContent0[2][2])*(1.-totz)
+        abchanges[2]= atContent0[2][2]\
+            /(atContent0[2][1]+atContent0[2][2])*(1.-totz)
+        out.append((copy.copy(atContent0[0]),abscale,abchanges,
+                    newdeck,newpradks[ii]))
+    if scalarOut: return out[0]
+    else: return out
+
+def _atlas9Corners(teff,logg,metals,am,cm):
+    """Return the grid points surrounding a point and their weights for multi-linear interpolation, as a list of ((teff,logg,metals,am,cm),weight)"""
     try:
         # Find the hypercube in the grid that this point lies in
         # Teff
@@ -439,109 +517,80 @@ def interpolateAtlas9(teff,logg,metals,am,cm,dr=None,interp_x=_OPSCALE):
         raise IndexError('Requested model lies outside the grid of model atmospheres')
     # Determine whether any of the parameters is on a grid point
     paramIsGrid= isGridPoint(teff,logg,metals,am,cm,return_indiv=True)
-    # Determine whether to interpolate over this parameter or not (if it's grid)
-    interpGridShape= ()
-    if paramIsGrid[0]:
-        tes= [teff]
-    else:
-        tes= [tefflow,teffhigh]
-        interpGridShape+= (2,)
-    if paramIsGrid[1]:
-        lgs= [logg]
-    else:
-        lgs= [logglow,logghigh]
-        interpGridShape+= (2,)
-    if paramIsGrid[2]:
-        mes= [metals]
-    else:
-        mes= [metalslow,metalshigh]
-        interpGridShape+= (2,)
-    if paramIsGrid[3]:
-        ams= [am]
-    else:
-        ams= [amlow,amhigh]
-        interpGridShape+= (2,)
-    if paramIsGrid[4]:
-        cms= [cm]
-    else:
-        cms= [cmlow,cmhigh]  
-        interpGridShape+= (2,)
-    # Load all of the models surrounding this point, also store the min and
-    # max of the opacity scale that we use to interpolate the models on
-    models= []
-    opmin, opmax= [], []
-    for te in tes:
-        for lg in lgs:
-            for me in mes:
-                for a in ams:
-                    for c in cms:
-                        tatm= Atlas9Atmosphere(te,lg,me,a,c,dr=dr)
-                        models.append(tatm)
-                        if interp_x.lower() == 'rhox':
-                            opmin.append(numpy.amin(tatm._deck[:,0]))
-                            opmax.append(numpy.amax(tatm._deck[:,0]))
-                        elif interp_x.lower() == 'rosstau':
-                            opmin.append(numpy.amin(tatm.rosslandtau))
-                            opmax.append(numpy.amax(tatm.rosslandtau))
-    # Interpolate each model atmosphere onto a common opacity scale, 
-    # if not rosstau (because all models have the same rossland tau scale)
-    if not interp_x.lower() == 'rosstau':
-        opmin= numpy.amax(opmin)
-        opmax= numpy.amin(opmax)
-        for tatm in models:
-            tatm.interpOpacityScale(opmin,opmax)
-    # Now interpolate each layer
-    coord= []
-    if not paramIsGrid[0]: coord.append([(teff-tefflow)/(teffhigh-tefflow)])
-    if not paramIsGrid[1]: coord.append([(logg-logglow)/(logghigh-logglow)])
-    if not paramIsGrid[2]:
-        coord.append([(metals-metalslow)/(metalshigh-metalslow)])
-    if not paramIsGrid[3]: coord.append([(am-amlow)/(amhigh-amlow)])
-    if not paramIsGrid[4]: coord.append([(cm-cmlow)/(cmhigh-cmlow)])
-    newdeck= numpy.zeros_like(models[0]._deck)
-    newdeck[:,7:]= models[0]._deck[:,7:]
-    for ii in range(models[0]._nlayers): # same number of layers
-        for jj in range(7): # we don't interpolate FLXCNV,VCONV,VELSND
-            # Accumulate all models
-            tlayer= numpy.zeros(interpGridShape)
-            cntr= 0
-            while cntr < numpy.prod(interpGridShape):
-                indx= numpy.unravel_index(cntr,interpGridShape)
-                tlayer[indx]= models[cntr]._deck[ii,jj]
-                cntr+= 1
-            newdeck[ii,jj]=\
-                ndimage.interpolation.map_coordinates(tlayer,coord,order=1)
-    # Also interpolate pradk
-    tlayer= numpy.zeros(interpGridShape)
-    cntr= 0
-    while cntr < numpy.prod(interpGridShape):
-        indx= numpy.unravel_index(cntr,interpGridShape)
-        tlayer[indx]= models[cntr]._pradk
-        cntr+= 1
-    pradk=\
-        ndimage.interpolation.map_coordinates(tlayer,coord,order=1)
-    # Fix the abundances; overall scale of metallicity
-    abscale= 10.**metals
-    # Changes due to [C/M] and [a/M]
-    abchanges= copy.deepcopy(models[0]._abchanges)
-    abchanges[6]+= cm-cms[0]
-    abchanges[8]+= am-ams[0]
-    abchanges[12]+= am-ams[0]
-    abchanges[14]+= am-ams[0]
-    abchanges[16]+= am-ams[0]
-    abchanges[20]+= am-ams[0]
-    abchanges[22]+= am-ams[0]
-    # Need to change 1 and 2 as well
-    totz= 0.
-    for key in abchanges:
-        if key > 2: totz+= 10.**abchanges[key]
-    totz*= abscale
-    abchanges[1]= models[0]._abchanges[1]\
-        /(models[0]._abchanges[1]+models[0]._abchanges[2])*(1.-totz)
-    abchanges[2]= models[0]._abchanges[2]\
-        /(models[0]._abchanges[1]+models[0]._abchanges[2])*(1.-totz)
-    return (models[0]._first4lines,abscale,abchanges,
-            newdeck,pradk)
+    # Determine whether to interpolate over this parameter or not (if it's
+    # grid), and the weights of the low and high grid points
+    dims= []
+    for isGrid, x, low, high in zip(paramIsGrid,
+                                    [teff,logg,metals,am,cm],
+                                    [tefflow,logglow,metalslow,amlow,cmlow],
+                                    [teffhigh,logghigh,metalshigh,amhigh,
+                                     cmhigh]):
+        if isGrid:
+            dims.append([(x,1.)])
+        else:
+            frac= (x-low)/(high-low)
+            dims.append([(low,1.-frac),(high,frac)])
+    return [(tuple([float(d[0]) for d in corner]),
+             numpy.prod([d[1] for d in corner]))
+            for corner in itertools.product(*dims)]
+
+def _loadAtlas9(teff,logg,metals,am,cm,dr=None):
+    """Return the content of the ATLAS9 model at a grid point, from the cache if possible (do not change the returned content)"""
+    key= (teff,logg,metals,am,cm,'current' if dr is None else dr)
+    if key in _ATLAS9CACHE: return _ATLAS9CACHE[key]
+    filePath= appath.modelAtmospherePath(lib='kurucz_filled',
+                                         teff=teff,logg=logg,metals=metals,
+                                         cfe=cm,afe=am,dr=dr)
+    # Download if necessary
+    if not os.path.exists(filePath):
+        apdownload.modelAtmosphere(lib='kurucz_filled',
+                                   teff=teff,logg=logg,metals=metals,
+                                   cfe=cm,afe=am,dr=dr)
+    _ATLAS9CACHE[key]= readAtlas9(filePath)
+    return _ATLAS9CACHE[key]
+
+def saveAtlas9Cache(filename):
+    """
+    NAME:
+       saveAtlas9Cache
+    PURPOSE:
+       save the cache of ATLAS9 grid atmospheres loaded so far to a binary file
+    INPUT:
+       filename - name of the file
+    OUTPUT:
+       (none; just writes the file)
+    """
+    save_pickles(filename,_ATLAS9CACHE)
+    return None
+
+def loadAtlas9Cache(filename):
+    """
+    NAME:
+       loadAtlas9Cache
+    PURPOSE:
+       load ATLAS9 grid atmospheres saved with saveAtlas9Cache into the cache, such that they do not need to be read from the grid files
+    INPUT:
+       filename - name of the file
+    OUTPUT:
+       (none; just updates the cache)
+    """
+    with open(filename,'rb') as savefile:
+        _ATLAS9CACHE.update(pickle.load(savefile))
+    return None
+
+def clearAtlas9Cache():
+    """
+    NAME:
+       clearAtlas9Cache
+    PURPOSE:
+       clear the cache of ATLAS9 grid atmospheres
+    INPUT:
+       (none)
+    OUTPUT:
+       (none)
+    """
+    _ATLAS9CACHE.clear()
+    return None
 
 def readAtlas9(filePath):
     """
@@ -573,12 +622,12 @@ def readAtlas9(filePath):
                     float(split[abchangeIndex+2+2*ii])
             line= modfile.readline()
         # Now read the deck, ignore the READ DECK6 line
-        line= modfile.readline()
-        deck= []
-        while 'PRADK' not in line:
-            deck.append([float(f) for f in line.split()])
-            line= modfile.readline()
-        deck= numpy.array(deck)
+        lines= []
+        for line in modfile:
+            if 'PRADK' in line: break
+            lines.append(line)
+        deck= numpy.array(' '.join(lines).split(),dtype='float')\
+            .reshape((len(lines),-1))
         # PRADK
         pradk= float(line.split()[1])   
     return (first4lines,abscale,abchanges,deck,pradk)
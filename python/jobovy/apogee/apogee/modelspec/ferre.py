@@ -4,10 +4,7 @@
 import os, os.path
 import copy
 import subprocess
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
+import threading
 import numpy
 from functools import wraps
 import tempfile
@@ -48,7 +45,7 @@ class Interpolator:
     """Return an interpolator that can directly interact with the FERRE Fortran library"""
     def __init__(self,lib='GK',pca=True,sixd=True,dr=None,
                  inter=3,f_format=1,f_access=None,
-                 verbose=False,apStarWavegrid=True):
+                 verbose=False,apStarWavegrid=True,ferre='ferre'):
         """
         NAME:
            __init__
@@ -64,6 +61,7 @@ class Interpolator:
               inter= (3) order of the interpolation
               f_format= (1) file format (0=ascii, 1=unf)
               f_access= (None) 0: load whole library, 1: use direct access (for small numbers of interpolations), None: automatically determine a good value (currently, 1)
+              ferre= ('ferre') FERRE executable
            Object-wide output options:
               apStarWavegrid= (True) if True, output the spectrum onto the apStar wavelength grid, otherwise just give the ASPCAP version (blue+green+red directly concatenated)
               verbose= (False) if True, run FERRE in verbose mode
@@ -92,13 +90,15 @@ class Interpolator:
         else:
             stdout= open('/dev/null', 'w')
         try:
-            self._proc= subprocess.Popen(['ferre'],
+            self._proc= subprocess.Popen([ferre],
                                          cwd=self._tmpDir,
                                          stdin=subprocess.PIPE,
                                          stdout=stdout,
                                          stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError:
-            raise Exception("Starting FERRE instance for ferre.Interpolator in directory %s failed ..." % dir)
+        except (OSError,subprocess.CalledProcessError):
+            os.remove(os.path.join(self._tmpDir,'input.nml'))
+            os.rmdir(self._tmpDir)
+            raise Exception("Starting FERRE instance for ferre.Interpolator in directory %s failed ..." % self._tmpDir)
         return None
 
     # Context manager functions
@@ -109,7 +109,7 @@ class Interpolator:
         return None
 
     @modelspecOnApStarWavegrid
-    def __call__(self,teff,logg,metals,am,nm,cm,vm=None):
+    def __call__(self,teff,logg,metals,am,nm,cm,vm=None,apStarWavegrid=True):
         """
         NAME:
            __call__
@@ -123,29 +123,39 @@ class Interpolator:
            nm - [N/M]
            cm - [C/M]
            vm= if using the 7D library, also specify the microturbulence
+           Parameters can be 1D arrays, in this case multiple spectra are returned from a single exchange with FERRE
+           apStarWavegrid= (True) if True, output the spectrum onto the apStar wavelength grid
         OUTPUT:
-           interpolated spectrum
+           interpolated spectrum (nwave) or spectra (nspec,nwave)
         HISTORY:
            2015-08-04 - Written - Bovy (UofT)
         """
-        # Build parameter string
-        paramStr= self._paramStr(teff,logg,metals,am,nm,cm,vm=None)
-        try:
-            self._proc.stdin.write((paramStr+'\n').encode('utf-8'))
-        except subprocess.CalledProcessError:
-            raise Exception("Running FERRE Interpolator instance in directory %s failed ..." % dir)
-        out= numpy.loadtxt(StringIO(self._proc.stderr.readline()))
-        return out
+        out= self._interpolate(_paramStrs(teff,logg,metals,am,nm,cm,vm=vm))
+        if numpy.ndim(teff) == 0: return out[0]
+        else: return out
+
+    def _interpolate(self,paramStrs):
+        """Send a batch of parameter strings to FERRE, return the interpolated spectra [nspec,nwave]"""
+        # Write the batch from a separate thread, such that FERRE never blocks
+        # on a full output pipe while we are still writing its input
+        def _write():
+            try:
+                self._proc.stdin.write(''.join(paramStrs).encode('utf-8'))
+                self._proc.stdin.flush()
+            except (IOError,OSError):
+                pass
+        writer= threading.Thread(target=_write)
+        writer.start()
+        lines= [self._proc.stderr.readline() for ii in range(len(paramStrs))]
+        writer.join()
+        if len(paramStrs) > 0 and len(lines[-1]) == 0:
+            raise Exception("Running FERRE Interpolator instance in directory %s failed ..." % self._tmpDir)
+        return numpy.array(b' '.join(lines).split(),dtype='float')\
+            .reshape((len(paramStrs),-1))
 
     def _paramStr(self,teff,logg,metals,am,nm,cm,vm=None):
         """Build the input string for a set of parameters"""
-        # Build parameter string
-        paramStr= 'dummy '
-        if not vm is None:
-            paramStr+= '%.3f ' % numpy.log10(vm)
-        paramStr+= '%.3f %.3f %.3f %.3f %.3f %.1f\n' \
-            % (cm,nm,am,metals,logg,teff)
-        return paramStr
+        return _paramStrs(teff,logg,metals,am,nm,cm,vm=vm)[0]
 
     def close(self):
         """
@@ -162,18 +172,125 @@ class Interpolator:
         """
         # Terminate process
         self._proc.terminate()
+        self._proc.wait()
         # Clean up temporary directory
         if os.path.exists(os.path.join(self._tmpDir,'input.nml')):
             os.remove(os.path.join(self._tmpDir,'input.nml'))
         os.rmdir(self._tmpDir)
 
+class InterpolatorPool:
+    """Return a pool of long-lived FERRE interpolators that share batches of parameters"""
+    def __init__(self,nworkers=4,ferre='ferre',**kwargs):
+        """
+        NAME:
+           __init__
+        PURPOSE:
+           Start nworkers FERRE Interpolator processes for a given model spectral library; the pool can be passed as pool= to interpolate, fit, elemfit, elemchi2, and mcmc to avoid starting FERRE (and loading the library) for each call
+        INPUT:
+           nworkers= (4) number of FERRE processes
+           ferre= ('ferre') FERRE executable
+           Library and FERRE options as for ferre.Interpolator (lib=, pca=, sixd=, dr=, inter=, f_format=, f_access=, verbose=)
+        OUTPUT:
+           Object
+        """
+        self.ferre= ferre
+        self._workers= []
+        try:
+            for ii in range(nworkers):
+                self._workers.append(Interpolator(ferre=ferre,**kwargs))
+        except:
+            self.close()
+            raise
+        return None
+
+    def __len__(self):
+        return len(self._workers)
+
+    # Context manager functions
+    def __enter__(self):
+        return self
+    def __exit__(self,type,value,traceback):
+        self.close()
+        return None
+
+    @modelspecOnApStarWavegrid
+    def __call__(self,teff,logg,metals,am,nm,cm,vm=None,apStarWavegrid=True):
+        """
+        NAME:
+           __call__
+        PURPOSE:
+           return interpolated spectra at the requested parameters, split over the workers in the pool
+        INPUT:
+           Parameters as for ferre.Interpolator (can be 1D arrays)
+           apStarWavegrid= (True) if True, output the spectrum onto the apStar wavelength grid
+        OUTPUT:
+           interpolated spectrum (nwave) or spectra (nspec,nwave)
+        """
+        out= self._interpolate(_paramStrs(teff,logg,metals,am,nm,cm,vm=vm))
+        if numpy.ndim(teff) == 0: return out[0]
+        else: return out
+
+    def _interpolate(self,paramStrs):
+        """Split a batch of parameter strings over the workers, return the interpolated spectra [nspec,nwave]"""
+        chunks= numpy.array_split(numpy.arange(len(paramStrs)),
+                                  min(len(self._workers),max(len(paramStrs),1)))
+        out= [None for chunk in chunks]
+        def _run(ii):
+            out[ii]= self._workers[ii]._interpolate([paramStrs[jj] for jj in chunks[ii]])
+        _threadmap(_run,range(len(chunks)))
+        return numpy.concatenate(out,axis=0)
+
+    def close(self):
+        """
+        NAME:
+           close
+        PURPOSE:
+           Terminate all of the FERRE processes in the pool
+        INPUT:
+           (none)
+        OUTPUT:
+           (none)
+        """
+        for worker in self._workers:
+            worker.close()
+        self._workers= []
+
+def _paramStrs(teff,logg,metals,am,nm,cm,vm=None):
+    """Build the FERRE input strings for a (set of) parameters"""
+    teff= numpy.atleast_1d(teff)
+    out= []
+    for ii in range(len(teff)):
+        paramStr= 'dummy '
+        if not vm is None:
+            paramStr+= '%.3f ' % numpy.log10(numpy.atleast_1d(vm)[ii])
+        paramStr+= '%.3f %.3f %.3f %.3f %.3f %.1f\n' \
+            % (numpy.atleast_1d(cm)[ii],numpy.atleast_1d(nm)[ii],
+               numpy.atleast_1d(am)[ii],numpy.atleast_1d(metals)[ii],
+               numpy.atleast_1d(logg)[ii],teff[ii])
+        out.append(paramStr)
+    return out
+
+def _threadmap(func,args):
+    """Run func(arg) for each arg in its own thread (the work itself is done by FERRE subprocesses)"""
+    errors= []
+    def _func(arg):
+        try:
+            func(arg)
+        except Exception as e:
+            errors.append(e)
+    threads= [threading.Thread(target=_func,args=(arg,)) for arg in args]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if len(errors) > 0: raise errors[0]
+    return None
+
 @modelspecOnApStarWavegrid
 @paramArrayInputDecorator(0)
 def interpolate(teff,logg,metals,am,nm,cm,vm=None,
                 lib='GK',pca=True,sixd=True,dr=None,
                 offile=None,
                 inter=3,f_format=1,f_access=None,
-                verbose=False,apStarWavegrid=True):
+                verbose=False,apStarWavegrid=True,pool=None):
     """
     NAME:
        interpolate
@@ -201,11 +318,16 @@ def interpolate(teff,logg,metals,am,nm,cm,vm=None,
           apStarWavegrid= (True) if True, output the spectrum onto the apStar wavelength grid, otherwise just give the ASPCAP version (blue+green+red directly concatenated)
           offile= (None) if offile is set, the FERRE OFFILE is saved to this file, otherwise this file is removed
        verbose= (False) if True, run FERRE in verbose mode
+       pool= (None) if set, a ferre.InterpolatorPool (for the same library and FERRE options) to do the interpolation with, rather than starting a new FERRE instance
     OUTPUT:
        spec[nspec,nwave]
     HISTORY:
        2015-01-23 - Written - Bovy (IAS)
     """
+    if not pool is None and offile is None:
+        out= pool._interpolate(_paramStrs(teff,logg,metals,am,nm,cm,vm=vm))
+        if len(out) == 1: out= out[0]
+        return out
     # Setup temporary directory to run FERRE from
     tmpDir= tempfile.mkdtemp(dir='./')
     try:
@@ -247,7 +369,7 @@ def fit(spec,specerr,
         offile=None,
         inter=3,f_format=1,f_access=None,
         errbar=1,indini=[1,1,1,2,2,3],init=1,initcannon=False,
-        verbose=False):
+        verbose=False,pool=None):
     """
     NAME:
        fit
@@ -292,6 +414,7 @@ def fit(spec,specerr,
        Output options:
           offile= (None) if offile is set, the FERRE OFFILE is saved to this file, otherwise this file is removed
        verbose= (False) if True, run FERRE in verbose mode
+       pool= (None) if set, a ferre.InterpolatorPool (for the same library and FERRE options) ; the spectra are split over as many simultaneous FERRE runs as there are workers in the pool
     OUTPUT:
        best-fit parameters (nspec,nparams); in the same order as the FPARAM APOGEE data product
     HISTORY:
@@ -364,66 +487,37 @@ def fit(spec,specerr,
         if isinstance(indini,list): indini[6-sixd]= -1
     if isinstance(indini,list):
         while -1 in indini: indini.remove(-1)
-    # Setup temporary directory to run FERRE from
-    tmpDir= tempfile.mkdtemp(dir='./')
-    try:
-        # First write the ipf file with the parameters
-        write_ipf(tmpDir,teff,logg,metals,am,nm,cm,vm=vm)
-        # Write the file with the fluxes and the flux errors
-        write_ffile(tmpDir,spec,specerr=specerr)
-        # Now write the input.nml file
-        if f_access is None:
-            f_access= 1
-        write_input_nml(tmpDir,'input.ipf','output.dat',ndim=7-sixd,
-                        nov=7-sixd-fixcm-fixnm-fixam-fixmetals\
-                            -fixlogg-fixteff,
-                        indv=indv,
-                        synthfile=appath.ferreModelLibraryPath\
-                            (lib=lib,pca=pca,sixd=sixd,dr=dr,
-                             header=True,unf=False),
-                        ffile='input.frd',erfile='input.err',
-                        opfile='output.opf',
-                        inter=inter,f_format=f_format,
-                        errbar=errbar,indini=indini,init=init,
-                        f_access=f_access)
-        # Run FERRE
-        run_ferre(tmpDir,verbose=verbose)
-        # Read the output
-        cols= (1,2,3,4,5,6)
-        tmpOut= numpy.loadtxt(os.path.join(tmpDir,'output.opf'),usecols=cols)
-        if len(spec.shape) == 1 or spec.shape[0] == 1:
-            out= numpy.zeros((1,7))
-            tmpOut= numpy.reshape(tmpOut,(1,7-sixd))
-        else:
-            out= numpy.zeros((nspec,7))
-        out[:,paramIndx('TEFF')]= tmpOut[:,-1]
-        out[:,paramIndx('LOGG')]= tmpOut[:,-2]
-        out[:,paramIndx('METALS')]= tmpOut[:,-3]
-        out[:,paramIndx('ALPHA')]= tmpOut[:,-4]
-        out[:,paramIndx('N')]= tmpOut[:,-5]
-        out[:,paramIndx('C')]= tmpOut[:,-6]
-        if sixd and dr == '12':
-            out[:,paramIndx('LOG10VDOP')]=\
-                numpy.log10(2.478-0.325*out[:,paramIndx('LOGG')])
-        else:
-            out[:,paramIndx('LOG10VDOP')]= tmpOut[:,0]
-        if not offile is None:
-            os.rename(os.path.join(tmpDir,'output.dat'),offile)
-    finally:
-        # Clean up
-        if os.path.exists(os.path.join(tmpDir,'input.ipf')):
-            os.remove(os.path.join(tmpDir,'input.ipf'))
-        if os.path.exists(os.path.join(tmpDir,'input.frd')):
-            os.remove(os.path.join(tmpDir,'input.frd'))
-        if os.path.exists(os.path.join(tmpDir,'input.err')):
-            os.remove(os.path.join(tmpDir,'input.err'))
-        if os.path.exists(os.path.join(tmpDir,'input.nml')):
-            os.remove(os.path.join(tmpDir,'input.nml'))
-        if os.path.exists(os.path.join(tmpDir,'output.dat')):
-            os.remove(os.path.join(tmpDir,'output.dat'))
-        if os.path.exists(os.path.join(tmpDir,'output.opf')):
-            os.remove(os.path.join(tmpDir,'output.opf'))
-        os.rmdir(tmpDir)
+    # Run FERRE, split over the workers of the pool if given
+    if f_access is None:
+        f_access= 1
+    tmpOut= _search(spec,specerr,teff,logg,metals,am,nm,cm,vm,
+                    offile=offile,verbose=verbose,pool=pool,
+                    ndim=7-sixd,
+                    nov=7-sixd-fixcm-fixnm-fixam-fixmetals\
+                        -fixlogg-fixteff,
+                    indv=indv,
+                    synthfile=appath.ferreModelLibraryPath\
+                        (lib=lib,pca=pca,sixd=sixd,dr=dr,
+                         header=True,unf=False),
+                    inter=inter,f_format=f_format,
+                    errbar=errbar,indini=indini,init=init,
+                    f_access=f_access)
+    if len(spec.shape) == 1 or spec.shape[0] == 1:
+        out= numpy.zeros((1,7))
+        tmpOut= numpy.reshape(tmpOut,(1,7-sixd))
+    else:
+        out= numpy.zeros((nspec,7))
+    out[:,paramIndx('TEFF')]= tmpOut[:,-1]
+    out[:,paramIndx('LOGG')]= tmpOut[:,-2]
+    out[:,paramIndx('METALS')]= tmpOut[:,-3]
+    out[:,paramIndx('ALPHA')]= tmpOut[:,-4]
+    out[:,paramIndx('N')]= tmpOut[:,-5]
+    out[:,paramIndx('C')]= tmpOut[:,-6]
+    if sixd and dr == '12':
+        out[:,paramIndx('LOG10VDOP')]=\
+            numpy.log10(2.478-0.325*out[:,paramIndx('LOGG')])
+    else:
+        out[:,paramIndx('LOG10VDOP')]= tmpOut[:,0]
     return out
 
 @specFitInput
@@ -515,7 +609,7 @@ def elemfit(spec,specerr,elem,
             offile=None,
             inter=3,f_format=1,f_access=None,
             errbar=1,indini=[1,1,1,2,2,3],init=0,
-            verbose=False):
+            verbose=False,pool=None):
     """
     NAME:
        elemfit
@@ -563,6 +657,7 @@ def elemfit(spec,specerr,elem,
        Output options:
           offile= (None) if offile is set, the FERRE OFFILE is saved to this file, otherwise this file is removed
        verbose= (False) if True, run FERRE in verbose mode
+       pool= (None) if set, a ferre.InterpolatorPool (for the same library and FERRE options) ; the spectra are split over as many simultaneous FERRE runs as there are workers in the pool, and the pool is used for the interpolation when estimate_err
     OUTPUT:
        best-fit parameters (nspec,nparams); in the same order as the FPARAM APOGEE data product (fixed inputs are repeated in the output)
        if estimate_err: tuple with best-fit (see above) and error on the element abundance
@@ -652,67 +747,38 @@ def elemfit(spec,specerr,elem,
     if isinstance(indini,list):
         while -1 in indini: indini.remove(-1)
     if init == 0: indini= 0
-    # Setup temporary directory to run FERRE from
-    tmpDir= tempfile.mkdtemp(dir='./')
-    try:
-        # First write the ipf file with the parameters
-        write_ipf(tmpDir,teff,logg,metals,am,nm,cm,vm=vm)
-        # Write the file with the fluxes and the flux errors
-        write_ffile(tmpDir,spec,specerr=specerr)
-        # Now write the input.nml file
-        if f_access is None:
-            f_access= 1
-        write_input_nml(tmpDir,'input.ipf','output.dat',ndim=7-sixd,
-                        nov=7-sixd-fixcm-fixnm-fixam-fixmetals\
-                            -fixlogg-fixteff,
-                        indv=indv,
-                        synthfile=appath.ferreModelLibraryPath\
-                            (lib=lib,pca=pca,sixd=sixd,dr=dr,
-                             header=True,unf=False),
-                        ffile='input.frd',erfile='input.err',
-                        opfile='output.opf',
-                        inter=inter,f_format=f_format,
-                        errbar=errbar,indini=indini,init=init,
-                        f_access=f_access,
-                        filterfile=apwindow.path(elem,dr=dr))
-        # Run FERRE
-        run_ferre(tmpDir,verbose=verbose)
-        # Read the output
-        cols= (1,2,3,4,5,6)
-        tmpOut= numpy.loadtxt(os.path.join(tmpDir,'output.opf'),usecols=cols)
-        if len(spec.shape) == 1 or spec.shape[0] == 1:
-            out= numpy.zeros((1,7))
-            tmpOut= numpy.reshape(tmpOut,(1,7-sixd))
-        else:
-            out= numpy.zeros((nspec,7))
-        out[:,paramIndx('TEFF')]= tmpOut[:,-1]
-        out[:,paramIndx('LOGG')]= tmpOut[:,-2]
-        out[:,paramIndx('METALS')]= tmpOut[:,-3]
-        out[:,paramIndx('ALPHA')]= tmpOut[:,-4]
-        out[:,paramIndx('N')]= tmpOut[:,-5]
-        out[:,paramIndx('C')]= tmpOut[:,-6]
-        if sixd and dr == '12':
-            out[:,paramIndx('LOG10VDOP')]=\
-                numpy.log10(2.478-0.325*out[:,paramIndx('LOGG')])
-        else:
-            out[:,paramIndx('LOG10VDOP')]= tmpOut[:,0]
-        if not offile is None:
-            os.rename(os.path.join(tmpDir,'output.dat'),offile)
-    finally:
-        # Clean up
-        if os.path.exists(os.path.join(tmpDir,'input.ipf')):
-            os.remove(os.path.join(tmpDir,'input.ipf'))
-        if os.path.exists(os.path.join(tmpDir,'input.frd')):
-            os.remove(os.path.join(tmpDir,'input.frd'))
-        if os.path.exists(os.path.join(tmpDir,'input.err')):
-            os.remove(os.path.join(tmpDir,'input.err'))
-        if os.path.exists(os.path.join(tmpDir,'input.nml')):
-            os.remove(os.path.join(tmpDir,'input.nml'))
-        if os.path.exists(os.path.join(tmpDir,'output.dat')):
-            os.remove(os.path.join(tmpDir,'output.dat'))
-        if os.path.exists(os.path.join(tmpDir,'output.opf')):
-            os.remove(os.path.join(tmpDir,'output.opf'))
-        os.rmdir(tmpDir)
+    # Run FERRE, split over the workers of the pool if given
+    if f_access is None:
+        f_access= 1
+    tmpOut= _search(spec,specerr,teff,logg,metals,am,nm,cm,vm,
+                    offile=offile,verbose=verbose,pool=pool,
+                    ndim=7-sixd,
+                    nov=7-sixd-fixcm-fixnm-fixam-fixmetals\
+                        -fixlogg-fixteff,
+                    indv=indv,
+                    synthfile=appath.ferreModelLibraryPath\
+                        (lib=lib,pca=pca,sixd=sixd,dr=dr,
+                         header=True,unf=False),
+                    inter=inter,f_format=f_format,
+                    errbar=errbar,indini=indini,init=init,
+                    f_access=f_access,
+                    filterfile=apwindow.path(elem,dr=dr))
+    if len(spec.shape) == 1 or spec.shape[0] == 1:
+        out= numpy.zeros((1,7))
+        tmpOut= numpy.reshape(tmpOut,(1,7-sixd))
+    else:
+        out= numpy.zeros((nspec,7))
+    out[:,paramIndx('TEFF')]= tmpOut[:,-1]
+    out[:,paramIndx('LOGG')]= tmpOut[:,-2]
+    out[:,paramIndx('METALS')]= tmpOut[:,-3]
+    out[:,paramIndx('ALPHA')]= tmpOut[:,-4]
+    out[:,paramIndx('N')]= tmpOut[:,-5]
+    out[:,paramIndx('C')]= tmpOut[:,-6]
+    if sixd and dr == '12':
+        out[:,paramIndx('LOG10VDOP')]=\
+            numpy.log10(2.478-0.325*out[:,paramIndx('LOGG')])
+    else:
+        out[:,paramIndx('LOG10VDOP')]= tmpOut[:,0]
     if estimate_err:
         # Determine the chi2 and the error
         elem_linspace= (-0.5,0.5,51)
@@ -721,7 +787,7 @@ def elemfit(spec,specerr,elem,
                      elem_linspace=elem_linspace,
                      fparam=out,lib=lib,pca=pca,sixd=sixd,dr=dr,
                      inter=inter,f_format=f_format,f_access=f_access,
-                     verbose=verbose)
+                     verbose=verbose,pool=pool)
         from scipy import interpolate, optimize
         outerr= numpy.empty(nspec)
         for ii in range(nspec):
@@ -748,7 +814,7 @@ def elemchi2(spec,specerr,
              lib='GK',pca=True,sixd=True,dr=None,
              offile=None,
              inter=3,f_format=1,f_access=None,
-             verbose=False):
+             verbose=False,pool=None):
     """
     NAME:
        elemchi2
@@ -783,6 +849,7 @@ def elemchi2(spec,specerr,
           f_format= (1) file format (0=ascii, 1=unf)
           f_access= (None) 0: load whole library, 1: use direct access (for small numbers of interpolations), None: automatically determine a good value (currently, 1)
        verbose= (False) if True, run FERRE in verbose mode
+       pool= (None) if set, a ferre.InterpolatorPool (for the same library and FERRE options) to do the interpolation with
     OUTPUT:
        chi^2
     HISTORY:
@@ -840,7 +907,7 @@ def elemchi2(spec,specerr,
                        am.flatten(),nm.flatten(),cm.flatten(),vm=vm,
                        lib=lib,pca=pca,sixd=sixd,dr=dr,
                        inter=inter,f_format=f_format,f_access=f_access,
-                       verbose=verbose,apStarWavegrid=False)
+                       verbose=verbose,apStarWavegrid=False,pool=pool)
     dspec= numpy.tile(spec,(1,nvelem)).reshape((nspec*nvelem,spec.shape[1]))
     dspecerr= numpy.tile(specerr,
                          (1,nvelem)).reshape((nspec*nvelem,spec.shape[1]))
@@ -857,7 +924,7 @@ def mcmc(spec,specerr,
          fixnm=False,fixvm=False,
          lib='GK',pca=True,sixd=True,dr=None,
          inter=3,f_format=1,f_access=None,
-         verbose=False):
+         verbose=False,pool=None):
     """
     NAME:
        mcmc
@@ -902,6 +969,7 @@ def mcmc(spec,specerr,
           f_format= (1) file format (0=ascii, 1=unf)
           f_access= (None) 0: load whole library, 1: use direct access (for small numbers of interpolations), None: automatically determine a good value (currently, 1)
        verbose= (False) if True, run FERRE in verbose mode
+       pool= (None) a ferre.InterpolatorPool (for the same library and FERRE options) to do the interpolation with; if None, a single-worker pool is started for the duration of the MCMC
     OUTPUT:
        TBD
     HISTORY:
@@ -992,27 +1060,37 @@ def mcmc(spec,specerr,
     # Prepare the data
     dspec= numpy.tile(spec,(nwalkers,1))
     dspecerr= numpy.tile(specerr,(nwalkers,1))
-    # Run MCMC
-    sampler= apogee.util.emcee.EnsembleSampler(nwalkers,ndim,_mcmc_lnprob,
-                                               args=[dspec,dspecerr,
-                                                     teff,logg,vm,metals,
-                                                     cm,nm,am,
-                                                     fixteff,fixlogg,fixvm,
-                                                     fixmetals,fixcm,fixnm,
-                                                     fixam,sixd,pca,
-                                                     dr,lib,
-                                                     inter,f_format,f_access])
-    # Burn-in 10% of nsamples
-    pos, prob, state = sampler.run_mcmc(p0,nsamples//10)
-    sampler.reset()
-    # Run main MCMC
-    sampler.run_mcmc(pos,nsamples)
+    # Keep FERRE running for all of the likelihood evaluations
+    ownpool= pool is None
+    if ownpool:
+        pool= InterpolatorPool(1,lib=lib,pca=pca,sixd=True,dr=dr,inter=inter,
+                               f_format=f_format,f_access=f_access,
+                               verbose=verbose)
+    try:
+        # Run MCMC
+        sampler= apogee.util.emcee.EnsembleSampler(nwalkers,ndim,_mcmc_lnprob,
+                                                   args=[dspec,dspecerr,
+                                                         teff,logg,vm,metals,
+                                                         cm,nm,am,
+                                                         fixteff,fixlogg,fixvm,
+                                                         fixmetals,fixcm,fixnm,
+                                                         fixam,sixd,pca,
+                                                         dr,lib,
+                                                         inter,f_format,f_access,
+                                                         pool])
+        # Burn-in 10% of nsamples
+        pos, prob, state = sampler.run_mcmc(p0,nsamples//10)
+        sampler.reset()
+        # Run main MCMC
+        sampler.run_mcmc(pos,nsamples)
+    finally:
+        if ownpool: pool.close()
     return sampler.flatchain
 
 def _mcmc_lnprob(p,dspec,dspecerr,
                  teff,logg,vm,metals,cm,nm,am,
                  fixteff,fixlogg,fixvm,fixmetals,fixcm,fixnm,fixam,
-                 sixd,pca,dr,lib,inter,f_format,f_access):
+                 sixd,pca,dr,lib,inter,f_format,f_access,pool=None):
     # First fill in the fixed parameters
     parIndx= 0
     if fixteff:
@@ -1054,12 +1132,88 @@ def _mcmc_lnprob(p,dspec,dspecerr,
     # Get the interpolated spectra
     ispec= interpolate(tteff,tlogg,tmetals,tam,tnm,tcm,vm=tvm,
                        sixd=True,apStarWavegrid=False,dr=dr,pca=pca,
-                       lib=lib,inter=inter,f_format=f_format,f_access=f_access)
+                       lib=lib,inter=inter,f_format=f_format,f_access=f_access,
+                       pool=pool)
     # Compute the chi^2
     chi2= _chi2(ispec,dspec[:len(ispec)],dspecerr[:len(ispec)])
     return -chi2/2.
 
-def run_ferre(dir,verbose=False):
+def _search(spec,specerr,teff,logg,metals,am,nm,cm,vm,
+            offile=None,verbose=False,pool=None,**kwargs):
+    """Run a FERRE search for the given spectra and initial parameters, with input.nml options kwargs,
+    return the output parameters [nspec,ndim]; if pool is given, the spectra are split over
+    as many simultaneous FERRE runs as there are workers in the pool"""
+    if len(spec.shape) == 1 or pool is None or len(pool) < 2:
+        return _search_one(spec,specerr,teff,logg,metals,am,nm,cm,vm,
+                           offile=offile,verbose=verbose,
+                           ferre='ferre' if pool is None else pool.ferre,
+                           **kwargs)
+    nspec= spec.shape[0]
+    chunks= numpy.array_split(numpy.arange(nspec),min(len(pool),nspec))
+    def _chunk(x,indx):
+        if x is None: return None
+        return numpy.atleast_1d(x)[indx] if numpy.ndim(x) > 0 else x
+    out= [None for chunk in chunks]
+    offiles= [None for chunk in chunks]
+    if not offile is None:
+        offiles= [offile+'.%i' % ii for ii in range(len(chunks))]
+    def _run(ii):
+        indx= chunks[ii]
+        out[ii]= numpy.reshape(\
+            _search_one(spec[indx],None if specerr is None else specerr[indx],
+                        _chunk(teff,indx),_chunk(logg,indx),
+                        _chunk(metals,indx),_chunk(am,indx),
+                        _chunk(nm,indx),_chunk(cm,indx),_chunk(vm,indx),
+                        offile=offiles[ii],verbose=verbose,ferre=pool.ferre,
+                        **kwargs),(len(indx),-1))
+    _threadmap(_run,range(len(chunks)))
+    if not offile is None:
+        with open(offile,'w') as outfile:
+            for tofile in offiles:
+                with open(tofile) as infile:
+                    outfile.write(infile.read())
+                os.remove(tofile)
+    return numpy.concatenate(out,axis=0)
+
+def _search_one(spec,specerr,teff,logg,metals,am,nm,cm,vm,
+                offile=None,verbose=False,ferre='ferre',**kwargs):
+    """Run a single FERRE search in a temporary directory, return the output parameters"""
+    # Setup temporary directory to run FERRE from
+    tmpDir= tempfile.mkdtemp(dir='./')
+    try:
+        # First write the ipf file with the parameters
+        write_ipf(tmpDir,teff,logg,metals,am,nm,cm,vm=vm)
+        # Write the file with the fluxes and the flux errors
+        write_ffile(tmpDir,spec,specerr=specerr)
+        # Now write the input.nml file
+        write_input_nml(tmpDir,'input.ipf','output.dat',
+                        ffile='input.frd',erfile='input.err',
+                        opfile='output.opf',**kwargs)
+        # Run FERRE
+        run_ferre(tmpDir,verbose=verbose,ferre=ferre)
+        # Read the output
+        cols= (1,2,3,4,5,6)
+        tmpOut= numpy.loadtxt(os.path.join(tmpDir,'output.opf'),usecols=cols)
+        if not offile is None:
+            os.rename(os.path.join(tmpDir,'output.dat'),offile)
+    finally:
+        # Clean up
+        if os.path.exists(os.path.join(tmpDir,'input.ipf')):
+            os.remove(os.path.join(tmpDir,'input.ipf'))
+        if os.path.exists(os.path.join(tmpDir,'input.frd')):
+            os.remove(os.path.join(tmpDir,'input.frd'))
+        if os.path.exists(os.path.join(tmpDir,'input.err')):
+            os.remove(os.path.join(tmpDir,'input.err'))
+        if os.path.exists(os.path.join(tmpDir,'input.nml')):
+            os.remove(os.path.join(tmpDir,'input.nml'))
+        if os.path.exists(os.path.join(tmpDir,'output.dat')):
+            os.remove(os.path.join(tmpDir,'output.dat'))
+        if os.path.exists(os.path.join(tmpDir,'output.opf')):
+            os.remove(os.path.join(tmpDir,'output.opf'))
+        os.rmdir(tmpDir)
+    return tmpOut
+
+def run_ferre(dir,verbose=False,ferre='ferre'):
     """
     NAME:
        run_ferre
@@ -1068,6 +1222,7 @@ def run_ferre(dir,verbose=False):
     INPUT:
        dir - directory to run the instance in (has to have an input.nml file)
        verbose= (False) if True, print the FERRE output
+       ferre= ('ferre') FERRE executable
     OUTPUT:
        (none)
     HISTORY:
@@ -1081,7 +1236,7 @@ def run_ferre(dir,verbose=False):
         stdout= open('/dev/null', 'w')
         stderr= subprocess.STDOUT
     try:
-        subprocess.check_call(['ferre'],cwd=dir,stdout=stdout,stderr=stderr)
+        subprocess.check_call([ferre],cwd=dir,stdout=stdout,stderr=stderr)
     except subprocess.CalledProcessError:
         raise Exception("Running FERRE instance in directory %s failed ..." % dir)
     return None
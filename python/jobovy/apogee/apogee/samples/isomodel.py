@@ -1,7 +1,10 @@
+import os, os.path
+import pickle
 import numpy
 from scipy import misc, special
 import scipy.interpolate
 import isodist, isodist.imf
+from galpy.util import save_pickles
 try:
     from galpy.util import bovy_plot
     _BOVY_PLOT_LOADED= True
@@ -212,7 +215,8 @@ class isomodel:
                                     h=2.*self._sample.shape[0]**(-1./5.),#h='scott',
                                     kernel='biweight',
                                     variable=True,variablenitt=3,
-                                    variableexp=0.5)
+                                    variableexp=0.5,tree=True)
+        self._tabulated= False
         return None
 
     def __call__(self,jk,h):
@@ -254,6 +258,78 @@ class isomodel:
             return self._kde(numpy.reshape(numpy.array([jk,h]),
                                            (1,2)),log=True)
 
+    def tabulate(self,savefilename=None,njk=301,nxs=1001,nq=1001):
+        """
+        NAME:
+           tabulate
+        PURPOSE:
+           precompute the conditional PDF of M_X on a grid in J-Ks between _jkmin and _jkmax and its cumulative distribution; afterwards, calc_pdf, median, quant, mode, and sigmafwhm interpolate these tables and can be called for arrays of J-Ks (for which values outside of the grid return NaN)
+        INPUT:
+           savefilename= if set, load the PDF table from this file if it exists and was computed for the same J-Ks and M_X grid (_jkmin, _jkmax, _hmin, _hmax, njk, nxs), otherwise (re)compute it and save it to this file
+           njk= (301) number of J-Ks
+           nxs= (1001) number of M_X
+           nq= (1001) number of quantiles for the inverse cumulative distribution
+        OUTPUT:
+           (none; sets up the tables)
+        """
+        self._tabulated= False
+        # The table is only reused if it was computed on the same grid
+        tabkey= (self._jkmin,self._jkmax,self._hmin,self._hmax,njk,nxs)
+        match= False
+        if not savefilename is None and os.path.exists(savefilename):
+            with open(savefilename,'rb') as savefile:
+                savedkey= pickle.load(savefile)
+                match= isinstance(savedkey,tuple) and savedkey == tabkey
+                if match:
+                    jks= pickle.load(savefile)
+                    xs= pickle.load(savefile)
+                    lnpdf= pickle.load(savefile)
+            if not match:
+                print("Saved table in %s does not match the requested grid, recomputing it ..." % savefilename)
+        if not match:
+            jks= numpy.linspace(self._jkmin,self._jkmax,njk)
+            xs= numpy.linspace(self._hmin,self._hmax,nxs)
+            lnpdf= numpy.array([self.calc_pdf(jk,nxs=nxs)[1] for jk in jks])
+            if not savefilename is None:
+                save_pickles(savefilename,tabkey,jks,xs,lnpdf)
+        self._tabjks= jks
+        self._tabxs= xs
+        self._tabpdf= numpy.exp(lnpdf)
+        # Cumulative distribution and its inverse at nq quantiles
+        cumul= numpy.cumsum(self._tabpdf,axis=1)
+        cumul/= cumul[:,-1:]
+        self._tabqs= numpy.linspace(0.,1.,nq)
+        self._tabinvcumul= numpy.array([numpy.interp(self._tabqs,tcumul,xs)
+                                        for tcumul in cumul])
+        # Mode and half-maximum points
+        self._tabmode= xs[numpy.argmax(lnpdf,axis=1)]
+        self._tabhm= numpy.empty((len(jks),2))
+        for ii in range(len(jks)):
+            try:
+                self._tabhm[ii]= _halfmax(xs,lnpdf[ii])
+            except ValueError:
+                self._tabhm[ii]= numpy.nan
+        self._tabulated= True
+        return None
+
+    def _intable(self,jk):
+        """Determine whether to use the tables for this J-Ks"""
+        if not self._tabulated: return False
+        return isinstance(jk,(list,numpy.ndarray)) \
+            or (jk >= self._tabjks[0] and jk <= self._tabjks[-1])
+
+    def _tabinterp(self,table,jk):
+        """Linearly interpolate a table in J-Ks (first axis)"""
+        tjk= numpy.atleast_1d(jk).astype('float')
+        djk= (tjk-self._tabjks[0])/(self._tabjks[1]-self._tabjks[0])
+        ilo= numpy.clip(numpy.floor(djk).astype('int'),0,len(self._tabjks)-2)
+        djk-= ilo
+        djk[(tjk < self._tabjks[0])+(tjk > self._tabjks[-1])]= numpy.nan
+        djk= numpy.reshape(djk,djk.shape+(1,)*(table.ndim-1))
+        out= (1.-djk)*table[ilo]+djk*table[ilo+1]
+        if isinstance(jk,(list,numpy.ndarray)): return out
+        else: return out[0]
+
     def plot_pdf(self,jk,**kwargs):
         """
         NAME:
@@ -293,13 +369,18 @@ class isomodel:
         PURPOSE:
            calculate the conditioned PDF
         INPUT:
-           jk - J-Ks
+           jk - J-Ks (can be an array after tabulate)
            nxs= number of M_X
         OUTPUT:
            (xs,lnpdf)
         HISTORY:
            2012-11-09 - Written - Bovy (IAS)
         """
+        if self._intable(jk) and nxs == len(self._tabxs):
+            with numpy.errstate(divide='ignore'):
+                lnpdf= numpy.log(self._tabinterp(self._tabpdf,jk))
+            lnpdf[True^numpy.isfinite(lnpdf)]= -numpy.finfo(numpy.dtype(numpy.float64)).max
+            return (self._tabxs,lnpdf)
         #Calculate pdf
         xs= numpy.linspace(self._hmin,self._hmax,nxs)
         lnpdf= self(jk*numpy.ones(nxs),xs)
@@ -334,12 +415,14 @@ class isomodel:
         PURPOSE:
            return the median of the M_x distribution at this J-K
         INPUT:
-           jk - J-Ks
+           jk - J-Ks (can be an array after tabulate)
         OUTPUT:
            median
         HISTORY:
            2012-11-09 - Written - Bovy (IAS)
         """
+        if self._intable(jk):
+            return self.quant(0.5,jk,sigma=False)
         #First calculate the inverse cumulative distribution
         interpInvCumul= self.calc_invcumul(jk)
         return interpInvCumul(0.5)
@@ -352,23 +435,29 @@ class isomodel:
            return the quantile of the M_x distribution at this J-K
         INPUT:
            q - desired quantile in terms of 'sigma'
-           jk - J-Ks
+           jk - J-Ks (can be an array after tabulate)
            sigma= if False, the quantile is the actual quantile
         OUTPUT:
            quantile
         HISTORY:
            2012-11-09 - Written - Bovy (IAS)
         """
-        #First calculate the inverse cumulative distribution
-        interpInvCumul= self.calc_invcumul(jk)
         if not sigma:
-            return interpInvCumul(q)
+            arg= q
+        elif q > 0.:
+            arg= 1.-(1.-special.erf(q/numpy.sqrt(2.)))/2.
         else:
-            if q > 0.:
-                arg= 1.-(1.-special.erf(q/numpy.sqrt(2.)))/2.
-            else:
-                arg= (1.-special.erf(-q/numpy.sqrt(2.)))/2.
-            return interpInvCumul(arg)
+            arg= (1.-special.erf(-q/numpy.sqrt(2.)))/2.
+        if self._intable(jk):
+            # Linearly interpolate the inverse cumulative distribution in q
+            dq= arg*(len(self._tabqs)-1)
+            iq= int(numpy.clip(numpy.floor(dq),0,len(self._tabqs)-2))
+            dq-= iq
+            return self._tabinterp((1.-dq)*self._tabinvcumul[:,iq]
+                                   +dq*self._tabinvcumul[:,iq+1],jk)
+        #First calculate the inverse cumulative distribution
+        interpInvCumul= self.calc_invcumul(jk)
+        return interpInvCumul(arg)
 
     def mode(self,jk):
         """
@@ -377,12 +466,14 @@ class isomodel:
         PURPOSE:
            return the moden of the M_x distribution at this J-K
         INPUT:
-           jk - J-Ks
+           jk - J-Ks (can be an array after tabulate)
         OUTPUT:
            mode
         HISTORY:
            2012-11-09 - Written - Bovy (IAS)
         """
+        if self._intable(jk):
+            return self._tabinterp(self._tabmode,jk)
         #First calculate the PDF
         xs, lnpdf= self.calc_pdf(jk,nxs=1001)
         return xs[numpy.argmax(lnpdf)]
@@ -394,24 +485,20 @@ class isomodel:
         PURPOSE:
            return the sigma of the M_X distribution based on the FWHM
         INPUT:
-           jk - J-Ks
+           jk - J-Ks (can be an array after tabulate)
            straight= (False) if True, return actual hm points
         OUTPUT:
            FWHM/2.35...
         HISTORY:
            2012-11-09 - Written - Bovy (IAS)
         """
-        #First calculate the PDF
-        xs, lnpdf= self.calc_pdf(jk,nxs=1001)
-        tmode= xs[numpy.argmax(lnpdf)]
-        lnpdf_mode= numpy.amax(lnpdf)
-        lnpdf_hm= lnpdf_mode-numpy.log(2.)
-        minxs= xs[(xs < tmode)]
-        minlnpdf= lnpdf[(xs < tmode)]
-        minhm= minxs[numpy.argmin((minlnpdf-lnpdf_hm)**2.)]
-        maxxs= xs[(xs > tmode)]
-        maxlnpdf= lnpdf[(xs > tmode)]
-        maxhm= maxxs[numpy.argmin((maxlnpdf-lnpdf_hm)**2.)]
+        if self._intable(jk):
+            hm= self._tabinterp(self._tabhm,jk)
+            minhm, maxhm= hm[...,0], hm[...,1]
+        else:
+            #First calculate the PDF
+            xs, lnpdf= self.calc_pdf(jk,nxs=1001)
+            minhm, maxhm= _halfmax(xs,lnpdf)
         if straight:
             return (minhm,maxhm)
         else:
@@ -557,3 +644,16 @@ class isomodel:
                                    marker='o',
                                    colorbar=True)
     
+
+def _halfmax(xs,lnpdf):
+    """Return the M_X on either side of the mode where the PDF is half of its maximum"""
+    tmode= xs[numpy.argmax(lnpdf)]
+    lnpdf_mode= numpy.amax(lnpdf)
+    lnpdf_hm= lnpdf_mode-numpy.log(2.)
+    minxs= xs[(xs < tmode)]
+    minlnpdf= lnpdf[(xs < tmode)]
+    minhm= minxs[numpy.argmin((minlnpdf-lnpdf_hm)**2.)]
+    maxxs= xs[(xs > tmode)]
+    maxlnpdf= lnpdf[(xs > tmode)]
+    maxhm= maxxs[numpy.argmin((maxlnpdf-lnpdf_hm)**2.)]
+    return (minhm,maxhm)
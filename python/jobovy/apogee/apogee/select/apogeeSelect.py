@@ -3,7 +3,7 @@ import copy
 import tqdm
 import numpy
 from scipy import stats, special
-from galpy.util import bovy_plot, bovy_coords
+from galpy.util import bovy_plot, bovy_coords, multi
 import matplotlib
 from matplotlib import cm, pyplot
 import warnings
@@ -1454,7 +1454,7 @@ class apogeeSelect:
 
 class apogeeEffectiveSelect:
     """Class that contains effective selection functions for APOGEE targets"""
-    def __init__(self,apoSel,MH=-1.49,dmap3d=None):
+    def __init__(self,apoSel,MH=-1.49,dmap3d=None,maxcache=64):
         """
         NAME:
            __init__
@@ -1464,6 +1464,7 @@ class apogeeEffectiveSelect:
            apoSel - an apogeeSelect object with the apogee selection function for the sample that you are interested in
            MH= (-1.49) absolute magnitude in H of the standard candle used or an array with samples of the absolute magnitude distribution for the tracer that you are using
            dmap3d= if given, a mwdust.Dustmap3D object that returns the H-band extinction in 3D; if not set use the Green15 Pan-STARRS map
+           maxcache= (64) maximum number of (location,distance grid) extinction distributions to cache between calls
         OUTPUT:
            object
         HISTORY:
@@ -1482,6 +1483,11 @@ class apogeeEffectiveSelect:
                 raise ImportError("mwdust module not installed, required for extinction tools; download and install from http://github.com/jobovy/mwdust")
             dmap3d= mwdust.Green15(filter='2MASS H')
         self._dmap3d= dmap3d
+        # Caches of the extinction distribution and of the selection function
+        self._maxcache= maxcache
+        self._dustcache= {}
+        self._dustcachekeys= []
+        self._selcache= {}
         return None
 
     def __call__(self,location,dist,MH=None):
@@ -1500,30 +1506,80 @@ class apogeeEffectiveSelect:
            2015-03-06 - Written - Bovy (IAS)
         """
         if MH is None: MH= self._MH
+        MH= numpy.atleast_1d(MH)
+        dist= numpy.atleast_1d(dist)
         distmod= 5.*numpy.log10(dist)+10.
+        # Cumulative area of the sorted A_H at each distance
+        sortah, cumarea= self._sorted_ah(location,dist)
+        # Limits in A_H for all cohorts and MH samples [ncohort x nMH]
+        hmins, hmaxs, selfunc= self._cohorts(location)
+        if len(selfunc) == 0: return numpy.zeros_like(dist)
+        loah= (hmins[:,None]-MH[None,:]).flatten()
+        hiah= (hmaxs[:,None]-MH[None,:]).flatten()
+        weight= numpy.repeat(selfunc,len(MH))
+        out= numpy.zeros(len(dist))
+        for ii in range(len(dist)):
+            # Area with lo < A_H < hi from the cumulative area
+            nlo= numpy.searchsorted(sortah[:,ii],loah-distmod[ii],side='right')
+            nhi= numpy.searchsorted(sortah[:,ii],hiah-distmod[ii],side='left')
+            out[ii]= numpy.sum(weight\
+                                   *numpy.maximum(cumarea[nhi,ii]-cumarea[nlo,ii],0.))
+        return out/cumarea[-1,0]/len(MH)
+
+    def evaluate(self,locations,dist,MH=None,threads=None):
+        """
+        NAME:
+           evaluate
+        PURPOSE:
+           evaluate the effective selection function for many locations
+        INPUT:
+           locations - list of location_ids
+           dist - distance in kpc
+           MH= (object-wide default) absolute magnitude in H of the standard candle used or an array with samples of the absolute magnitude distribution for the tracer that you are using
+           threads= (None) if set, evaluate the locations in parallel using this many processes
+        OUTPUT:
+           effective selection function [nlocation,ndist]
+        """
+        if threads is None or threads <= 1:
+            return numpy.array([self(location,dist,MH=MH)
+                                for location in locations])
+        return numpy.array(multi.parallel_map(\
+                (lambda ii: self(locations[ii],dist,MH=MH)),
+                range(len(locations)),numcores=numpy.amin([len(locations),
+                                                           threads])))
+
+    def _sorted_ah(self,location,dist):
+        """Return the sorted A_H at each distance and the corresponding cumulative pixel area (starting at 0), cached for each location and distance grid"""
+        key= (location,dist.tobytes())
+        if key in self._dustcache: return self._dustcache[key]
         # Extract the distribution of A_H at this distance from the dust map
         lcen, bcen= self._apoSel.glonGlat(location)
         pixarea, ah= self._dmap3d.dust_vals_disk(lcen[0],bcen[0],dist,
                                                  self._apoSel.radius(location))
-        distmod= numpy.tile(distmod,(ah.shape[0],1))       
-        out= numpy.zeros_like(dist)
-        # Cache the values of the selection function
-        cohorts= ['short','medium','long']
-        hmins= dict((c,self._apoSel.Hmin(location,cohort=c)) for c in cohorts)
-        hmaxs= dict((c,self._apoSel.Hmax(location,cohort=c)) for c in cohorts)
-        selfunc= dict((c,self._apoSel(location,(hmins[c]+hmaxs[c])/2.)) 
-                      for c in cohorts)
-        totarea= numpy.sum(pixarea)
-        for cohort in cohorts:
-            if numpy.isnan(hmins[cohort]):
-                continue
-            for mh in MH:
-                indx= (hmins[cohort]-mh-distmod < ah)\
-                    *(hmaxs[cohort]-mh-distmod > ah)
-                for ii in range(len(dist)):
-                    out[ii]+= selfunc[cohort]\
-                        *numpy.sum(pixarea[indx[:,ii]])/totarea
-        return out/len(MH)
+        order= numpy.argsort(ah,axis=0)
+        sortah= numpy.take_along_axis(ah,order,axis=0)
+        cumarea= numpy.zeros((ah.shape[0]+1,ah.shape[1]))
+        cumarea[1:]= numpy.cumsum(pixarea[order],axis=0)
+        self._dustcache[key]= (sortah,cumarea)
+        self._dustcachekeys.append(key)
+        if len(self._dustcachekeys) > self._maxcache:
+            del self._dustcache[self._dustcachekeys.pop(0)]
+        return (sortah,cumarea)
+
+    def _cohorts(self,location):
+        """Return the Hmin, Hmax, and selection function of the cohorts in a location, cached"""
+        if location in self._selcache: return self._selcache[location]
+        hmins, hmaxs, selfunc= [], [], []
+        for cohort in ['short','medium','long']:
+            hmin= self._apoSel.Hmin(location,cohort=cohort)
+            if numpy.isnan(hmin): continue
+            hmax= self._apoSel.Hmax(location,cohort=cohort)
+            hmins.append(hmin)
+            hmaxs.append(hmax)
+            selfunc.append(self._apoSel(location,(hmin+hmax)/2.))
+        self._selcache[location]= (numpy.array(hmins),numpy.array(hmaxs),
+                                   numpy.array(selfunc))
+        return self._selcache[location]
 
 def _append_field_recarray(recarray, name, new):
     new = numpy.asarray(new)
@@ -18,6 +18,7 @@ def linfit(*args,**kwargs):
        specerrs - errors on the spectra (nspec,nlambda); assume no covariances
        label1, label2, ... - labels (nspec); best to subtract reference values before running this
        return_residuals= (False), if True, also return the residuals
+       batch= (True) if True, fit all pixels at once (see polyfit)
     OUTPUT:
        (coefficients (ncoeffs,nlambda),scatter (nlambda))
        or (coefficients,scatter,residuals) if return_residuals
@@ -38,6 +39,7 @@ def quadfit(*args,**kwargs):
        specerrs - errors on the spectra (nspec,nlambda); assume no covariances
        label1, label2, ... - labels (nspec); best to subtract reference values before running this
        return_residuals= (False), if True, also return the residuals
+       batch= (True) if True, fit all pixels at once (see polyfit)
     OUTPUT:
        (coefficients (ncoeffs,nlambda),scatter (nlambda))
        or (coefficients,scatter,residuals) if return_residuals
@@ -59,6 +61,8 @@ def polyfit(*args,**kwargs):
        label1, label2, ... - labels (nspec); best to subtract reference values before running this
        return_residuals= (False), if True, also return the residuals
        poly= ('lin') 'lin' or 'quad' currently
+       batch= (True) if True, fit all pixels at once, with a vectorized search for the scatter; otherwise fit each pixel separately
+       chunk= (None) number of pixels to fit at once in batch mode (default: such that chunk x nspec ~ 10^7)
     OUTPUT:
        (coefficients (ncoeffs,nlambda),scatter (nlambda))
        or (coefficients,scatter,residuals) if return_residuals
@@ -70,6 +74,11 @@ def polyfit(*args,**kwargs):
     specerr= args[1]
     return_residuals= kwargs.get('return_residuals',False)
     poly= kwargs.pop('poly','lin')
+    if kwargs.get('batch',True):
+        return _polyfit_batch(spec,specerr,
+                              _polyfit_design(args[2:],poly),
+                              return_residuals=return_residuals,
+                              chunk=kwargs.get('chunk',None))
     # Setup output
     nspec= spec.shape[0]
     nwave= spec.shape[1]
@@ -152,22 +161,16 @@ def polylabels(spec,specerr,coeffs=None,scatter=None,poly='lin',
     out= numpy.empty((nspec,nout))
     if return_cov:
         outcov= numpy.empty((nspec,nout,nout))
-    # Run through the spectra
-    for ii in range(nspec):
-        labels= _polyfit_coeffs(spec[ii]-coeffs[0],specerr[ii],
-                                scatter,coeffs[1:].T,
-                                return_cov=return_cov)
-        if return_cov:
-            cov= labels[1]
-            labels= labels[0]
-        if return_poly:
-            out[ii]= labels
-        else:
-            out[ii]= labels[:nlabels]
-        if return_cov and return_poly:
-            outcov[ii]= cov
-        elif return_cov:
-            outcov[ii]= cov[:nlabels,:nlabels]
+    # Solve for all spectra at once
+    labels, cov= _polylabels_batch(spec-coeffs[0],specerr,scatter,coeffs[1:].T)
+    if return_poly:
+        out[:]= labels
+    else:
+        out[:]= labels[:,:nlabels]
+    if return_cov and return_poly:
+        outcov[:]= cov
+    elif return_cov:
+        outcov[:]= cov[:,:nlabels,:nlabels]
     if not baseline_labels is None:
         out+= baseline_labels
     if return_cov:
@@ -272,3 +275,106 @@ def _polyfit_coeffs(spec,specerr,scatter,labelA,return_cov=False):
         return (numpy.dot(ATCiAinv,ATY),ATCiAinv)
     else:
         return numpy.dot(ATCiAinv,ATY)
+
+# Batched fits
+_NSCATTERGRID= 27
+_NSCATTERITER= 30
+def _polyfit_design(labels,poly):
+    """Return the design matrix (nspec,ncoeffs) for a polynomial in the labels, in the order used by _linfit_onewave and _quadfit_onewave"""
+    vstackIn= (numpy.ones(len(labels[0])),)
+    # Linear components
+    for ii in range(len(labels)):
+        vstackIn= vstackIn+(labels[ii],)
+    # Quadratic components
+    if 'quad' in poly:
+        for ii in range(len(labels)):
+            for jj in range(ii,len(labels)):
+                vstackIn= vstackIn+(labels[ii]*labels[jj],)
+    return numpy.vstack(vstackIn).T
+
+def _polyfit_batch(spec,specerr,labelA,return_residuals=False,chunk=None):
+    """Fit a polynomial relation to all pixels at once, for a chunk of pixels at a time"""
+    nspec= spec.shape[0]
+    nwave= spec.shape[1]
+    ncoeffs= labelA.shape[1]
+    if chunk is None: chunk= numpy.amax([1,10**7//nspec])
+    outcoeffs= numpy.zeros((ncoeffs,nwave))+numpy.nan
+    outscatter= numpy.zeros(nwave)+numpy.nan
+    outresiduals= numpy.zeros((nspec,nwave))+numpy.nan
+    # Products of the design matrix for the normal equations
+    labelAA= (labelA[:,:,None]*labelA[:,None,:]).reshape((nspec,ncoeffs**2))
+    # Skip pixels without data (when given input on APOGEE grid)
+    good= numpy.arange(nwave)[True^numpy.all(numpy.isnan(spec),axis=0)]
+    for ii in range(0,len(good),chunk):
+        sys.stdout.write('\r'+"Working on pixels %i-%i / %i ...\r" \
+                             % (good[ii]+1,good[numpy.amin([ii+chunk,len(good)])-1]+1,nwave))
+        sys.stdout.flush()
+        indx= good[ii:ii+chunk]
+        tspec= spec[:,indx]
+        tspecerr2= specerr[:,indx]**2.
+        # Initialize the fit, as for a single pixel
+        initscatter= numpy.var(tspec,axis=0)\
+            -numpy.median(specerr[:,indx],axis=0)**2.
+        initscatter= numpy.where(initscatter < 0.,numpy.std(tspec,axis=0),
+                                 numpy.sqrt(numpy.fabs(initscatter)))
+        initscatter= numpy.log(initscatter) # fit as log
+        mloglike= lambda lnscatter: _polyfit_batch_mloglike(\
+            numpy.exp(lnscatter),tspec,tspecerr2,labelA,labelAA)
+        # Bracket the minimum on a grid, then refine with a golden-section search
+        grid= initscatter+numpy.linspace(-10.,3.,_NSCATTERGRID)[:,None]
+        gridmll= numpy.array([mloglike(g) for g in grid])
+        imin= numpy.argmin(gridmll,axis=0)
+        cols= numpy.arange(len(indx))
+        a= grid[numpy.maximum(imin-1,0),cols]
+        b= grid[numpy.minimum(imin+1,_NSCATTERGRID-1),cols]
+        gr= (numpy.sqrt(5.)-1.)/2.
+        c= b-gr*(b-a)
+        d= a+gr*(b-a)
+        fc= mloglike(c)
+        fd= mloglike(d)
+        for jj in range(_NSCATTERITER):
+            left= fc < fd
+            a= numpy.where(left,a,c)
+            b= numpy.where(left,d,b)
+            x= numpy.where(left,b-gr*(b-a),a+gr*(b-a))
+            fx= mloglike(x)
+            c, d, fc, fd= numpy.where(left,x,d), numpy.where(left,c,x),\
+                numpy.where(left,fx,fd), numpy.where(left,fc,fx)
+        tscatter= numpy.exp(numpy.where(fc < fd,c,d))
+        tcoeffs= _polyfit_batch_coeffs(tspec,tspecerr2,tscatter,
+                                       labelA,labelAA)
+        outcoeffs[:,indx]= tcoeffs.T
+        outscatter[indx]= tscatter
+        if return_residuals:
+            outresiduals[:,indx]= tspec-numpy.dot(labelA,tcoeffs.T)
+    sys.stdout.write('\r'+_ERASESTR+'\r')
+    sys.stdout.flush()
+    out= (outcoeffs,outscatter,)
+    if return_residuals: out= out+(outresiduals,)
+    return out
+
+def _polyfit_batch_coeffs(spec,specerr2,scatter,labelA,labelAA):
+    """For a given scatter (npix), return the best-fit coefficients (npix,ncoeffs) for all pixels"""
+    ncoeffs= labelA.shape[1]
+    Ci= 1./(specerr2+scatter**2.)
+    ATCiA= numpy.dot(Ci.T,labelAA).reshape((spec.shape[1],ncoeffs,ncoeffs))
+    ATY= numpy.dot((spec*Ci).T,labelA)
+    return linalg.solve(ATCiA,ATY[:,:,None])[:,:,0]
+
+def _polyfit_batch_mloglike(scatter,spec,specerr2,labelA,labelAA):
+    """Minus the log likelihood for all pixels, optimizing the coefficients for the given scatter"""
+    tcoeffs= _polyfit_batch_coeffs(spec,specerr2,scatter,labelA,labelAA)
+    tres= spec-numpy.dot(labelA,tcoeffs.T)
+    Ci= 1./(specerr2+scatter**2.)
+    return 0.5*numpy.sum(tres**2.*Ci,axis=0)-0.5*numpy.sum(numpy.log(Ci),axis=0)
+
+def _polylabels_batch(spec,specerr,scatter,labelA):
+    """Return the best-fit labels (nspec,ncoeffs) and their covariances (nspec,ncoeffs,ncoeffs) for all spectra at once"""
+    ncoeffs= labelA.shape[1]
+    labelAA= (labelA[:,:,None]*labelA[:,None,:]).reshape((labelA.shape[0],
+                                                          ncoeffs**2))
+    Ci= 1./(specerr**2.+scatter**2.)
+    ATCiA= numpy.dot(Ci,labelAA).reshape((spec.shape[0],ncoeffs,ncoeffs))
+    ATY= numpy.dot(spec*Ci,labelA)
+    ATCiAinv= linalg.inv(ATCiA)
+    return (numpy.einsum('nij,nj->ni',ATCiAinv,ATY),ATCiAinv)
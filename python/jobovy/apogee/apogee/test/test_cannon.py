@@ -0,0 +1,35 @@
+##############################################################################
+# test_cannon.py: test the batched Cannon training and label inference
+##############################################################################
+import numpy
+from apogee.spec import cannon
+
+def test_quadfit_polylabels():
+    numpy.random.seed(1)
+    nspec, nwave= 200, 100
+    teff= numpy.random.normal(size=nspec)
+    logg= numpy.random.normal(size=nspec)
+    labelA= numpy.vstack([numpy.ones(nspec),teff,logg,
+                          teff**2.,teff*logg,logg**2.]).T
+    coeffs= numpy.random.normal(size=(6,nwave))*0.1
+    specerr= numpy.zeros((nspec,nwave))+0.001
+    spec= numpy.dot(labelA,coeffs)\
+        +numpy.random.normal(size=(nspec,nwave))*0.001
+    spec[:,5]= numpy.nan
+    fcoeffs, fscatter= cannon.quadfit(spec,specerr,teff,logg)
+    good= numpy.arange(nwave) != 5
+    assert numpy.all(numpy.isnan(fscatter[True^good])), \
+        'cannon.quadfit does not skip pixels without data'
+    assert numpy.all(numpy.fabs(fcoeffs[:,good]-coeffs[:,good]) < 0.01), \
+        'cannon.quadfit does not recover the input coefficients'
+    labels, cov= cannon.polylabels(spec[:10,good],specerr[:10,good],
+                                   coeffs=fcoeffs[:,good],
+                                   scatter=fscatter[good],poly='quad',
+                                   return_cov=True)
+    assert numpy.all(numpy.fabs(labels[:,0]-teff[:10]) < 0.01), \
+        'cannon.polylabels does not recover the input labels'
+    assert numpy.all(numpy.fabs(labels[:,1]-logg[:10]) < 0.01), \
+        'cannon.polylabels does not recover the input labels'
+    assert cov.shape == (10,2,2), \
+        'cannon.polylabels does not return a covariance for each spectrum'
+    return None
@@ -0,0 +1,25 @@
+##############################################################################
+# test_dens_kde.py: test the chunked and KD-tree evaluation of densKDE
+##############################################################################
+import numpy
+from apogee.util import dens_kde
+
+def test_densKDE_chunk_tree():
+    numpy.random.seed(1)
+    ndata= 2000
+    data= numpy.vstack([numpy.random.normal(size=(ndata//2,2)),
+                        numpy.random.normal(size=(ndata//2,2))*0.3+2.])
+    w= numpy.random.uniform(size=ndata)
+    x= numpy.random.normal(size=(200,2))*1.5
+    kwargs= {'w':w,'h':2.*ndata**(-1./5.),'kernel':'biweight',
+             'variable':True,'variablenitt':3,'variableexp':0.5}
+    kde= dens_kde.densKDE(data,maxmem=None,**kwargs)
+    kdechunk= dens_kde.densKDE(data,maxmem=0.001,**kwargs)
+    kdetree= dens_kde.densKDE(data,maxmem=0.001,tree=True,**kwargs)
+    for log in [False,True]:
+        dens= kde(x,log=log)
+        assert numpy.all(numpy.fabs(kdechunk(x,log=log)-dens) < 10.**-10.), \
+            'densKDE evaluated in chunks does not agree with densKDE evaluated at once'
+        assert numpy.all(numpy.fabs(kdetree(x,log=log)-dens) < 10.**-10.), \
+            'densKDE evaluated using KD-trees does not agree with densKDE evaluated at once'
+    return None
@@ -0,0 +1,78 @@
+##############################################################################
+# test_ferre.py: test the persistent FERRE interpolators, using a stand-in
+#                executable that mimics FERRE's interactive interpolation
+##############################################################################
+import os, os.path
+import sys
+import shutil
+import stat
+import tempfile
+import numpy
+import apogee.modelspec.ferre as ferre
+_NWAVE= 10
+_STANDIN= """#!%s
+import sys, numpy
+nml= open('input.nml').read()
+pfile= nml.split("PFILE = '")[1].split("'")[0]
+if pfile == '/dev/stdin':
+    for line in sys.stdin:
+        if len(line.split()) == 0: continue
+        p= numpy.array(line.split()[1:],dtype='float')
+        sys.stderr.write(' '.join(['%%.3f' %% v for v in p[-1]+p[-2]+numpy.arange(%i)])+'\\n')
+        sys.stderr.flush()
+else:
+    with open('output.opf','w') as opf:
+        for line in open(pfile):
+            opf.write(line)
+    with open('output.dat','w') as dat:
+        for line in open(pfile):
+            dat.write(' '.join(['1.0']*%i)+'\\n')
+""" % (sys.executable,_NWAVE,_NWAVE)
+
+def _standin():
+    tmpdir= tempfile.mkdtemp()
+    exe= os.path.join(tmpdir,'ferre')
+    with open(exe,'w') as outfile:
+        outfile.write(_STANDIN)
+    os.chmod(exe,os.stat(exe).st_mode | stat.S_IEXEC)
+    return exe
+
+def _expected(teff,logg):
+    return (numpy.atleast_1d(teff)+numpy.atleast_1d(logg))[:,None]\
+        +numpy.arange(_NWAVE)
+
+def test_interpolator_batch():
+    exe= _standin()
+    try:
+        teff= numpy.round(numpy.linspace(4000.,5000.,2000),1)
+        logg= numpy.round(numpy.linspace(1.,3.,2000),3)
+        zero= numpy.zeros_like(teff)
+        with ferre.Interpolator(ferre=exe) as ip:
+            out= ip(teff,logg,zero,zero,zero,zero,apStarWavegrid=False)
+            single= ip(4200.,2.,0.,0.,0.,0.,apStarWavegrid=False)
+        assert numpy.all(numpy.fabs(out-_expected(teff,logg)) < 1e-3), \
+            'Batched ferre.Interpolator output does not match the input parameters'
+        assert single.shape == (_NWAVE,), \
+            'ferre.Interpolator does not return a single spectrum for scalar input'
+    finally:
+        shutil.rmtree(os.path.dirname(exe))
+    return None
+
+def test_interpolatorpool():
+    exe= _standin()
+    try:
+        teff= numpy.round(numpy.linspace(4000.,5000.,101),1)
+        logg= numpy.round(numpy.linspace(1.,3.,101),3)
+        zero= numpy.zeros_like(teff)
+        with ferre.InterpolatorPool(3,ferre=exe) as pool:
+            assert len(pool) == 3, 'ferre.InterpolatorPool does not start the requested number of workers'
+            out= pool(teff,logg,zero,zero,zero,zero,apStarWavegrid=False)
+            iout= ferre.interpolate(teff,logg,zero,zero,zero,zero,
+                                    apStarWavegrid=False,pool=pool)
+        assert numpy.all(numpy.fabs(out-_expected(teff,logg)) < 1e-3), \
+            'ferre.InterpolatorPool output is not in the order of the input parameters'
+        assert numpy.all(numpy.fabs(iout-out) < 1e-10), \
+            'ferre.interpolate with pool= does not agree with ferre.InterpolatorPool'
+    finally:
+        shutil.rmtree(os.path.dirname(exe))
+    return None
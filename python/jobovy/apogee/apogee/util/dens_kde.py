@@ -1,12 +1,14 @@
 # KDE density estimation
 import copy
 import numpy
+from scipy.spatial import cKDTree
 from galpy.util import logsumexp
 class densKDE:
     """Class for KDE density estimation"""
     def __init__(self,data,kernel='biweight',w=None,
                  scale=True,fit=False,h=1.,
-                 variable=False,variablenitt=2,variableexp=0.5):
+                 variable=False,variablenitt=2,variableexp=0.5,
+                 maxmem=1.,tree=False):
         """
         NAME:
            __init__
@@ -23,11 +25,15 @@ class densKDE:
            variable= (False) if True, do variable width
            variablenitt= number of iterations to settle on variable bandwidth
            variableexp= (0.5) exponent to use in variable lambda
+           maxmem= (1.) approximate memory budget in GB for evaluating the density, which is evaluated for chunks of x that fit within this budget (None: all x at once)
+           tree= (False) if True and the kernel is 'biweight', only visit the data within the kernel's support of x using a KD-tree (not used when sx2 is given)
         OUTPUT:
         HISTORY:
            2012-11-12 - Written - Bovy (IAS)
         """
         self._setup_kernel(kernel)
+        self._maxmem= maxmem
+        self._tree= tree and self._kernel is kernel_biweight
         self._ndata= data.shape[0]
         self._dim= data.shape[1]
         if not w is None:
@@ -40,6 +46,7 @@ class densKDE:
             self._data= data
         #For variable
         self._lambda= numpy.ones((self._ndata,self._dim))
+        self._npairs= float(self._ndata) # number of data within the support of an x, for the tree memory budget
         if fit:
             raise NotImplementedError("fit=True not implemented yet")
         else:
@@ -77,6 +84,32 @@ class densKDE:
         else:
             thish= h
         x= self._prepare_x(x,scale)
+        # Evaluate for chunks of x that fit within the memory budget
+        out= numpy.empty(x.shape[0])
+        if self._tree and sx2 is None:
+            groups= self._tree_groups()
+        ii= 0
+        while ii < x.shape[0]:
+            if self._tree and sx2 is None:
+                chunk= self._chunk(x.shape[0],
+                                   8.*(10.*self._dim+8.)*self._npairs)
+                out[ii:ii+chunk]= self._call_tree(x[ii:ii+chunk],thish,log,
+                                                  groups)
+            else:
+                chunk= self._chunk(x.shape[0],8.*8.*self._dim*self._ndata)
+                out[ii:ii+chunk]= self._call_dense(x[ii:ii+chunk],thish,log,
+                                                   None if sx2 is None \
+                                                       else sx2[ii:ii+chunk])
+            ii+= chunk
+        return out
+
+    def _chunk(self,nx,bytesperx):
+        """Number of x to evaluate at once within the memory budget"""
+        if self._maxmem is None: return nx
+        return int(numpy.amax([1,self._maxmem*1e9/bytesperx]))
+
+    def _call_dense(self,x,thish,log,sx2):
+        """Evaluate the density at x by evaluating the kernel for all data"""
         divh= numpy.tile(thish*self._lambda.T,(x.shape[0],1,1))
         if not sx2 is None:
             divh= numpy.sqrt(divh**2.
@@ -94,16 +127,55 @@ class densKDE:
                 *numpy.sum(numpy.tile(self._w,(x.shape[0],1))\
                                *thiskernel/self._lambda[:,0]**self._dim,axis=1)
 
+    def _tree_groups(self):
+        """Group the data by bandwidth (within a factor of 1.25), such that the search radius is close to the kernel's support for all data in a group, and return a list of (indices,KD-tree,largest lambda) for the groups"""
+        sindx= numpy.argsort(self._lambda[:,0])
+        lgroup= numpy.floor(numpy.log(self._lambda[sindx,0]
+                                      /self._lambda[sindx[0],0])
+                            /numpy.log(1.25))
+        return [(group,cKDTree(self._data[group]),
+                 numpy.amax(self._lambda[group,0]))
+                for group in numpy.split(sindx,
+                                         numpy.flatnonzero(numpy.diff(lgroup))+1)]
+
+    def _call_tree(self,x,thish,log,groups):
+        """Evaluate the density at x by evaluating the (compact) kernel only for the data within its support, found using KD-trees"""
+        xtree= cKDTree(x)
+        xindx, dindx= [], []
+        for group, tree, maxlambda in groups:
+            pairs= xtree.sparse_distance_matrix(tree,thish*maxlambda,
+                                                output_type='ndarray')
+            indx= pairs['v'] < thish*self._lambda[group[pairs['j']],0]
+            xindx.append(pairs['i'][indx])
+            dindx.append(group[pairs['j'][indx]])
+        xindx= numpy.concatenate(xindx)
+        dindx= numpy.concatenate(dindx)
+        self._npairs= numpy.amax([1.,len(xindx)/float(x.shape[0])])
+        divh= thish*self._lambda[dindx]
+        thiskernel= self._kernel((x[xindx]/divh)[:,:,None],
+                                 (self._data[dindx]/divh)[:,:,None],
+                                 log=log)[:,0]
+        if log:
+            # logsumexp over the data within the support of each x
+            tlog= thiskernel+numpy.log(self._w[dindx])\
+                -numpy.sum(numpy.log(divh),axis=1)
+            out= numpy.zeros(x.shape[0])-numpy.finfo(numpy.dtype(numpy.float64)).max
+            numpy.maximum.at(out,xindx,tlog)
+            tsum= numpy.bincount(xindx,weights=numpy.exp(tlog-out[xindx]),
+                                 minlength=x.shape[0])
+            indx= tsum > 0.
+            out[indx]+= numpy.log(tsum[indx])
+            return out
+        else:
+            return 1./thish**self._dim\
+                *numpy.bincount(xindx,
+                                weights=self._w[dindx]*thiskernel\
+                                    /self._lambda[dindx,0]**self._dim,
+                                minlength=x.shape[0])
+
     def _setup_variable(self,nitt,alpha):
-        chunksize= 1000
-        nchunks= self._ndata/chunksize
-        logdens= numpy.empty(self._ndata)
         for ii in range(nitt):
-            for jj in range(nchunks):
-                if jj < nchunks-1:
-                    logdens[jj*chunksize:(jj+1)*chunksize]= self(self._data[jj*chunksize:(jj+1)*chunksize],log=True,scale=False)
-                else:
-                    logdens[jj*chunksize:self._ndata]= self(self._data[jj*chunksize:self._ndata],log=True,scale=False)
+            logdens= self(self._data,log=True,scale=False)
             logg= numpy.mean(logdens)
             self._lambda= numpy.tile(numpy.exp(-alpha*(logdens-logg)),(self._dim,1)).T
         return None
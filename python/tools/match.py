@@ -40,3 +40,62 @@ def match(A,B,test=False) :
 
     return m1, m2
 
+
+def group(keys) :
+    '''
+    Sort-based grouping of an array of keys, in a single O(N log N) pass
+
+    Args:
+        keys : array of (possibly repeated) keys, e.g. APOGEE_ID for a set of visits
+
+    Returns:
+        uniq  : sorted unique keys
+        inv   : index into uniq for each input element
+        order : indices that sort keys so that members of each group are contiguous
+        start : index into the sorted array of the first member of each group
+        n     : number of members in each group
+    '''
+    keys=np.asarray(keys)
+    order=np.argsort(keys,kind='mergesort')
+    skeys=keys[order]
+    if len(skeys) == 0 :
+        return skeys, np.zeros(0,dtype=int), order, np.zeros(0,dtype=int), np.zeros(0,dtype=int)
+    new=np.ones(len(skeys),dtype=bool)
+    new[1:]= skeys[1:] != skeys[:-1]
+    start=np.where(new)[0]
+    n=np.diff(np.append(start,len(skeys)))
+    uniq=skeys[start]
+    inv=np.empty(len(keys),dtype=int)
+    inv[order]=np.cumsum(new)-1
+    return uniq, inv, order, start, n
+
+def groupstats(keys,vals,grp=None) :
+    '''
+    Per-group mean, standard deviation, minimum and maximum of values, along with
+    the residual of each element from its group mean
+
+    Args:
+        keys : array of group keys
+        vals : array of values, same length as keys
+
+    Keyword args:
+        grp= : output of group(keys), to avoid re-sorting when computing statistics for several columns
+
+    Returns:
+        dictionary with uniq, n, mean, std, min, max (one per group) and resid (one per input element);
+        std is the population standard deviation (as in np.std)
+    '''
+    if grp is None : grp=group(keys)
+    uniq,inv,order,start,n = grp
+    vals=np.asarray(vals,dtype=float)
+    out={'uniq' : uniq, 'n' : n}
+    if len(vals) == 0 :
+        for stat in ['mean','std','min','max','resid'] : out[stat]=np.zeros(0)
+        return out
+    svals=vals[order]
+    out['mean']=np.add.reduceat(svals,start)/n
+    out['resid']=vals-out['mean'][inv]
+    out['std']=np.sqrt(np.add.reduceat(out['resid'][order]**2,start)/n)
+    out['min']=np.minimum.reduceat(svals,start)
+    out['max']=np.maximum.reduceat(svals,start)
+    return out
@@ -151,15 +151,76 @@ def append(a,b) :
     # unforutantely, broadcasting of the ND array in np.append doesn't seem to work!
     return np.append(a.astype(dt),b.astype(dt)), dt
 
-def concat(files,hdu=1,verbose=False,fixfield=False) :
+def _concat_schema(file,hdu=1) :
+    """ Return (dtype,nrows) of a FITS table from its header/column definitions, without reading the data
+    """
+    with fits.open(file,memmap=True) as hdulist :
+        tab=hdulist[hdu]
+        dt=tab.columns.dtype
+        # columns.dtype is the storage dtype: use the dtype of the scaled data for TZERO/TSCAL
+        #   columns (e.g., unsigned or scaled integers), found from a zero-length slice of the table
+        scaled=[col.name for col in tab.columns if col.bzero not in (None,0) or col.bscale not in (None,1)]
+        if len(scaled) > 0 :
+            empty=tab.data[:0]
+            out=[]
+            for name in dt.names :
+                base,shape=dt.fields[name][0],()
+                if base.subdtype is not None : base,shape=base.subdtype
+                if name in scaled : base=empty[name].dtype
+                out.append((name,base,shape) if len(shape) > 0 else (name,base))
+            dt=np.dtype(out)
+        return dt, tab.header['NAXIS2']
+
+def _widen(dt,new) :
+    """ Combine two dtypes with the same fields, increasing the size of character fields as needed
+    """
+    if dt is None : return new
+    if dt.names != new.names :
+        print("fields don't match",dt.names,new.names)
+    out=[]
+    for name in dt.names :
+        base=dt.fields[name][0]
+        shape=()
+        if base.subdtype is not None : base,shape=base.subdtype
+        if name in new.names :
+            nbase=new.fields[name][0]
+            if nbase.subdtype is not None : nbase=nbase.subdtype[0]
+            if base.kind in 'SU' and nbase.kind in 'SU' :
+                base=np.dtype((base.kind,max(base.itemsize,nbase.itemsize)//np.dtype(base.kind+'1').itemsize))
+        out.append((name,base,shape) if len(shape) > 0 else (name,base))
+    return np.dtype(out)
+
+def _concat_copy(all,file,j0,hdu=1,fixfield=False,verbose=False) :
+    """ Copy the table in file into rows starting at j0 of preallocated output array, whole columns at a time
+    """
+    if verbose: print(file)
+    with fits.open(file,memmap=True) as hdulist :
+        a=hdulist[hdu].data
+        n=0 if a is None else len(a)
+        names = [] if a is None else a.dtype.names
+        for name in all.dtype.names :
+            if name == 'ALTFIELD' and fixfield :
+                all[name][j0:j0+n] = os.path.basename(os.path.dirname(file))
+            elif name in names :
+                out=all[name][j0:j0+n]
+                # strings and chararrays need to handled properly
+                out[...] = np.asarray(a[name]).reshape(out.shape)
+    return n
+
+def concat(files,hdu=1,verbose=False,fixfield=False,threads=0) :
     '''
     Create concatenation of structures from an input list of files files; structures must have identical tags
 
+    Works in two passes: the first reads only the table headers to determine the maximally sized
+    dtype needed to store data from all files, and the total number of rows; the second preallocates
+    the output once and copies each file into it column by column
+
     Args:
         files : single file name(str) or list of files, can include wildcards (expanded using glob)
   
     Keyword args:
         hdu=  : specifies which HDU to read/concatenation (default=1)
+        threads= : if >0, number of threads to use for reading/copying the files (default=0)
 
     Returns:
         structure with concatenated records
@@ -173,43 +234,29 @@ def concat(files,hdu=1,verbose=False,fixfield=False) :
         print('no files found!',file)
         return
 
-    # first go through and determine the maximally sized dtypes to be able to store data from all files
-    # append the arrays using np.append, but unfortunately, this doesn't seem to work for nD fields
-    ntot=0
+    # first go through headers and determine the maximally sized dtypes to be able to store data from all files
+    dt=None
+    nrows=[]
     for file in allfiles :
-        if verbose: print(file)
-        a=fits.open(file)[hdu].data
-        if fixfield : 
-            a = add_cols(a,np.zeros(len(a),dtype=[('ALTFIELD','S24')]))
-            a['ALTFIELD'] = os.path.basename(os.path.dirname(file))
-
-        if file == allfiles[0] :
-            app=a
-        else :
-            app,dt=append(app,a)
-        ntot+=len(a)
-        if verbose: print(len(app), len(a))
-
-    # since broadcasting in np.append doesn't seem to work, create an empty structure using the maximal
-    #    dtype, and load it up line by line, and field by field
-    all=np.empty(ntot,dt)
-
-    j=0
-    for file in allfiles :
-        if verbose: print(file)
-        a=fits.open(file)[hdu].data
-        if fixfield : 
-            a = add_cols(a,np.zeros(len(a),dtype=[('ALTFIELD','S24')]))
-            a['ALTFIELD'] = os.path.basename(os.path.dirname(file))
-        for i in range(len(a)) :
-          for name in all.dtype.names :
-            # strings and chararrays need to behandled properly
-            try:
-              all[name][j] = a[name][i]
-            except:
-              all[name][j] = a[name][i][0]
-          j+=1
-        if verbose: print(len(all), len(a))
+        fdt,n=_concat_schema(file,hdu=hdu)
+        dt=_widen(dt,fdt)
+        nrows.append(n)
+    if fixfield :
+        dt=np.dtype(dt.descr+[('ALTFIELD','S24')])
+    start=np.append(0,np.cumsum(nrows))
+    if verbose: print('total rows: ', start[-1])
+
+    # preallocate the output, and fill it with one block of rows per file
+    all=np.zeros(start[-1],dt)
+    if threads > 0 :
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(threads) as pool :
+            jobs=[pool.submit(_concat_copy,all,file,start[i],hdu=hdu,fixfield=fixfield,verbose=verbose)
+                  for i,file in enumerate(allfiles)]
+            for job in jobs : job.result()
+    else :
+        for i,file in enumerate(allfiles) :
+            _concat_copy(all,file,start[i],hdu=hdu,fixfield=fixfield,verbose=verbose)
 
     return all
 